@@ -1,23 +1,80 @@
 # Python 3 server example
 from http.server import BaseHTTPRequestHandler, HTTPServer
-import time
+import threading
+import queue
+import os
 
 hostName = "0.0.0.0"
 serverPort = 8080
 
+# How many connections are served at once, and how many more may wait for a free thread.
+# Once that many are waiting, new connections get a 503 telling them to retry later.
+concurrency = int(os.getenv("CONCURRENCY", 16))
+queueDepth = int(os.getenv("QUEUE_DEPTH", 32))
+retryAfter = int(os.getenv("RETRY_AFTER", 1))
+
+# The reply to a connection we have no room for
+busyReply = ("HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Length: 0\r\n"
+             "Connection: close\r\n\r\n" % retryAfter).encode("ascii")
+
+# Serves connections on a fixed pool of threads, so one slow request doesn't hold up everyone else
+class PooledHTTPServer(HTTPServer):
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class):
+        super().__init__(server_address, handler_class)
+        self.connections = queue.Queue(maxsize=queueDepth)
+        for _ in range(concurrency):
+            threading.Thread(target=self.serve_connections, daemon=True).start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address))
+        except queue.Full:
+            self.reply_busy(request)
+
+    # Turns a connection away with a 503 without waiting on the client, as this runs on the accept thread:
+    # the request isn't parsed, the reply is sent without blocking, and what the client already sent is
+    # drained (closing with unread data resets the connection and can lose the reply)
+    def reply_busy(self, request):
+        try:
+            request.setblocking(False)
+            request.sendall(busyReply)
+            request.recv(65536)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def serve_connections(self):
+        while True:
+            request, client_address = self.connections.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
 class MyServer(BaseHTTPRequestHandler):
+    # Keep connections open between requests, and send each reply in one go
+    protocol_version = "HTTP/1.1"
+    timeout = 15
+    wbufsize = -1
+
     def do_GET(self):
+        body = bytes("<html><head><title>Docker Python3 Web Service</title></head>"
+                     "<p>Request: %s</p>"
+                     "<body>"
+                     "<p>This is an example web server.</p>"
+                     "</body></html>" % self.path, "utf-8")
         self.send_response(200)
         self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(bytes("<html><head><title>Docker Python3 Web Service</title></head>", "utf-8"))
-        self.wfile.write(bytes("<p>Request: %s</p>" % self.path, "utf-8"))
-        self.wfile.write(bytes("<body>", "utf-8"))
-        self.wfile.write(bytes("<p>This is an example web server.</p>", "utf-8"))
-        self.wfile.write(bytes("</body></html>", "utf-8"))
+        self.wfile.write(body)
 
 if __name__ == "__main__":
-    webServer = HTTPServer((hostName, serverPort), MyServer)
+    webServer = PooledHTTPServer((hostName, serverPort), MyServer)
     print("Server started http://%s:%s" % (hostName, serverPort))
 
     try:
@@ -26,4 +83,4 @@ if __name__ == "__main__":
         pass
 
     webServer.server_close()
-    print("Server stopped.")
\ No newline at end of file
+    print("Server stopped.")
@@ -1,15 +1,75 @@
 import spacy
+import time
 import sys
+import os
 from tqdm import tqdm
 
+# Where to read from and write to - the defaults match the paths mounted in the README
+INPUT_PATH = os.getenv( 'INPUT_PATH', '/input' )
+OUTPUT_PATH = os.getenv( 'OUTPUT_PATH', '/output/output.txt' )
+
+# How many lines spaCy tags at a time, and how many processes it spreads the batches over
+BATCH_SIZE = int( os.getenv( 'BATCH_SIZE', 256 ) )
+N_PROCESS = int( os.getenv( 'N_PROCESS', 1 ) )
+
+# Set LEGACY_LOOP=1 to tag one line at a time, as this example originally did - handy for comparing speeds
+LEGACY_LOOP = os.getenv( 'LEGACY_LOOP', '0' ) == '1'
+
 # Just a little print function that forces the terminal to write immediately
 # so we can see what is going on in real-time.
 def printf( data ):
     print( data )
     sys.stdout.flush()
 
-if __name__ == "__main__":
-    # We exclude the following components as we do not need them. 
+def format_token( token ):
+    return f'{token.text}\t{token.lemma_}\t{token.pos_}\t{token._.pymusas_tags}\n'
+
+# The original approach: count the lines first for the progress bar, then call nlp() on each line
+# and flush the output after every one of them
+def tag_lines_loop( nlp, input_path, output_path ):
+    tokens_tagged = 0
+
+    # Grab a line count just so we get a nice progress bar :)
+    with open( input_path, 'r', encoding='utf8' ) as f:
+        total_lines = sum(1 for line in f)
+
+    with open( input_path, 'r', encoding='utf8' ) as input:
+        with open( output_path, 'w', encoding='utf8' ) as output:
+
+            for line in tqdm( input, ncols=100, desc="Processing file: ", unit="line", file=sys.stdout, total=total_lines ):
+                tokens = nlp( line )
+                for token in tokens:
+                    output.write( format_token( token ) )
+                tokens_tagged += len( tokens )
+
+                output.flush()
+
+    return tokens_tagged
+
+# The faster approach: stream the lines through nlp.pipe, which tags them in batches (optionally over
+# several processes) and hands them back in their original order. The progress bar follows how far
+# through the file we have read, so there is no need to read it twice, and the output is only
+# written out when its (large) buffer fills up.
+def tag_lines_pipe( nlp, input_path, output_path, batch_size=BATCH_SIZE, n_process=N_PROCESS ):
+    tokens_tagged = 0
+
+    with open( input_path, 'rb' ) as input, \
+         open( output_path, 'w', encoding='utf8', buffering=1024 * 1024 ) as output, \
+         tqdm( total=os.path.getsize( input_path ), ncols=100, desc="Processing file: ", unit="B", unit_scale=True, file=sys.stdout ) as progress:
+
+        def read_lines():
+            for line in input:
+                progress.update( len( line ) )
+                yield line.decode( 'utf8' )
+
+        for tokens in nlp.pipe( read_lines(), batch_size=batch_size, n_process=n_process ):
+            output.write( ''.join( format_token( token ) for token in tokens ) )
+            tokens_tagged += len( tokens )
+
+    return tokens_tagged
+
+def load_pipeline():
+    # We exclude the following components as we do not need them.
     printf( "Loading the parser..." )
     nlp = spacy.load( 'en_core_web_sm', exclude=['parser', 'ner'] )
 
@@ -20,22 +80,19 @@ if __name__ == "__main__":
     # Adds the English PyMUSAS rule-based tagger to the main spaCy pipeline
     printf( "Configuring spacy..." )
     nlp.add_pipe( 'pymusas_rule_based_tagger', source=english_tagger_pipeline )
+    return nlp
 
-    printf( "Go!" )
+if __name__ == "__main__":
+    nlp = load_pipeline()
 
-    # Grab a line count just so we get a nice progress bar :)
-    with open( '/input', 'r', encoding='utf8' ) as f:
-        total_lines = sum(1 for line in f)
+    printf( "Go!" )
+    start = time.perf_counter()
 
-    with open( '/input', 'r', encoding='utf8' ) as input:
-        with open( '/output/output.txt', 'w', encoding='utf8' ) as output:
+    if LEGACY_LOOP:
+        tokens_tagged = tag_lines_loop( nlp, INPUT_PATH, OUTPUT_PATH )
+    else:
+        tokens_tagged = tag_lines_pipe( nlp, INPUT_PATH, OUTPUT_PATH )
 
-            for line in tqdm( input, ncols=100, desc="Processing file: ", unit="line", file=sys.stdout, total=total_lines ):
-                tokens = nlp( line )
-                for token in tokens:
-                    output.write( f'{token.text}\t{token.lemma_}\t{token.pos_}\t{token._.pymusas_tags}\n' )
-                
-                # Avoid flushing on every write, as keeping high-burst rates often mean faster overall throughput
-                output.flush()
-        
-    printf( "Done! Bye :)" )
\ No newline at end of file
+    elapsed = time.perf_counter() - start
+    printf( f"Tagged {tokens_tagged} tokens in {elapsed:.1f}s ({tokens_tagged / elapsed:.0f} tokens/sec)" )
+    printf( "Done! Bye :)" )
@@ -0,0 +1,118 @@
+'''Compares the asyncio Dispatcher in server/src/simple_server.py with the p_umap version it replaced, against
+local stub workers. Each stub listens on its own loopback address (127.0.0.2, 127.0.0.3, ...) as the replicas of
+the compose 'worker' service would, takes --latency seconds per request and serves at most --capacity requests
+at once. The last stub is --slow-factor times slower, to show what the load balancing does with an uneven set of
+workers. The dispatcher runs twice: with 7 jobs in flight, like the 7 p_umap processes, and with its default
+of 128, where jobs queue up for free workers - the time they wait is reported separately from the request
+latency. The p_umap version needs p_tqdm installed. Run from the 03_complex_compose_example folder:
+
+    python benchmarks/dispatch.py --jobs 2000
+'''
+import io
+import sys
+import time
+import contextlib
+import random
+import asyncio
+import argparse
+import urllib.request
+import multiprocessing
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.insert( 0, str( Path( __file__ ).resolve().parent.parent / "server" / "src" ) )
+
+from simple_server import Dispatcher
+
+
+def stub_addresses( replicas ):
+    return [ f"127.0.0.{i + 2}" for i in range( replicas ) ]
+
+# A stand-in for a worker replica: reads the posted text and sleeps instead of tagging it, and only handles
+# `capacity` requests at a time
+def run_stub_workers( addresses, port, latencies, capacity ):
+    async def serve():
+        for address, latency in zip( addresses, latencies ):
+            slots = asyncio.Semaphore( capacity )
+
+            async def handle( request, latency=latency, slots=slots ):
+                await request.read()
+                async with slots:
+                    await asyncio.sleep( latency )
+                return web.Response( text="ok" )
+
+            app = web.Application()
+            app.router.add_get( "/", handle )  # As the p_umap version asks
+            app.router.add_post( "/", handle )
+            runner = web.AppRunner( app, access_log=None )
+            await runner.setup()
+            await web.TCPSite( runner, address, port, backlog=1024 ).start()
+        await asyncio.Event().wait()
+
+    asyncio.run( serve() )
+
+
+def percentiles( latencies ):
+    latencies = sorted( latencies )
+    return [ latencies[ min( len( latencies ) - 1, int( p / 100 * len( latencies ) ) ) ] * 1000 for p in ( 50, 95, 99 ) ]
+
+
+# simple_server.py as it was: p_umap over 7 processes, a new connection per job to a random worker
+def run_p_umap( addresses, port, jobs ):
+    from p_tqdm import p_umap
+
+    def ask_worker( jobId ):
+        started = time.perf_counter()
+        worker_ip = random.choice( addresses )
+        urllib.request.urlopen( f"http://{worker_ip}:{port}/" ).read()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies = p_umap( ask_worker, range( jobs ), num_cpus=7, disable=True )
+    return jobs / ( time.perf_counter() - started ), percentiles( latencies )
+
+
+def run_dispatcher( addresses, port, jobs, max_in_flight, max_parallel_jobs ):
+    dispatcher = Dispatcher( resolve=lambda: addresses, port=port, max_in_flight_per_worker=max_in_flight )
+    with contextlib.redirect_stdout( io.StringIO() ):  # The dispatcher announces every worker it finds
+        asyncio.run( dispatcher.run( range( jobs ), max_parallel_jobs ) )
+    return dispatcher.report()
+
+
+def main( args ):
+    addresses = stub_addresses( args.replicas )
+    latencies = [ args.latency ] * ( args.replicas - 1 ) + [ args.latency * args.slow_factor ]
+    stubs = multiprocessing.Process( target=run_stub_workers, args=( addresses, args.port, latencies, args.capacity ), daemon=True )
+    stubs.start()
+    time.sleep( 1 )
+
+    print( f"{args.jobs} jobs, {args.replicas} stub workers taking {args.latency * 1000:.0f} ms "
+           f"(the last one {args.latency * args.slow_factor * 1000:.0f} ms), {args.capacity} requests at a time each" )
+    print( f"{'':<16}{'jobs/sec':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'wait p99':>10}" )
+
+    if not args.skip_p_umap:
+        jobs_per_second, ( p50, p95, p99 ) = run_p_umap( addresses, args.port, args.jobs )
+        print( f"{'p_umap':<16}{jobs_per_second:>10.1f}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}{'-':>10}" )
+
+    for max_parallel_jobs in [ 7, 128 ]:
+        report = run_dispatcher( addresses, args.port, args.jobs, args.max_in_flight, max_parallel_jobs )
+        latency, wait = report[ "latency_ms" ], report[ "wait_ms" ]
+        print( f"{f'dispatcher {max_parallel_jobs}':<16}{report[ 'jobs_per_second' ]:>10.1f}"
+               f"{latency[ 'p50' ]:>10.1f}{latency[ 'p95' ]:>10.1f}{latency[ 'p99' ]:>10.1f}{wait[ 'p99' ]:>10.1f}" )
+        print( f"{'':<16}jobs per worker: {list( report[ 'jobs_per_worker' ].values() )}" )
+
+    stubs.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "--jobs", type=int, default=2000 )
+    parser.add_argument( "--replicas", type=int, default=5 )
+    parser.add_argument( "--port", type=int, default=18080 )
+    parser.add_argument( "--latency", type=float, default=0.02 )
+    parser.add_argument( "--slow-factor", type=float, default=5 )
+    parser.add_argument( "--capacity", type=int, default=8 )
+    parser.add_argument( "--max-in-flight", type=int, default=8 )
+    parser.add_argument( "--skip-p-umap", action="store_true" )
+    main( parser.parse_args() )
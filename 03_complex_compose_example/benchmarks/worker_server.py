@@ -0,0 +1,171 @@
+'''Compares the pooled keep-alive server of worker/src/simple_worker.py with the single-threaded HTTPServer it
+replaced, with the compose example's 5 worker replicas simulated locally on 127.0.0.2 to 127.0.0.6. Each
+request pretends to work for --work seconds, as the original worker did, and the replicas are driven by the
+server's Dispatcher, which posts them the job text. The replicas then run for real, tagging the posted text
+with the worker's pipeline and micro-batcher, and the tagging throughput is read from their /stats. A last
+test sends a burst of requests to a single replica with a small pool and queue, to show the requests past the
+queue being turned away straight away with a 503. Needs the worker's requirements (spaCy, PyMUSAS and the
+models). Run from the 03_complex_compose_example folder:
+
+    python benchmarks/worker_server.py --jobs 1000 --work 0.05
+'''
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+import urllib.request
+import multiprocessing
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import aiohttp
+
+root = Path( __file__ ).resolve().parent.parent
+sys.path.insert( 0, str( root / "worker" / "src" ) )
+sys.path.insert( 0, str( root / "server" / "src" ) )
+
+import simple_worker
+from simple_worker import MyServer, PooledHTTPServer, MicroBatcher, Stats, load_pipeline
+from simple_server import Dispatcher
+from dispatch import stub_addresses
+
+
+# The worker's do_GET as it was: HTTP/1.0, one connection per request, the reply written in pieces
+class OldHandler( BaseHTTPRequestHandler ):
+    work = 0
+
+    def do_POST( self ):
+        self.rfile.read( int( self.headers.get( "Content-Length", 0 ) ) )
+        time.sleep( self.work )
+        self.send_response( 200 )
+        self.send_header( "Content-type", "text/plain" )
+        self.end_headers()
+        self.wfile.write( bytes( "ok", "utf-8" ) )
+
+    def log_message( self, format, *args ):
+        return
+
+class PooledHandler( MyServer ):
+    work = 0
+
+    def do_POST( self ):
+        self.rfile.read( int( self.headers.get( "Content-Length", 0 ) ) )
+        time.sleep( self.work )
+        self.reply( 200, "ok", "text/plain" )
+
+    def log_message( self, format, *args ):
+        return
+
+
+def serve( mode, address, port, work, concurrency, queue_depth ):
+    if mode == "old":
+        OldHandler.work = work
+        server = HTTPServer( ( address, port ), OldHandler )
+        server.request_queue_size = 128
+    elif mode == "tagging":
+        # The worker as it runs in the compose example, MyServer's do_POST hands the text to the batcher
+        simple_worker.stats = Stats()
+        simple_worker.batcher = MicroBatcher( load_pipeline(), simple_worker.maxBatchSize, simple_worker.maxWaitMs,
+                                              simple_worker.stats )
+        server = PooledHTTPServer( ( address, port ), MyServer, concurrency, queue_depth, 1 )
+    else:
+        PooledHandler.work = work
+        server = PooledHTTPServer( ( address, port ), PooledHandler, concurrency, queue_depth, 1 )
+    server.serve_forever()
+
+def start_replicas( mode, addresses, port, work, concurrency, queue_depth ):
+    replicas = [ multiprocessing.Process( target=serve, args=( mode, address, port, work, concurrency, queue_depth ), daemon=True )
+                 for address in addresses ]
+    for replica in replicas:
+        replica.start()
+    time.sleep( 1 )
+    return replicas
+
+# Waits for every replica to answer, the tagging ones load their pipeline first
+def wait_for_replicas( addresses, port, timeout=120 ):
+    deadline = time.monotonic() + timeout
+    for address in addresses:
+        while True:
+            try:
+                urllib.request.urlopen( f"http://{address}:{port}/stats", timeout=1 ).read()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep( 0.5 )
+
+# The tokens the replicas have tagged, from their /stats
+def tagged_tokens( addresses, port ):
+    return sum( json.loads( urllib.request.urlopen( f"http://{address}:{port}/stats" ).read() )[ "tokens" ]
+                for address in addresses )
+
+
+def run_dispatcher( addresses, port, jobs, max_in_flight ):
+    dispatcher = Dispatcher( resolve=lambda: addresses, port=port, max_in_flight_per_worker=max_in_flight, max_attempts=1 )
+    with contextlib.redirect_stdout( io.StringIO() ):
+        asyncio.run( dispatcher.run( range( jobs ), 128 ) )
+    return dispatcher.report()
+
+
+# Sends `requests` requests at once, each on its own connection, and times the replies by status
+async def burst( url, requests ):
+    async def one( session ):
+        started = time.perf_counter()
+        async with session.post( url, data=b"Keswick" ) as response:
+            await response.read()
+            return response.status, time.perf_counter() - started
+
+    async with aiohttp.ClientSession( connector=aiohttp.TCPConnector( limit=0, force_close=True ) ) as session:
+        return await asyncio.gather( *[ one( session ) for _ in range( requests ) ] )
+
+
+def main( args ):
+    addresses = stub_addresses( args.replicas )
+    print( f"{args.jobs} jobs over {args.replicas} replicas, {args.work * 1000:.0f} ms of work each, "
+           f"{args.max_in_flight} in flight per replica" )
+    print( f"{'':<10}{'requests/sec':>14}{'p50 ms':>10}{'p99 ms':>10}{'failed':>8}" )
+    for port, mode in enumerate( [ "old", "pooled" ], start=args.port ):
+        replicas = start_replicas( mode, addresses, port, args.work, args.concurrency, args.queue_depth )
+        report = run_dispatcher( addresses, port, args.jobs, args.max_in_flight )
+        latency = report[ "latency_ms" ]
+        print( f"{mode:<10}{report[ 'jobs_per_second' ]:>14.1f}{latency[ 'p50' ]:>10.1f}{latency[ 'p99' ]:>10.1f}{report[ 'failed' ]:>8}" )
+        for replica in replicas:
+            replica.terminate()
+
+    # The replicas tagging the job text for real
+    port = args.port + 2
+    replicas = start_replicas( "tagging", addresses, port, 0, args.concurrency, args.queue_depth )
+    wait_for_replicas( addresses, port )
+    report = run_dispatcher( addresses, port, args.jobs, args.max_in_flight )
+    latency = report[ "latency_ms" ]
+    print( f"{'tagging':<10}{report[ 'jobs_per_second' ]:>14.1f}{latency[ 'p50' ]:>10.1f}{latency[ 'p99' ]:>10.1f}{report[ 'failed' ]:>8}"
+           f"   {tagged_tokens( addresses, port ) / report[ 'elapsed' ]:.0f} tokens/sec tagged" )
+    for replica in replicas:
+        replica.terminate()
+
+    # Overload one replica with a small pool and queue
+    port = args.port + 3
+    replicas = start_replicas( "pooled", addresses[ :1 ], port, args.work * 4, 4, 4 )
+    results = asyncio.run( burst( f"http://{addresses[ 0 ]}:{port}/", args.burst ) )
+    for status in sorted( { status for status, _ in results } ):
+        times = sorted( seconds for s, seconds in results if s == status )
+        print( f"burst of {args.burst} on 4 threads + 4 queued: {len( times )} x {status}, "
+               f"slowest after {times[ -1 ] * 1000:.0f} ms" )
+    for replica in replicas:
+        replica.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "--jobs", type=int, default=1000 )
+    parser.add_argument( "--replicas", type=int, default=5 )
+    parser.add_argument( "--port", type=int, default=18090 )
+    parser.add_argument( "--work", type=float, default=0.05 )
+    parser.add_argument( "--max-in-flight", type=int, default=8 )
+    parser.add_argument( "--concurrency", type=int, default=32 )
+    parser.add_argument( "--queue-depth", type=int, default=64 )
+    parser.add_argument( "--burst", type=int, default=50 )
+    main( parser.parse_args() )
@@ -1,10 +1,40 @@
 # Python 3 server example
-import urllib.request
 import dns.resolver
+import dns.exception
+import aiohttp
+import asyncio
 import random
 import time
 import sys
-from p_tqdm import p_umap
+import os
+from collections import deque
+from tqdm import tqdm
+
+# Where to find our workers - every replica of the 'worker' service gets its own address under this name
+workerHostName = os.getenv( "WORKER_HOSTNAME", "worker" )
+workerPort = int( os.getenv( "WORKER_PORT", 8080 ) )
+
+# Change these to run more/fewer jobs, and to allow more/fewer of them to be running at once
+jobCount = int( os.getenv( "JOB_COUNT", 100 ) )
+maxParallelJobs = int( os.getenv( "MAX_PARALLEL_JOBS", 128 ) )
+
+# No worker is sent more than this many requests at once, the rest wait here for whichever worker frees up first
+maxInFlightPerWorker = int( os.getenv( "MAX_IN_FLIGHT_PER_WORKER", 8 ) )
+
+# How often we look the worker addresses up again, so we notice replicas being added or removed
+dnsRefreshSeconds = float( os.getenv( "DNS_REFRESH_SECONDS", 10 ) )
+
+# How many different workers a job is tried on before we give up on it, and how long each try may take
+maxAttempts = int( os.getenv( "MAX_ATTEMPTS", 3 ) )
+requestTimeout = float( os.getenv( "REQUEST_TIMEOUT", 60 ) )
+
+# The text every job sends the workers to tag - see job_text
+jobText = os.getenv( "JOB_TEXT", "The Nile is a major north-flowing river in Northeastern Africa. "
+                                 "We walked from Keswick along the shore of Derwentwater to the Lodore Falls." )
+
+# A worker that fails a request gets no new ones for this many seconds - otherwise a dead worker, which
+# fails very quickly, would always look like the least busy one
+failureCooldown = float( os.getenv( "FAILURE_COOLDOWN", 5 ) )
 
 # Just a little print function that forces the terminal to write immediately
 # so we can see what is going on in real-time.
@@ -12,43 +42,222 @@ def printf( data ):
     print( data )
     sys.stdout.flush()
 
-if __name__ == "__main__":
+# This function is where in a 'real' application we would pick the work for a job - perhaps the next
+# part of the corpus? Here every job sends the workers the same text to tag
+def job_text( job_id ):
+    return jobText
+
+# Looks up the addresses of all our worker replicas
+def resolve_workers():
+    return sorted( str( answer ) for answer in dns.resolver.Resolver().resolve( workerHostName, 'A' ) )
+
+# One worker replica, with its own pool of keep-alive connections so we don't open a new
+# TCP connection for every job
+class Worker:
+    def __init__( self, address, port, max_in_flight, timeout ):
+        self.address = address
+        self.url = f"http://{address}:{port}/"
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.completed = 0
+        self.resting_until = 0
+        self.retired = False
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector( limit=max_in_flight ),
+            timeout=aiohttp.ClientTimeout( total=timeout ) )
+
+# Hands jobs out to the workers: each job goes to the worker with the fewest of our requests
+# outstanding, and is tried again on a different worker if that one fails
+class Dispatcher:
+    def __init__( self, resolve=resolve_workers, port=workerPort, max_in_flight_per_worker=maxInFlightPerWorker,
+                  refresh_seconds=dnsRefreshSeconds, max_attempts=maxAttempts, timeout=requestTimeout,
+                  failure_cooldown=failureCooldown, job_text=job_text ):
+        self.resolve = resolve
+        self.job_text = job_text
+        self.port = port
+        self.max_in_flight_per_worker = max_in_flight_per_worker
+        self.refresh_seconds = refresh_seconds
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.failure_cooldown = failure_cooldown
+        self.workers = {}
+        self.retired = []
+        self.waiting = deque()
+        self.waits = []
+        self.latencies = []
+        self.retries = 0
+        self.failed = 0
+
+    # Looks the workers up again, starting pools for new replicas and retiring the ones that have gone
+    async def update_workers( self ):
+        addresses = await asyncio.get_running_loop().run_in_executor( None, self.resolve )
+        for address in addresses:
+            if address not in self.workers:
+                printf( f"\nFound worker {address}" )
+                self.workers[ address ] = Worker( address, self.port, self.max_in_flight_per_worker, self.timeout )
+        for address in list( self.workers ):
+            if address not in addresses:
+                printf( f"\nWorker {address} has gone" )
+                worker = self.workers.pop( address )
+                worker.retired = True
+                self.retired.append( worker )
+                if worker.in_flight == 0:
+                    await worker.session.close()
+        self.hand_out_workers()
+
+    async def keep_workers_updated( self ):
+        while True:
+            await asyncio.sleep( self.refresh_seconds )
+            try:
+                await self.update_workers()
+            except dns.exception.DNSException as e:
+                printf( f"\nCould not look up the workers, keeping the ones we have: {e}" )
+
+    # Picks the least busy worker with room for another request, preferring ones this job hasn't been tried on yet
+    # and ones that haven't failed recently
+    def pick_worker( self, tried ):
+        now = time.monotonic()
+        workers = [ w for w in self.workers.values() if w.resting_until <= now ] or list( self.workers.values() )
+        workers = [ w for w in workers if w.address not in tried ] or workers
+        available = [ w for w in workers if w.in_flight < w.max_in_flight ]
+        if not available:
+            return None
+        worker = min( available, key=lambda w: ( w.in_flight, random.random() ) )
+        worker.in_flight += 1
+        return worker
+
+    # Jobs that find every worker busy queue up here, and are handed a worker in the order they arrived
+    async def acquire( self, tried ):
+        if not self.waiting:
+            worker = self.pick_worker( tried )
+            if worker is not None:
+                return worker
+        waiter = ( asyncio.get_running_loop().create_future(), tried )
+        self.waiting.append( waiter )
+        return await waiter[ 0 ]
 
-    # Strictly, in a 'real' application where this might change, we would re-request
-    # this periodically to check we have no worker address updates.
-    printf( "Finding our worker addresses..." )
-    worker_list = []
-    answers = dns.resolver.Resolver().resolve( 'worker', 'A' )
-    for server in answers:
-        worker_list.append( server )
-    
+    def hand_out_workers( self ):
+        while self.waiting:
+            future, tried = self.waiting[ 0 ]
+            if future.cancelled():
+                self.waiting.popleft()
+                continue
+            worker = self.pick_worker( tried )
+            if worker is None:
+                break
+            self.waiting.popleft()
+            future.set_result( worker )
+
+    # A busy worker (503) tells us how long to leave it alone for, otherwise we use our own cooldown
+    def rest_after_failure( self, error ):
+        if isinstance( error, aiohttp.ClientResponseError ) and error.status == 503 and error.headers:
+            try:
+                return float( error.headers.get( "Retry-After", self.failure_cooldown ) )
+            except ValueError:
+                pass
+        return self.failure_cooldown
+
+    async def release( self, worker ):
+        worker.in_flight -= 1
+        if worker.retired and worker.in_flight == 0:
+            await worker.session.close()
+        self.hand_out_workers()
+
+    # Sends the job's text to a worker, which tags it and replies with its tokens as JSON
+    async def run_job( self, job_id ):
+        data = self.job_text( job_id ).encode( "utf-8" )
+        queued = time.perf_counter()
+        started = None
+        tried = set()
+        for attempt in range( self.max_attempts ):
+            worker = await self.acquire( tried )
+            tried.add( worker.address )
+            if started is None:
+                # Time spent waiting for the first free worker is counted separately from the request itself
+                started = time.perf_counter()
+                self.waits.append( started - queued )
+            try:
+                async with worker.session.post( worker.url, data=data ) as response:
+                    response.raise_for_status()
+                    result = await response.read()
+                worker.completed += 1
+                self.latencies.append( time.perf_counter() - started )
+                return result
+            except ( aiohttp.ClientError, asyncio.TimeoutError ) as e:
+                printf( f"\nJob {job_id} failed on worker {worker.address}: {e!r}" )
+                worker.resting_until = time.monotonic() + self.rest_after_failure( e )
+                if attempt + 1 < self.max_attempts:
+                    self.retries += 1
+            finally:
+                await self.release( worker )
+
+        self.failed += 1
+        return None
+
+    async def run( self, job_ids, max_parallel_jobs=maxParallelJobs, progress=None ):
+        await self.update_workers()
+        refresher = asyncio.create_task( self.keep_workers_updated() )
+
+        # A fixed number of runners take jobs off the list, so a long job list doesn't become
+        # a long list of waiting tasks
+        jobs = iter( job_ids )
+        async def runner():
+            for job_id in jobs:
+                await self.run_job( job_id )
+                if progress is not None:
+                    progress.update()
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather( *[ runner() for _ in range( max_parallel_jobs ) ] )
+        finally:
+            self.elapsed = time.perf_counter() - started
+            refresher.cancel()
+            for worker in list( self.workers.values() ) + self.retired:
+                await worker.session.close()
+
+    def report( self ):
+        def percentiles( values ):
+            values = sorted( values )
+            def percentile( p ):
+                return values[ min( len( values ) - 1, int( p / 100 * len( values ) ) ) ] * 1000 if values else None
+            return { "p50": percentile( 50 ), "p95": percentile( 95 ), "p99": percentile( 99 ) }
+
+        return {
+            "jobs": len( self.latencies ),
+            "failed": self.failed,
+            "retries": self.retries,
+            "elapsed": self.elapsed,
+            "jobs_per_second": len( self.latencies ) / self.elapsed,
+            # From sending a job to a worker until it is done, including any retries
+            "latency_ms": percentiles( self.latencies ),
+            # Waiting here for a worker to have room for the job
+            "wait_ms": percentiles( self.waits ),
+            "jobs_per_worker": { w.address: w.completed for w in list( self.workers.values() ) + self.retired },
+        }
+
+async def main():
+    dispatcher = Dispatcher()
+
+    # We're using the excellent tqdm library to render a nice progress bar in the terminal for us
+    with tqdm( total=jobCount, file=sys.stdout, desc="Running jobs: ", unit="job", ncols=100 ) as progress:
+        await dispatcher.run( range( jobCount ), progress=progress )
+
+    report = dispatcher.report()
+    printf( f"{report[ 'jobs' ]} jobs done ({report[ 'failed' ]} failed, {report[ 'retries' ]} retries) "
+            f"at {report[ 'jobs_per_second' ]:.1f} jobs/sec" )
+    if report[ 'jobs' ]:
+        for name in [ 'latency_ms', 'wait_ms' ]:
+            printf( f"{name}: p50 {report[ name ][ 'p50' ]:.1f}, p95 {report[ name ][ 'p95' ]:.1f}, p99 {report[ name ][ 'p99' ]:.1f}" )
+    printf( f"Jobs per worker: {report[ 'jobs_per_worker' ]}" )
+
+if __name__ == "__main__":
     # Just pause for a moment - this lets our workers all be ready, but also lets you
     # see what is happening on the terminal before we get a ton of text from the jobs
     # running on the workers :)
     printf( "Ready to go :) Waiting 5 seconds before we kick off the requests..." )
     time.sleep( 5 )
 
-    # Change this to run more/fewer jobs!
-    job_list = range( 100 )
-    max_parallel_jobs = 7
-
-    # This function is where in a 'real' application we would tell a worker what work
-    # needed to be done next - perhaps processing the next part of tha corpus? Training
-    # your LLM on the next chunk of data? Scraping the next webpage?
-    def ask_worker( jobId ):
-        printf( f"\nContacting a worker for job {jobId}..." )
-        worker_ip = random.choice( worker_list )
-        result = urllib.request.urlopen( f"http://{worker_ip}:8080/").read()
-
-    # We're using the excellent p_tqdm and tqdm libraries to render a nice progress bar
-    # in the terminal for us, as well as to dispatch our jobs in parallel - handy!
-    p_umap(
-        ask_worker,
-        job_list,
-        file=sys.stdout,
-        desc="Running jobs: ",
-        unit="job",
-        ncols=100,
-        num_cpus=max_parallel_jobs )
-
-    printf( "Server stopped, all done! Bye!" )
\ No newline at end of file
+    asyncio.run( main() )
+
+    printf( "Server stopped, all done! Bye!" )
@@ -1,55 +1,256 @@
 # Python 3 server example
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from collections import deque
+import threading
 import signal
+import queue
+import json
 import time
 import sys
+import os
+import spacy
 
 # Listen on all interfaces on port 8080
 hostName = "0.0.0.0"
 serverPort = 8080
 
+# Requests that arrive within MAX_WAIT_MS of each other are tagged together in one batch of
+# up to MAX_BATCH_SIZE texts - one nlp.pipe call is much cheaper than many nlp() calls
+maxBatchSize = int( os.getenv( "MAX_BATCH_SIZE", 32 ) )
+maxWaitMs = float( os.getenv( "MAX_WAIT_MS", 5 ) )
+
+# How many connections we serve at once, and how many more may wait for a free thread. Connections
+# arriving when the queue is full are turned away with a 503 and a Retry-After header, so the server
+# can send the job to another worker instead of piling it onto this one
+concurrency = int( os.getenv( "CONCURRENCY", 32 ) )
+queueDepth = int( os.getenv( "QUEUE_DEPTH", 64 ) )
+retryAfter = int( os.getenv( "RETRY_AFTER", 1 ) )
+
+# Seconds an idle keep-alive connection is kept open - it holds on to one of the threads meanwhile
+keepAliveTimeout = float( os.getenv( "KEEP_ALIVE_TIMEOUT", 15 ) )
+
 # Just a little print function that forces the terminal to write immediately
 # so we can see what is going on in real-time.
 def printf( data ):
     print( data )
     sys.stdout.flush()
 
+# The tagging pipeline: spaCy's small English model, without the parser, and the PyMUSAS tagger
+def load_pipeline():
+    nlp = spacy.load( 'en_core_web_sm', exclude=['parser'] )
+    english_tagger_pipeline = spacy.load( 'en_dual_none_contextual' )
+    nlp.add_pipe( 'pymusas_rule_based_tagger', source=english_tagger_pipeline )
+    return nlp
+
+# Keeps track of how many requests and batches we have handled, and how long the requests took
+class Stats:
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.batches = 0
+        self.tokens = 0
+        self.latencies = deque( maxlen=10000 ) # Only the most recent requests count towards the percentiles
+
+    def record_batch( self, latencies, tokens ):
+        with self.lock:
+            self.requests += len( latencies )
+            self.batches += 1
+            self.tokens += tokens
+            self.latencies.extend( latencies )
+
+    def report( self ):
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            latencies = sorted( self.latencies )
+            requests, batches, tokens = self.requests, self.batches, self.tokens
+
+        def percentile( p ):
+            return latencies[ min( len( latencies ) - 1, int( p / 100 * len( latencies ) ) ) ] * 1000 if latencies else None
+
+        return {
+            "requests": requests,
+            "batches": batches,
+            "mean_batch_size": requests / batches if batches else None,
+            "tokens": tokens,
+            "requests_per_second": requests / elapsed,
+            "tokens_per_second": tokens / elapsed,
+            "latency_ms": { "p50": percentile( 50 ), "p95": percentile( 95 ), "p99": percentile( 99 ) },
+        }
+
+# Collects the texts sent to us by the request handler threads into batches, and runs each batch
+# through the pipeline on a single background thread
+class MicroBatcher:
+    def __init__( self, nlp, max_batch_size, max_wait_ms, stats ):
+        self.nlp = nlp
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats
+        self.jobs = queue.Queue()
+        threading.Thread( target=self.run, daemon=True ).start()
+
+    # Called from a request handler thread, waits until the batch with our text has been tagged
+    def submit( self, text ):
+        job = { "text": text, "submitted": time.perf_counter(), "done": threading.Event() }
+        self.jobs.put( job )
+        job[ "done" ].wait()
+        if "error" in job:
+            raise RuntimeError( job[ "error" ] )
+        return job[ "result" ]
+
+    def run( self ):
+        while True:
+            # Wait for the first text, then give the others a few milliseconds to join the batch
+            batch = [ self.jobs.get() ]
+            deadline = time.perf_counter() + self.max_wait
+            while len( batch ) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append( self.jobs.get( timeout=remaining ) )
+                except queue.Empty:
+                    break
+
+            tokens = 0
+            try:
+                for job, doc in zip( batch, self.nlp.pipe( [ job[ "text" ] for job in batch ], batch_size=len( batch ) ) ):
+                    job[ "result" ] = [ {
+                        "text": token.text,
+                        "lemma": token.lemma_,
+                        "POS": token.pos_,
+                        "NE": token.ent_type_ or None,
+                        "USAS_tags": token._.pymusas_tags,
+                        "start_char": token.idx,
+                        "end_char": token.idx + len( token ),
+                    } for token in doc ]
+                    tokens += len( doc )
+            except Exception as e:
+                for job in batch:
+                    job[ "error" ] = str( e )
+
+            finished = time.perf_counter()
+            self.stats.record_batch( [ finished - job[ "submitted" ] for job in batch ], tokens )
+            for job in batch:
+                job[ "done" ].set()
+
+# Serves connections on a fixed pool of threads. Accepted connections wait in a queue of at most
+# queue_depth for a free thread, and are turned away with a 503 when the queue is full
+class PooledHTTPServer(HTTPServer):
+    # Lets plenty of connections wait to be accepted - with the default of 5, clients get
+    # their connections reset as soon as a few of them send requests at the same time
+    request_queue_size = 128
+
+    def __init__( self, server_address, handler_class, concurrency, queue_depth, retry_after ):
+        super().__init__( server_address, handler_class )
+        self.busy_reply = ( "HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Length: 0\r\n"
+                            "Connection: close\r\n\r\n" % retry_after ).encode( "ascii" )
+        self.connections = queue.Queue( maxsize=queue_depth )
+        for _ in range( concurrency ):
+            threading.Thread( target=self.serve_connections, daemon=True ).start()
+
+    def process_request( self, request, client_address ):
+        try:
+            self.connections.put_nowait( ( request, client_address ) )
+        except queue.Full:
+            self.reply_busy( request )
+
+    # Turns a connection away with a canned 503. This runs on the accept thread, so nothing here may wait
+    # on the client: the request isn't parsed, the reply is sent without blocking (a client that isn't
+    # reading just doesn't get it), and whatever the client already sent is drained without waiting for
+    # more, as closing with unread data on the socket resets the connection and can lose the reply
+    def reply_busy( self, request ):
+        try:
+            request.setblocking( False )
+            request.sendall( self.busy_reply )
+            request.recv( 65536 )
+        except OSError:
+            pass
+        self.shutdown_request( request )
+
+    def serve_connections( self ):
+        while True:
+            request, client_address = self.connections.get()
+            try:
+                self.finish_request( request, client_address )
+            except Exception:
+                self.handle_error( request, client_address )
+            finally:
+                self.shutdown_request( request )
+
 # A basic Python webserver, listens on a TCP port for web requests and writes
-# data back to the connection.
+# data back to the connection. Connections are served by a pool of threads, so that
+# requests arriving together can be batched, and are kept open between requests
+# (HTTP/1.1 keep-alive) so clients don't need a new connection for every request.
 class MyServer(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = keepAliveTimeout
+    # Buffer our replies so the headers and body go out together, rather than as several small packets
+    wbufsize = -1
+    disable_nagle_algorithm = True
 
-    # Handle HTTP GET requests... by doing nothing! We pretend to actually do
-    # some work here, but actually just wait half a second so it looks like we
-    # have something complicated to do.
-    #
-    # In your real application this would be where you would retrieve your data
-    # and do something useful with it :)
-    def do_GET(self):
-        printf( "Hello from a worker!" )
+    def reply( self, status, body, content_type ):
+        body = bytes( body, "utf-8" )
+        self.send_response( status )
+        self.send_header( "Content-type", content_type )
+        self.send_header( "Content-Length", str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
 
-        # Pretend to do some complex work :)
-        time.sleep( 0.5 )
+    # POST some text and get back its tokens, with lemma, POS, named entity type and USAS tags, as JSON
+    # A body we can't read gets a 400, and the connection is closed as we don't know where the next request starts
+    def do_POST(self):
+        try:
+            length = int( self.headers.get( "Content-Length", 0 ) )
+            if length < 0:
+                raise ValueError( "negative Content-Length" )
+        except ValueError:
+            self.close_connection = True
+            self.reply( 400, json.dumps( { "error": "bad Content-Length" } ), "application/json" )
+            return
+        try:
+            text = self.rfile.read( length ).decode( "utf-8" )
+        except UnicodeDecodeError:
+            self.reply( 400, json.dumps( { "error": "the text must be UTF-8" } ), "application/json" )
+            return
+
+        try:
+            self.reply( 200, json.dumps( batcher.submit( text ) ), "application/json" )
+        except RuntimeError as e:
+            self.reply( 500, json.dumps( { "error": str( e ) } ), "application/json" )
+
+    # GET /stats reports our throughput and latency percentiles, any other GET just
+    # replies that we're ok
+    def do_GET(self):
+        if self.path == "/stats":
+            self.reply( 200, json.dumps( stats.report() ), "application/json" )
+        else:
+            self.reply( 200, "ok", "text/plain" )
 
-        # Reply that we're ok
-        self.send_response( 200 )
-        self.send_header( "Content-type", "text/plain" )
-        self.end_headers()
-        self.wfile.write( bytes( "ok", "utf-8" ) )
-    
     # Quiets down the server a bit...
     # Comment out or delete this function to see the web requests
     def log_message( self, format, *args ):
         return
 
-if __name__ == "__main__":        
-    webServer = HTTPServer((hostName, serverPort), MyServer)
+if __name__ == "__main__":
+    # Load the pipeline once, when the worker starts, rather than for every request
+    printf( "Loading the pipeline..." )
+    nlp = load_pipeline()
+
+    stats = Stats()
+    batcher = MicroBatcher( nlp, maxBatchSize, maxWaitMs, stats )
+
+    webServer = PooledHTTPServer((hostName, serverPort), MyServer, concurrency, queueDepth, retryAfter)
     printf( "Worker started http://%s:%s" % (hostName, serverPort) )
+    printf( "Serving %d connections at once, with room for %d more to wait" % (concurrency, queueDepth) )
+    printf( "Batching up to %d texts, waiting at most %g ms" % (maxBatchSize, maxWaitMs) )
     printf( "Waiting for requests..." )
 
     # This function just handles shutting the worker down if we press Ctrl+C
     def signal_handler( sig, frame ):
         webServer.server_close()
         printf( 'You pressed Ctrl+C!' )
+        printf( json.dumps( stats.report() ) )
         sys.exit(0)
 
     signal.signal(signal.SIGINT, signal_handler)
@@ -64,4 +265,4 @@ if __name__ == "__main__":
     # either a crash, or we were shutting down anyway.
     webServer.server_close()
 
-    printf( "Worker stopped." )
\ No newline at end of file
+    printf( "Worker stopped." )
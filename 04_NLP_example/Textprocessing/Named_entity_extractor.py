@@ -1,13 +1,26 @@
+import os
+import json
+import time
+import logging
+import hashlib
+from pathlib import Path
+import numpy
 import spacy
-from spacy.tokens import Span
+import lemminflect
+from spacy.tokens import Span, Doc
 from spacy import displacy
 from collections import OrderedDict
 from lemminflect import getLemma, getInflection
 
 import requests
-import re
-import aiohttp
+from bisect import bisect_left, bisect_right
 import asyncio
+from geocoder import NominatimGeocoder
+from gazetteer_matcher import GazetteerMatcher
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
 BG_COLOR = {
     'PLANT': '#a9dfbf',  ### the added plant name
     'PLNAME':'#feca74',
@@ -49,18 +62,106 @@ print(entities) """
  ('Northeastern', 'B-GPE', {'latitude': '46.2588615', 'longitude': '-83.6403313'}), ('Africa', 'I-GPE', {'latitude': '46.2588615', 'longitude': '-83.6403313'}),
    ('.', 'O', None)]'''
 
+# The lists the EntityRuler patterns are built from
+RESOURCE_FILES = ['LD_placenames.txt', 'geo_feature_nouns.txt', 'locative_adverbs.txt', 'spatial_prepositions.txt',
+                  'distances.txt', 'dates.txt', 'times.txt', 'events.txt', 'Plant_list.txt',
+                  'positive-words.txt', 'negative-words.txt']
+
+# Bump this when build_entity_patterns or the snapshot format changes, so existing snapshots are rebuilt
+PATTERNS_VERSION = 2
+
 class NamedEntityExtractor:
-    def __init__(self, nlp_model):
+    def __init__(self, nlp_model, geocode_cache=None, geocoder=None, snapshot_dir='resources/snapshots'):
         self.nlp = nlp_model
         self.nlp.add_pipe("sentencizer")
         self.ruler = self.nlp.add_pipe("entity_ruler", before='ner')
+        self.snapshot_dir = Path(snapshot_dir) if snapshot_dir else None
         self.setup_entity_patterns()
-        self.combine = lambda x, y: (x[0], x[1], x[2]+' '+y[2], x[3])
         self.geolocation_tags = ['GEO', 'PLNAME', 'GPE']  # Tags for which to perform geocoding
-        self.geocode_cache = {}
+        # geocode_cache can be any GeocodeCache backend, e.g. a SQLiteGeocodeCache shared by parallel workers
+        self.geocoder = geocoder if geocoder is not None else NominatimGeocoder(cache=geocode_cache)
+        self.geocode_cache = self.geocoder.cache
+        self.entity_matcher = None  # (entity list, GazetteerMatcher) of the last list given to extract_entities
+        self.metrics = Metrics()  # TextProcessor swaps in the Metrics of the file it is working on
 
 
+    # Building the patterns means reading all the resource lists, inflecting the geo nouns and running about 100k
+    # patterns through the pipeline, so the tokenized patterns are kept in a snapshot keyed by a hash of the lists
+    # and the versions involved. A matching snapshot is loaded straight into the ruler's phrase matcher; when any
+    # list or version changes the key changes and the snapshot is rebuilt.
     def setup_entity_patterns(self):
+        start = time.perf_counter()
+        snapshot = self.snapshot_dir / f'entity_ruler-{self.patterns_hash()}' if self.snapshot_dir else None
+        if snapshot and snapshot.with_suffix('.json').exists():
+            build_seconds = self.load_patterns_snapshot(snapshot)
+            load_seconds = time.perf_counter() - start
+            print(f'Loaded entity patterns from {snapshot} in {load_seconds:.1f}s '
+                  f'(building them took {build_seconds:.1f}s, saved {build_seconds - load_seconds:.1f}s)')
+            return
+
+        self.ruler.add_patterns(self.build_entity_patterns())
+        build_seconds = time.perf_counter() - start
+        print(f'Built entity patterns in {build_seconds:.1f}s')
+        if snapshot:
+            self.save_patterns_snapshot(snapshot, build_seconds)
+
+    def patterns_hash(self):
+        digest = hashlib.sha256()
+        for name in RESOURCE_FILES:
+            digest.update(name.encode('utf8'))
+            digest.update(Path('resources', name).read_bytes())
+        versions = [PATTERNS_VERSION, spacy.__version__, lemminflect.__version__,
+                    self.nlp.meta.get('name'), self.nlp.meta.get('version'), self.nlp.pipe_names]
+        digest.update(json.dumps(versions).encode('utf8'))
+        return digest.hexdigest()[:16]
+
+    # The snapshot stores each phrase pattern as its tokens' texts and trailing spaces, which is what the pattern
+    # Docs are made of: the texts of all patterns NUL-separated in one UTF-8 buffer in a .npz file, with the
+    # spaces, the pattern lengths and the label ids next to it.
+    def save_patterns_snapshot(self, snapshot, build_seconds):
+        labels = list(self.ruler.phrase_patterns)
+        patterns = [(label_id, doc)
+                    for label_id, label in enumerate(labels) for doc in self.ruler.phrase_patterns[label]]
+        words = '\0'.join(token.text for _, doc in patterns for token in doc)
+        snapshot.parent.mkdir(parents=True, exist_ok=True)
+        # Written under temporary names and renamed, so a parallel run never loads a half-written snapshot;
+        # the .json is renamed last as it marks the snapshot as complete
+        temp_suffix = f'.{os.getpid()}.tmp'
+        with open(snapshot.with_suffix('.npz' + temp_suffix), 'wb') as file:
+            numpy.savez(file,
+                        words=numpy.frombuffer(words.encode('utf8'), dtype=numpy.uint8),
+                        spaces=numpy.array([bool(token.whitespace_) for _, doc in patterns for token in doc]),
+                        lengths=numpy.array([len(doc) for _, doc in patterns], dtype=numpy.uint32),
+                        label_ids=numpy.array([label_id for label_id, _ in patterns], dtype=numpy.uint32))
+        with open(snapshot.with_suffix('.json' + temp_suffix), 'w') as file:
+            json.dump({'labels': labels, 'build_seconds': build_seconds}, file)
+        os.replace(snapshot.with_suffix('.npz' + temp_suffix), snapshot.with_suffix('.npz'))
+        os.replace(snapshot.with_suffix('.json' + temp_suffix), snapshot.with_suffix('.json'))
+        # Snapshots of older lists are never loaded again
+        for old in snapshot.parent.glob('entity_ruler-*'):
+            if old.stem != snapshot.name and not old.name.endswith('.tmp'):
+                old.unlink()
+
+    # The pattern Docs are made again from their tokens, without running them through the pipeline, and go into
+    # the ruler's phrase_patterns as well as its phrase matcher, as add_patterns does: so ruler.patterns, labels
+    # and to_disk see them like patterns that were added.
+    def load_patterns_snapshot(self, snapshot):
+        with open(snapshot.with_suffix('.json')) as file:
+            meta = json.load(file)
+        arrays = numpy.load(snapshot.with_suffix('.npz'))
+        words = arrays['words'].tobytes().decode('utf8').split('\0')
+        spaces, lengths, label_ids = arrays['spaces'].tolist(), arrays['lengths'].tolist(), arrays['label_ids'].tolist()
+        by_label, offset = [[] for _ in meta['labels']], 0
+        for label_id, length in zip(label_ids, lengths):
+            by_label[label_id].append(Doc(self.nlp.vocab, words=words[offset:offset + length],
+                                          spaces=spaces[offset:offset + length]))
+            offset += length
+        for label, docs in zip(meta['labels'], by_label):
+            self.ruler.phrase_patterns[label].extend(docs)
+            self.ruler.phrase_matcher.add(label, docs)
+        return meta['build_seconds']
+
+    def build_entity_patterns(self):
         # Get the list of placenames and geonouns
         place_names = [name.strip().title().replace("'S", "'s") for name in open('resources/LD_placenames.txt').readlines()] #read and convert to title case
         place_names += [name.upper() for name in place_names] #retain the upper case versions
@@ -105,8 +206,7 @@ class NamedEntityExtractor:
         patterns += [{"label": "LOCADV", "pattern": word} for word in loc_advs]
         patterns += [{"label": "SP-PREP", "pattern": word} for word in sp_prep]
 
-
-        self.ruler.add_patterns(patterns)
+        return patterns
 
 
     
@@ -119,36 +219,42 @@ class NamedEntityExtractor:
             gf_names_inflected.extend(list(getLemma(w.strip(), 'NOUN', lemmatize_oov=False)))
         return list(set(gf_names_inflected))
     
-    # Generates a dictionary of entities with the indexes as keys
+    # Generates a dictionary of entities with the indexes as keys. Each position takes the longest entry
+    # that matches there, on word boundaries. The matcher is kept for the last list given and found again by
+    # the list's identity, as hashing a list of 170k entries on every call would cost more than the matcher
+    # saves; a list changed in place is not noticed, give a new list instead.
     def extract_entities(self,text, ent_list, tag='PLNAME'):
-        sorted(set(ent_list), key=lambda x:len(x), reverse=True)
-        extracted_entities = {}
-        for ent in ent_list:
-            for match in re.finditer(f' {ent}[\.,\s\n;:]', text):
-            
-                extracted_entities[match.start()+1]=text[match.start()+1:match.end()-1], tag
-        return {i:extracted_entities[i] for i in sorted(extracted_entities.keys())}
-
-
-    def combine_multi_tokens(self,a_list):
-        new_list = [a_list.pop()]
-        while a_list:
-            last = a_list.pop()
-            if new_list[-1][0] - last[0] == 1:
-                new_list.append(self.combine(last, new_list.pop()))
-            else:
-                new_list.append(last)
-        return sorted(new_list)
+        if self.entity_matcher is None or self.entity_matcher[0] is not ent_list:
+            self.entity_matcher = (ent_list, GazetteerMatcher(ent_list))
+        return {start: (text[start:end], tag) for start, end in self.entity_matcher[1].find(text)}
+
 
-     # Generates a dictionary of semantic entities combining adjacent ones
+     # Generates a dictionary of semantic entities combining adjacent ones. The tokens are read once, their
+     # primary USAS tags encoded as ids into the doc's distinct tags; a table of which tags start with the prefix
+     # of each tag type (tag_type[0]) then matches every tag type at once, and the runs of adjacent matching tokens
+     # are found from where the matches switch on and off. A run is keyed by the offset of its first token and
+     # holds its texts joined by spaces; where two tag types start a run at the same token, the later one wins.
     def extract_sem_entities(self,processed_text, tag_types):
-        entities, tokens = {}, [token.text for token in processed_text]
-        for tag_type in tag_types:
-            tag_indices = [(i, token.idx, token.text, tag_type) for i, token in enumerate(processed_text) 
-                                if token._.pymusas_tags[0].startswith(tag_type[0])]
-            if tag_indices:
-                for i, idx, token, tag in self.combine_multi_tokens(tag_indices):
-                    entities[idx] = token, tag
+        tag_ids, tag_codes, texts, offsets = {}, [], [], []
+        for token in processed_text:
+            tag_codes.append(tag_ids.setdefault(token._.pymusas_tags[0], len(tag_ids)))
+            texts.append(token.text)
+            offsets.append(token.idx)
+        if not texts or not tag_types:
+            return OrderedDict()
+
+        tags = list(tag_ids)
+        table = numpy.array([[tag.startswith(tag_type[0]) for tag in tags] for tag_type in tag_types])
+        matches = numpy.zeros((len(tag_types), len(texts) + 2), dtype=numpy.int8)
+        matches[:, 1:-1] = table[:, numpy.array(tag_codes)]
+        edges = numpy.diff(matches, axis=1)
+        # Row-major order, so the n-th start and the n-th end are the same run, and the runs come tag type by tag type
+        rows, starts = numpy.nonzero(edges == 1)
+        _, ends = numpy.nonzero(edges == -1)
+
+        entities = {}
+        for row, start, end in zip(rows.tolist(), starts.tolist(), ends.tolist()):
+            entities[offsets[start]] = ' '.join(texts[start:end]), tag_types[row]
         return OrderedDict(sorted(entities.items()))
 
 
@@ -185,48 +291,83 @@ class NamedEntityExtractor:
 
 
     async def geocode(self, place_name):
-        if place_name in self.geocode_cache:
-            return self.geocode_cache[place_name]
-
-        base_url = "https://nominatim.openstreetmap.org/search"
-        params = {'q': place_name, 'format': 'json'}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(base_url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data:
-                        result = {'latitude': data[0].get('lat'), 'longitude': data[0].get('lon')}
-                        self.geocode_cache[place_name] = result
-                        return result
-        return {'latitude': None, 'longitude': None}
-
-    async def convert_to_iob_format(self, merged_entities, doc):
-        iob_entities = []
+        return await self.geocoder.geocode(place_name)
+
+    # Maps every token of the doc to the merged entity covering it (or None), matching on character
+    # offsets. The entities are sorted and do not overlap, so each sentence finds its entities with a
+    # bisect over the start offsets and the tokens are swept against them in a single pass.
+    # As before, an entity that runs over a sentence boundary is not assigned to any token.
+    def index_entities(self, merged_entities, doc):
+        starts = [e["start"] for e in merged_entities]
+        token_entities = [None] * len(doc)
         for sent in doc.sents:
-            sent_entities = [e for e in merged_entities if e["start"] >= sent.start_char and e["end"] <= sent.end_char]
+            first, last = bisect_left(starts, sent.start_char), bisect_right(starts, sent.end_char)
+            sent_entities = [e for e in merged_entities[first:last] if e["end"] <= sent.end_char]
+            j = 0
             for token in sent:
-                merged_entity = next((e for e in sent_entities if e["start"] <= token.idx < e["end"]), None)
+                while j < len(sent_entities) and sent_entities[j]["end"] <= token.idx:
+                    j += 1
+                if j < len(sent_entities) and sent_entities[j]["start"] <= token.idx:
+                    token_entities[token.i] = sent_entities[j]
+        return token_entities
+
+    # Returns one (text, IOB tag, place name) tuple per token, in the same order as the doc, so the
+    # result can be indexed with token.i. The place name is the text of the entity the token is part
+    # of when that entity is to be geocoded (PLNAME, GEONOUN and GPE), and None otherwise.
+    def iob_tags(self, merged_entities, doc):
+        with self.metrics.time('ner.index_entities'):
+            token_entities = self.index_entities(merged_entities, doc)
+
+        debug = logger.isEnabledFor(logging.DEBUG)
+        with self.metrics.time('ner.iob_tuples'):
+            iob_tags = []
+            for token, merged_entity in zip(doc, token_entities):
                 if merged_entity:
                     tag_prefix = 'B-' if token.idx == merged_entity["start"] else 'I-'
                     base_label = merged_entity["label"].split('-')[-1]
-                    print('base_label:',base_label )  
-                    if base_label in ["PLNAME", "GEONOUN",  "GPE"]:
-                        geolocation = await self.geocode(merged_entity["text"])
-                        
-                    else:
-                        geolocation = None
-                    iob_entities.append((token.text, tag_prefix + merged_entity["label"], geolocation))
+                    if debug:
+                        logger.debug('base_label: %s', base_label)
+                    place_name = merged_entity["text"] if base_label in ["PLNAME", "GEONOUN",  "GPE"] else None
+                    iob_tags.append((token.text, tag_prefix + merged_entity["label"], place_name))
                 else:
-                    iob_entities.append((token.text, 'O', None))
-        return iob_entities
+                    iob_tags.append((token.text, 'O', None))
+        return iob_tags
+
+    # Geocodes the unique place names of a document together
+    async def geocode_places(self, place_names):
+        with self.metrics.time('ner.geocode'):
+            return await self.geocoder.geocode_many(place_names)
+
+    # Turns the (text, IOB tag, place name) tuples of iob_tags into (text, IOB tag, geolocation) tuples
+    async def geolocate(self, iob_tags):
+        geolocations = await self.geocode_places({place_name for _, _, place_name in iob_tags if place_name})
+        return [(text, tag, None if place_name is None else geolocations[place_name])
+                for text, tag, place_name in iob_tags]
+
+    # Returns one (text, IOB tag, geolocation) tuple per token, in the same order as the doc,
+    # so the result can be indexed with token.i. The document's unique place names are geocoded
+    # together before the tuples are filled in.
+    async def convert_to_iob_format(self, merged_entities, doc):
+        return await self.geolocate(self.iob_tags(merged_entities, doc))
 
     async def process_text(self, text):
         doc = self.nlp(text)
-        merged_entities = self.merge_entities(doc)
-        return await self.convert_to_iob_format(merged_entities, doc)
+        return await self.process_doc(doc)
 
+    # The (text, IOB tag, place name) tuples of a Doc that has already been run through self.nlp
+    def tag_doc(self, doc):
+        with self.metrics.time('ner.merge_entities'):
+            merged_entities = self.merge_entities(doc)
+        return self.iob_tags(merged_entities, doc)
+
+    # Same as process_text, but for a Doc that has already been run through self.nlp,
+    # so callers that need the tokens as well only pay for the pipeline once
+    async def process_doc(self, doc):
+        return await self.geolocate(self.tag_doc(doc))
+
+    # Takes a text, or a Doc that has already been through the pipeline, such as one saved with doc_store.py
     def visualize_entities(self, text):
-        doc = self.nlp(text)
+        doc = text if isinstance(text, Doc) else self.nlp(text)
         options = {"ents": list(BG_COLOR.keys()), "colors": BG_COLOR}
         displacy.render(doc, style="ent", options=options)
 
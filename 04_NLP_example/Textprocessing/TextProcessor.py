@@ -1,8 +1,28 @@
 import os
+import gc
 import json
+import time
+import shutil
+import itertools
+import cProfile
+import traceback
+import logging
+import hashlib
+import multiprocessing
+from importlib import metadata
 from pathlib import Path
+from collections import namedtuple
 import spacy
 from Named_entity_extractor import NamedEntityExtractor
+from geocode_cache import SQLiteGeocodeCache
+from geocoder import NominatimGeocoder, NOMINATIM_URL
+from gazetteer_geocoder import GazetteerGeocoder
+from output_formats import WRITERS, JSONPageWriter
+from manifest import FileManifest, append_journal, read_journal
+from metrics import Metrics, write_stats, worker_utilization
+from page_cache import PageCache
+from corpus_index import build_index
+from doc_store import DOCBIN_SUFFIX, DOCBIN_VERSION, new_docbin, add_doc, save_docbin, merge_docbins, load_docs
 import aiohttp
 import asyncio
 # Global spaCy model
@@ -10,27 +30,477 @@ NLP_MODEL = spacy.load('en_core_web_sm', exclude=['parser'])
 english_tagger_pipeline = spacy.load('en_dual_none_contextual')
 NLP_MODEL.add_pipe('pymusas_rule_based_tagger', source=english_tagger_pipeline)
 
+# Bump this when the token output changes, so files processed by an older version are processed again
+PIPELINE_VERSION = 3
+
+# A job for the worker pool: a whole file (shard None), or the entries first up to last of a file,
+# leaving out done_pages. work is the estimate the jobs are ordered by.
+Job = namedtuple('Job', ['file_name', 'shard', 'first', 'last', 'work', 'done_pages'])
+# Shards are written to <output>/.shards/<book>/<shard> and moved into the output folder once the book is done
+SHARD_DIR = '.shards'
+# Every shard journals the pages it has written in its folder, so an interrupted run keeps them (see plan_jobs)
+SHARD_JOURNAL = 'pages.journal'
+# The work of a page is estimated as the length of its text plus PAGE_WORK, and a shard holds at least
+# MIN_SHARD_WORK of it (about a second of processing), so the shards don't get too small to be worth it
+PAGE_WORK = 200
+MIN_SHARD_WORK = 50000
+SHARDS_PER_WORKER = 4
+
+
+class InputFileError(ValueError):
+    '''An input file that can't be read, or isn't a JSON list of [page_number, text] entries.'''
+
 '''it needs the cleaned version from the OCR tags'''
 class TextProcessor:
-    def __init__(self, input_path, NLP_MODEL):
+    def __init__(self, input_path, NLP_MODEL, single_pass=True, geocode_cache=None, geocoder=None,
+                 snapshot_dir='resources/snapshots', batch_size=16, output_format='json', incremental=True,
+                 profile_dir=None, page_cache=None, save_docs=False):
         self.input_path = Path(input_path)
         self.output_path = Path(output_folder_path)
         
         self.nlp = NLP_MODEL
-        self.nee = NamedEntityExtractor(NLP_MODEL)
+        self.nee = NamedEntityExtractor(NLP_MODEL, geocode_cache, geocoder, snapshot_dir)
+        # When set, the named entities are taken from the same Doc as the token features
+        # instead of running the whole pipeline over the page a second time
+        self.single_pass = single_pass
+        # Number of pages run through the pipeline together, this is what bounds memory use rather than the file size
+        self.batch_size = batch_size
+        # One of output_formats.WRITERS: 'json' (the default), 'jsonl', 'columnar' or 'columnar-zlib'
+        self.writer_class = WRITERS[output_format]
+        # When set, a manifest is kept per input file so unchanged files are skipped and interrupted ones resumed
+        self.incremental = incremental
+        # When set, the annotated Docs of every book are saved next to its output as <book>.spacy (see doc_store.py)
+        self.save_docs = save_docs
+        self.docbin = None  # The DocBin of the file being processed
+        self.pipeline_version = self.get_pipeline_version(output_format)
+        self.page_version = self.hash_versions(self.annotation_versions())
+        # Timings and counters of the file being processed, shared with the named entity extractor
+        self.metrics = self.nee.metrics = Metrics()
+        # When set, every file is run under cProfile and its profile saved here as <file>.prof
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        # Optional PageCache, so pages whose text was seen before (with the same pipeline version) are not processed again
+        self.page_cache = page_cache
+
+    def annotation_versions(self):
+        """What decides a page's tokens and tags: the entity pattern resources and the versions behind them, the models and packages."""
+        def package_version(name):
+            try:
+                return metadata.version(name)
+            except metadata.PackageNotFoundError:
+                return None
 
+        return [PIPELINE_VERSION, self.nee.patterns_hash(),
+                [package_version(name) for name in ['pymusas', 'en_core_web_sm', 'en_dual_none_contextual']]]
+
+    @staticmethod
+    def hash_versions(versions):
+        return hashlib.sha256(json.dumps(versions).encode('utf8')).hexdigest()[:16]
+
+    def get_pipeline_version(self, output_format):
+        """
+            Hash of everything besides the input that decides what the output looks like: the annotation
+            versions, the geocoder the locations come from, the output format and whether the Docs are saved.
+        """
+        versions = self.annotation_versions() + [self.nee.geocoder.version(), output_format]
+        if self.save_docs:
+            versions.append(['docbin', DOCBIN_VERSION])
+        return self.hash_versions(versions)
+
+    def page_key(self, text):
+        """
+            Key of a page in the page cache: a hash of its text and the annotation versions. The geocoder is not
+            part of it, as cached pages are kept without their locations and geocoded again on every hit.
+        """
+        return hashlib.sha256(f'{self.page_version}\0{text}'.encode('utf8', 'surrogatepass')).hexdigest()
+
+    def page_cache_counters(self):
+        if self.page_cache is None:
+            return (0, 0, 0)
+        return (self.page_cache.memory_hits, self.page_cache.disk_hits, self.page_cache.misses)
 
     async def process_file(self, file_name):
+        """
+            Processes one file of the input directory (see stream_file) and returns its Metrics: the time
+            spent in every stage of the pipeline, and the page, token, geocoding and output counters.
+        """
+        _, metrics = await self.measured(file_name, Path(file_name).stem, self.stream_file(file_name))
+        return metrics
+
+    async def process_shard(self, job):
+        """
+            Processes a shard of a file, the pages job.first up to job.last, into the shard's own folder (see
+            stream_shard). Returns the [(page_id, output files)] written, or None if the file couldn't be read,
+            and the shard's Metrics.
+        """
+        return await self.measured(f'{job.file_name} shard {job.shard}', f'{Path(job.file_name).stem}.shard{job.shard}',
+                                   self.stream_shard(job))
+
+    async def measured(self, label, profile_name, stream):
+        """Runs stream, a coroutine processing (part of) a file, with new Metrics and returns its result and the Metrics."""
+        metrics = self.metrics = self.nee.metrics = Metrics()
+        geocoder, cache = self.nee.geocoder, self.nee.geocode_cache
+        before = (geocoder.lookups, geocoder.failures, geocoder.lookup_seconds, cache.hits, cache.misses,
+                  getattr(geocoder, 'gazetteer_hits', 0), *self.page_cache_counters())
+        profiler = cProfile.Profile() if self.profile_dir else None
+        if profiler:
+            profiler.enable()
+
+        try:
+            with metrics.time('total'):
+                result = await stream
+        finally:
+            if profiler:
+                profiler.disable()
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                profiler.dump_stats(self.profile_dir / f'{profile_name}.prof')
+
+        after = (geocoder.lookups, geocoder.failures, geocoder.lookup_seconds, cache.hits, cache.misses,
+                 getattr(geocoder, 'gazetteer_hits', 0), *self.page_cache_counters())
+        for name, old, new in zip(['geocode_lookups', 'geocode_failures', 'geocode_lookup_seconds',
+                                   'geocode_cache_hits', 'geocode_cache_misses', 'geocode_gazetteer_hits',
+                                   'page_cache_memory_hits',
+                                   'page_cache_disk_hits', 'page_cache_misses'], before, after):
+            metrics.count(name, new - old)
+        print(f'Timings for {label}: {metrics.summary()}')
+        return result, metrics
+
+    async def stream_file(self, file_name):
+        """
+            Streams a file through the pipeline: pages are read from the JSON file a few at a time,
+            processed in batches and each page's output is written as soon as the page is done,
+            so memory use depends on the batch size and not on the size of the book.
+        """
         file_path = self.input_path / file_name
-        print(f'Processing file {file_path}')
-        
-        data = self.load_json_data(file_path)
-        if data is not None:
-            corrected_data = await self.process_data(data)
-            self.save_processed_data(file_path, corrected_data)
-        else:
-            print(f"Failed to load data from {file_path}")
-            
+        try:
+            manifest = FileManifest(self.output_path, file_path, self.pipeline_version) if self.incremental else None
+            if manifest and manifest.up_to_date():
+                print(f'Skipping file {file_path}, its output is up to date')
+                self.metrics.count('files_skipped')
+                return
+            print(f'Processing file {file_path}')
+
+            with self.writer_class(self.output_path, file_path) as writer:
+                # A book's DocBin is written in one go, so its pages can't be resumed when the Docs are saved
+                done_pages = manifest.start(writer.resumable and not self.save_docs) if manifest else set()
+                if done_pages:
+                    print(f'Resuming {file_path}, {len(done_pages)} pages were already done')
+                self.docbin = new_docbin() if self.save_docs else None
+                pages = (page for page in self.iter_json_pages(file_path) if page[0] not in done_pages)
+                await self.write_pages(writer, self.process_pages(pages), manifest.page_written if manifest else None)
+            docbin_files = []
+            if self.docbin is not None:
+                docbin_files.append(self.output_path / f'{file_path.stem}{DOCBIN_SUFFIX}')
+                with self.metrics.time('write'):
+                    save_docbin(self.docbin, docbin_files[0])
+            self.count_output(writer.output_files + docbin_files)
+            if manifest:
+                manifest.finish(([] if writer.resumable else writer.output_files) + docbin_files)
+        except InputFileError as e:
+            print(f"Failed to load data from {file_path}: {e}")
+            return
+        finally:
+            self.docbin = None
+            await self.nee.geocoder.close()  # The geocoder's connections belong to this event loop
+
+        cache_stats = self.nee.geocode_cache.stats()
+        print(f"Geocode cache after {file_name}: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+              f"({cache_stats['hit_rate']:.0%} hit rate)")
+        if self.page_cache is not None:
+            page_stats = self.page_cache.stats()
+            print(f"Page cache after {file_name}: {page_stats['memory_hits']} hits in memory, {page_stats['disk_hits']} "
+                  f"on disk, {page_stats['misses']} misses ({page_stats['hit_rate']:.0%} hit rate)")
+
+    async def stream_shard(self, job):
+        """
+            Streams the entries job.first up to job.last of a file through the pipeline, leaving out the pages in
+            job.done_pages, and writes them (and, with save_docs, the shard's DocBin) into the shard's folder with
+            the processor's writer. The manifest and the output folder are left to assemble_file, once every shard
+            of the file is done; meanwhile a resumable writer's pages are journaled in the shard's folder, for
+            plan_jobs to take over should the run be stopped before then.
+        """
+        file_path = self.input_path / job.file_name
+        shard_path = self.output_path / SHARD_DIR / file_path.stem / str(job.shard)
+        pages_written = []
+
+        def page_written(page_id, files):
+            pages_written.append((page_id, files))
+            append_journal(shard_path / SHARD_JOURNAL, [(page_id, [str(Path(path).relative_to(shard_path))
+                                                                   for path in files])])
+
+        print(f'Processing entries {job.first} to {job.last} of {file_path}')
+        try:
+            shard_path.mkdir(parents=True, exist_ok=True)
+            with self.writer_class(shard_path, file_path) as writer:
+                self.docbin = new_docbin() if self.save_docs else None
+                pages = (page for page in itertools.islice(self.iter_json_pages(file_path), job.first, job.last)
+                         if page[0] not in job.done_pages)
+                await self.write_pages(writer, self.process_pages(pages), page_written)
+            if self.docbin is not None:
+                # Merged with the other shards' Docs by assemble_file
+                with self.metrics.time('write'):
+                    save_docbin(self.docbin, shard_path / f'{file_path.stem}{DOCBIN_SUFFIX}')
+        except InputFileError as e:
+            print(f"Failed to load data from {file_path}: {e}")
+            return None
+        finally:
+            self.docbin = None
+            await self.nee.geocoder.close()
+        return pages_written if writer.resumable else [(None, writer.output_files)]
+
+    async def write_pages(self, writer, pages, page_written=None):
+        """
+            Gives each page's tokens to the writer as soon as the page is done. For a resumable writer,
+            page_written(page_id, output files) is called after every page. The writer is finished at the end.
+
+            Parameters:
+            - pages (async iterator): The processed (page_number, tokens) pairs, from process_pages or
+              process_saved_docs.
+        """
+        current_page_id, page_data = None, []
+
+        def write_page():
+            written = len(writer.output_files)
+            with self.metrics.time('write'):
+                writer.write_page(page_data, current_page_id)
+            if page_written and writer.resumable:
+                page_written(current_page_id, writer.output_files[written:])
+
+        async for page_number, tokens in pages:
+            # Consecutive entries for the same page number go into one output file, as before
+            if page_number != current_page_id and page_data:
+                write_page()
+                page_data = []
+            current_page_id = page_number
+            page_data.extend(tokens)
+        if page_data:
+            write_page()
+        with self.metrics.time('write'):
+            writer.finish()
+
+    def count_output(self, output_files):
+        self.metrics.count('files_written', len(output_files))
+        self.metrics.count('bytes_written', sum(os.path.getsize(path) for path in output_files))
+
+    def plan_jobs(self, file_names, num_workers, shards_per_worker=SHARDS_PER_WORKER):
+        """
+            Splits a run over the input directory into jobs for the worker pool, largest first, so the run
+            doesn't end with one worker going through the biggest book while the others wait.
+
+            The work of a page is estimated from the length of its text. Files with more work than a shard
+            - the run's work divided by shards_per_worker shards per worker, and at least MIN_SHARD_WORK - are
+            split into shards of consecutive pages, cut between page numbers. Shard jobs have the file's
+            manifest started here, so they skip the pages a previous run already wrote, the pages its shards
+            wrote before it was stopped included (see adopt_shard_pages).
+
+            Returns:
+            - list of Job: Whole files (job.shard None) and shards, the ones with the most work first.
+            - dict: {file name: (shard count, FileManifest or None)} for the files that were split.
+        """
+        jobs, entries = [], {}
+        for file_name in file_names:
+            file_path = self.input_path / file_name
+            if num_workers > 1 and shards_per_worker:
+                try:
+                    entries[file_name] = [len(text) + PAGE_WORK if text.strip() else 0
+                                          for _, text in self.iter_json_pages(file_path)]
+                    continue
+                except InputFileError as e:
+                    # Not split; left to process_file, which reports it
+                    print(f'Not splitting {file_path}, it can\'t be read: {e}')
+            jobs.append(Job(file_name, None, 0, None, file_path.stat().st_size, frozenset()))
+
+        total_work = sum(sum(work) for work in entries.values())
+        shard_work = max(MIN_SHARD_WORK, total_work / (num_workers * (shards_per_worker or 1)))
+        sharded = {}
+        for file_name, works in entries.items():
+            file_path = self.input_path / file_name
+            manifest = FileManifest(self.output_path, file_path, self.pipeline_version) if self.incremental else None
+            up_to_date = manifest is not None and manifest.up_to_date()
+            if up_to_date or sum(works) <= shard_work * 1.5:
+                jobs.append(Job(file_name, None, 0, None, 0 if up_to_date else sum(works), frozenset()))
+                continue
+
+            resumable = self.writer_class.resumable and not self.save_docs
+            resumed = manifest is not None and resumable and manifest.matches_previous()
+            done_pages = frozenset(manifest.start(resumable)) if manifest else frozenset()
+            if resumed:
+                done_pages |= self.adopt_shard_pages(file_path, manifest)
+            shutil.rmtree(self.output_path / SHARD_DIR / file_path.stem, ignore_errors=True)
+            page_ids = [page_id for page_id, _ in self.iter_json_pages(file_path)]
+            shards, first, work = [], 0, 0
+            for i, (page_id, page_work) in enumerate(zip(page_ids, works)):
+                work += 0 if page_id in done_pages else page_work
+                last_entry = i + 1 == len(page_ids)
+                if last_entry or (work >= shard_work and page_ids[i + 1] != page_id):
+                    if last_entry and shards and work < shard_work / 2:
+                        # Too little left over for a shard of its own, it goes with the one before
+                        work += shards[-1].work
+                        first = shards.pop().first
+                    shards.append(Job(file_name, len(shards), first, i + 1, work, done_pages))
+                    first, work = i + 1, 0
+            jobs.extend(shards)
+            sharded[file_name] = (len(shards), manifest)
+        return sorted(jobs, key=lambda job: -job.work), sharded
+
+    def adopt_shard_pages(self, file_path, manifest):
+        """
+            Moves the pages that the shards of an interrupted run wrote for a file, as listed in their journals,
+            into the output folder and adds them to the file's manifest. Returns their page ids.
+        """
+        adopted = []
+        with self.writer_class(self.output_path, file_path) as writer:
+            for journal in sorted((self.output_path / SHARD_DIR / file_path.stem).glob(f'*/{SHARD_JOURNAL}')):
+                for page_id, names in read_journal(journal):
+                    files = [journal.parent / name for name in names]
+                    if all(path.exists() for path in files):
+                        written = len(writer.output_files)
+                        writer.adopt(files)
+                        adopted.append((page_id, writer.output_files[written:]))
+        if adopted:
+            manifest.pages_written(adopted)
+            print(f'Resuming {file_path}, kept {len(adopted)} pages its shards wrote before the run was stopped')
+        return frozenset(page_id for page_id, _ in adopted)
+
+    def assemble_file(self, file_name, shard_pages, manifest):
+        """
+            Moves (or, for the columnar formats, merges) the output of a file's shards into the output folder,
+            in page order, merges their DocBins when the Docs are saved, and completes the file's manifest.
+
+            Parameters:
+            - shard_pages (list): The [(page_id, output files)] of every shard, in shard order.
+            - manifest (FileManifest): The file's manifest, None when not running incrementally.
+        """
+        file_path = self.input_path / file_name
+        with self.metrics.time('assemble'):
+            with self.writer_class(self.output_path, file_path) as writer:
+                for pages in shard_pages:
+                    adopted = []
+                    for page_id, files in pages:
+                        written = len(writer.output_files)
+                        writer.adopt(files)
+                        adopted.append((page_id, writer.output_files[written:]))
+                    if manifest and writer.resumable:
+                        manifest.pages_written(adopted)
+            docbin_files = []
+            if self.save_docs:
+                docbin_files.append(self.output_path / f'{file_path.stem}{DOCBIN_SUFFIX}')
+                merge_docbins([self.output_path / SHARD_DIR / file_path.stem / str(shard) / docbin_files[0].name
+                               for shard in range(len(shard_pages))], docbin_files[0])
+            if manifest:
+                manifest.finish(([] if writer.resumable else writer.output_files) + docbin_files)
+            shutil.rmtree(self.output_path / SHARD_DIR / file_path.stem, ignore_errors=True)
+            try:
+                (self.output_path / SHARD_DIR).rmdir()  # Once no other file has shards in it
+            except OSError:
+                pass
+        self.count_output(writer.output_files + docbin_files)
+
+    def process_directory(self, num_workers=None, stats_path=None, shards_per_worker=SHARDS_PER_WORKER):
+        """
+            Processes every JSON file in the input directory in one run.
+
+            The models and entity patterns are loaded once, in this process, and a pool of worker
+            processes is forked from it so the workers share that copy of the pipeline (copy-on-write)
+            instead of each loading their own. The work is handed out from the pool's queue one job at a
+            time, largest first, with the big files split into shards of pages (see plan_jobs); the
+            output of a split file is put together in page order once all its shards are done.
+            The CPU time every worker spent on its jobs is printed against the length of the run at the
+            end, to show how well the cores were used.
+
+            Parameters:
+            - num_workers (int): Number of worker processes, defaults to the number of cores.
+            - stats_path (str): Where to save the metrics of every file and of the whole run (see metrics.py).
+            - shards_per_worker (int): How many shards per worker the run's work is cut into, 0 to never split files.
+
+            Returns:
+            - dict: The Metrics of every file, by file name.
+        """
+        global _worker_processor
+        _worker_processor = self
+
+        file_names = sorted(path.name for path in self.input_path.glob('*.json'))
+        num_workers = num_workers or os.cpu_count()
+        jobs, sharded = self.plan_jobs(file_names, num_workers, shards_per_worker)
+        print(f'Processing {len(file_names)} files with {num_workers} workers, '
+              f'{sum(count for count, _ in sharded.values())} shards of {len(sharded)} files')
+
+        # Move everything loaded so far out of the collector's reach, so the workers don't
+        # touch (and copy) the model's pages just by running a garbage collection
+        gc.freeze()
+        file_metrics, shard_results, busy = {}, {}, {}
+        started = time.time()
+        with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+            for job, result, metrics, worker, cpu_seconds, error in pool.imap_unordered(_process_job_in_worker, jobs):
+                busy[worker] = busy.get(worker, 0) + cpu_seconds
+                file_metrics.setdefault(job.file_name, Metrics()).add(metrics)
+                if error:
+                    print(f'Failed to process {job.file_name}' + (f' shard {job.shard}' if job.shard is not None else '')
+                          + f': {error}')
+                    file_metrics[job.file_name].count('jobs_failed')
+                if job.shard is None:
+                    if not error:
+                        print(f'Finished file {job.file_name}')
+                    continue
+                shards = shard_results.setdefault(job.file_name, {})
+                shards[job.shard] = result
+                shard_count, manifest = sharded[job.file_name]
+                if len(shards) < shard_count:
+                    continue
+                if any(pages is None for pages in shards.values()):
+                    print(f'Failed to process file {job.file_name}')
+                    continue
+                self.metrics = Metrics()
+                self.assemble_file(job.file_name, [shards[shard] for shard in range(shard_count)], manifest)
+                file_metrics[job.file_name].add(self.metrics)
+                print(f'Finished file {job.file_name}, put together from {shard_count} shards')
+
+        workers = worker_utilization(busy, num_workers, time.time() - started)
+        print(f'Worker CPU use over the {workers["wall_seconds"]:.1f}s run: {workers["utilization"]:.0%} of {num_workers} cores, '
+              + ', '.join(f'{worker["busy_seconds"]:.1f}s ({worker["utilization"]:.0%})' for worker in workers['workers']))
+        if stats_path:
+            write_stats(stats_path, file_metrics, workers)
+        return file_metrics
+
+    @staticmethod
+    def iter_json_pages(file_path, chunk_size=1 << 16):
+        """
+            Yields the [page_number, text] entries of a JSON file one at a time, reading the file in
+            chunks instead of loading it whole with json.load. Errors reading or decoding the file, and entries
+            that are not [page_number, text] pairs, are raised as InputFileError, so callers can tell them from
+            errors in the processing of the pages.
+        """
+        decoder = json.JSONDecoder()
+        try:
+            with open(file_path, 'r') as file:
+                buffer = file.read(chunk_size)
+                position = buffer.index('[') + 1  # Skip the bracket opening the list of pages
+                while True:
+                    # Skip to the start of the next entry, reading more of the file if needed
+                    while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                        position += 1
+                    if position == len(buffer):
+                        buffer, position = file.read(chunk_size), 0
+                        if not buffer:
+                            raise ValueError('unexpected end of file')
+                        continue
+                    if buffer[position] == ']':
+                        return
+
+                    try:
+                        page, position = decoder.raw_decode(buffer, position)
+                    except json.JSONDecodeError:
+                        # The entry runs past the end of the buffer
+                        more = file.read(chunk_size)
+                        if not more:
+                            raise
+                        buffer, position = buffer[position:] + more, 0
+                        continue
+                    if not (isinstance(page, list) and len(page) == 2 and isinstance(page[1], str)):
+                        raise ValueError(f'entry {page!r:.60} is not a [page_number, text] pair')
+                    # Only the reading is in the try: what the caller raises while it has the page doesn't reach here
+                    yield page
+        except (OSError, ValueError) as e:
+            raise InputFileError(e) from e
 
     @staticmethod
     def load_json_data(file_path):
@@ -50,7 +520,11 @@ class TextProcessor:
             - data (list of tuples): Each tuple contains a page number and its corresponding text.
                 - page_number (int): The number of the page. This is used for tracking and referencing the source of each tokenized word.
                 - text (str): The textual content of the page. This text is processed and tokenized into individual words or tokens.
-                - start_char and end_char to be used later in KWIC and collocations
+                - start_char and end_char are used for KWIC and collocations, see corpus_index.py
+
+            Each page is run through the NLP pipeline once; the named entities come from the same Doc
+            unless the processor was created with single_pass=False. This collects the whole of
+            process_pages in memory, process_file streams it instead.
 
             Returns:
             - list of dicts: Each dictionary contains information about a token, including its text, lemma,
@@ -59,44 +533,216 @@ class TextProcessor:
 
 
         processed_data = []
-        for page in data:
-            page_number, text = page
-            doc = self.nlp(text)
-            ne_data = await self.nee.process_text(text)  # Process text for named entities
-                        # Extract latitude and longitude if they exist
-           
-            for token in doc:
-                # Find the named entity in ne_data that corresponds to the token
-                ne_info = next((ne for ne in ne_data if ne[0] == token.text), None)
-                latitude = None
-                longitude = None
-                if ne_info and len(ne_info) > 2 and isinstance(ne_info[2], dict):
-                    latitude_str = ne_info[2].get('latitude')
-                    longitude_str = ne_info[2].get('longitude')
-
-                    if latitude_str is not None and longitude_str is not None:
-                        try:
-                            latitude = float(latitude_str)
-                            longitude = float(longitude_str)
-                        except ValueError:
-                            # Handle the case where latitude or longitude is not a valid number
-                            print(f"Invalid latitude or longitude value for {token.text}: latitude={latitude_str}, longitude={longitude_str}")
-
-                token_data = {
-                    'text': token.text,
-                    'lemma': token.lemma_,
-                    'POS': token.pos_,
-                    'USAS_tags': token._.pymusas_tags,
-                    'page_id': page_number,
-                    'start_char': token.idx,  # Character start position
-                    'end_char': token.idx + len(token),  # Character end position
-                    'NE': ne_info,  # Add named entity information
-                    'latitude': latitude,  # Add latitude
-                    'longitude': longitude  # Add longitude
-                }
-                processed_data.append(token_data)
+        async for page_number, tokens in self.process_pages(data):
+            processed_data.extend(tokens)
         return processed_data
 
+    async def process_pages(self, pages):
+        """
+            Asynchronous generator over the processed pages: yields (page_number, list of token dicts) for
+            every page of `pages`, which can be any iterable of (page_number, text) pairs, such as a generator.
+            Pages are run through the NLP pipeline in batches of self.batch_size.
+        """
+        batch = []
+        for page in pages:
+            batch.append(page)
+            if len(batch) == self.batch_size:
+                async for processed_page in self.process_batch(batch):
+                    yield processed_page
+                batch = []
+        if batch:
+            async for processed_page in self.process_batch(batch):
+                yield processed_page
+
+    async def process_batch(self, batch):
+        """
+            Processes a batch of (page_number, text) pairs, yielding each page's tokens in order. Empty and
+            whitespace-only pages are given no tokens without going through the pipeline. With a page cache,
+            pages found in it are taken from there, and only the first page of the batch with a given text is
+            run through the pipeline, the others are answered from the cache. Cached pages are kept without
+            their locations, their place names are geocoded again on every hit, so a change of geocoder or a
+            lookup that failed once doesn't stay in the cache. While a DocBin is being filled (save_docs) the
+            page cache is not used, as every page needs its Doc; empty pages get an empty Doc in it.
+        """
+        page_cache = self.page_cache if self.docbin is None else None
+        self.metrics.count('pages', len(batch))
+        keys, cached, texts = [], {}, {}  # texts: key -> text of the pages to run through the pipeline
+        fresh = {}  # key -> (tokens, places) as cached, of the pages processed in this batch
+        for i, (page_number, text) in enumerate(batch):
+            key = None
+            if not text.strip():
+                self.metrics.count('pages_skipped_empty')
+            elif page_cache is None:
+                key = i
+                texts[key] = text
+            else:
+                key = self.page_key(text)
+                if key not in texts:
+                    with self.metrics.time('page_cache'):
+                        page = page_cache.get(key, page_number)
+                    if page is None:
+                        texts[key] = text
+                    else:
+                        cached[i] = page
+            keys.append(key)
+        docs = dict(zip(texts, self.run_pipeline(list(texts.values()))))
+
+        for i, ((page_number, text), key) in enumerate(zip(batch, keys)):
+            if key is None:
+                if self.docbin is not None:
+                    add_doc(self.docbin, self.nlp.make_doc(''), page_number)
+                yield page_number, []
+                continue
+            doc = docs.pop(key, None)
+            if doc is None:
+                # Found in the cache, or the same text as an earlier page of this batch. That page's tokens are
+                # used rather than read back from the cache, which may have evicted them already
+                if i not in cached:
+                    tokens, places = fresh[key]
+                    cached[i] = [dict(token, page_id=page_number) for token in tokens], places
+                tokens, places = cached[i]
+                await self.locate_places(tokens, places)
+                self.metrics.count('tokens', len(tokens))
+                yield page_number, tokens
+                continue
+            if self.docbin is not None:
+                add_doc(self.docbin, doc, page_number)
+            tokens, places = await self.page_tokens(page_number, doc, None if self.single_pass else text)
+            if page_cache is not None:
+                fresh[key] = self.without_locations(tokens, places), places
+                with self.metrics.time('page_cache'):
+                    page_cache.put(key, *fresh[key])
+            yield page_number, tokens
+
+    async def page_tokens(self, page_number, doc, text=None):
+        """
+            Finds the named entities of a parsed page and returns its token dicts, and the (token index, place
+            name) of the tokens that were geocoded. The entities are taken from the Doc itself, or when the
+            text is given, from a second pass over it (single_pass off).
+        """
+        # Reuse the parsed page for named entities, or process the text for them again
+        iob_tags = self.nee.tag_doc(doc if text is None else self.nlp(text))
+        ne_data = await self.nee.geolocate(iob_tags)
+        self.metrics.count('tokens', len(doc))
+        with self.metrics.time('token_features'):
+            tokens = self.token_features(doc, ne_data, page_number)
+        return tokens, [(i, place_name) for i, (_, _, place_name) in enumerate(iob_tags) if place_name is not None]
+
+    @staticmethod
+    def without_locations(tokens, places):
+        """The tokens as they are cached, the geocoded ones copied without their location."""
+        tokens = list(tokens)
+        for i, _ in places:
+            text, tag, _ = tokens[i]['NE']
+            tokens[i] = dict(tokens[i], NE=(text, tag, None), latitude=None, longitude=None)
+        return tokens
+
+    async def locate_places(self, tokens, places):
+        """Geocodes the place names of a cached page and fills in the locations of its tokens."""
+        geolocations = await self.nee.geocode_places({place_name for _, place_name in places})
+        for i, place_name in places:
+            token, geolocation = tokens[i], geolocations[place_name]
+            token['NE'] = (token['NE'][0], token['NE'][1], geolocation)
+            token['latitude'], token['longitude'] = self.coordinates(token['text'], geolocation)
+
+    async def process_saved_docs(self, docbin_path):
+        """
+            Asynchronous generator like process_pages, over the Docs saved with save_docs: yields (page_number,
+            list of token dicts) for every saved page, without running the NLP pipeline again. Only named
+            entities and geocoding are done. The empty Docs of empty pages give no tokens, as in process_batch.
+        """
+        docs = load_docs(docbin_path, self.nlp.vocab)
+        while True:
+            with self.metrics.time('load_docs'):
+                page_number, doc = next(docs, (None, None))
+            if doc is None:
+                break
+            self.metrics.count('pages')
+            if not len(doc):
+                self.metrics.count('pages_skipped_empty')
+                yield page_number, []
+                continue
+            tokens, _ = await self.page_tokens(page_number, doc)
+            yield page_number, tokens
+
+    async def export_saved_docs(self, file_name, output_path=None):
+        """
+            Writes the output of a book again from its saved Docs, e.g. in another output format, without
+            parsing the text. Empty pages are in the DocBin as empty Docs, so the pages go to the writer
+            exactly as they did in the run that saved the Docs.
+
+            Parameters:
+            - file_name (str): The name of the input file, its Docs are read from <output>/<stem>.spacy.
+            - output_path (Path): Where the output goes, the processor's output folder when not given.
+        """
+        file_path = self.input_path / file_name
+        docbin_path = self.output_path / f'{file_path.stem}{DOCBIN_SUFFIX}'
+        try:
+            with self.writer_class(output_path or self.output_path, file_path) as writer:
+                await self.write_pages(writer, self.process_saved_docs(docbin_path))
+            self.count_output(writer.output_files)
+        finally:
+            await self.nee.geocoder.close()
+
+    def run_pipeline(self, texts):
+        """
+            Does what nlp.pipe does for a batch of texts, but one component at a time over the whole batch,
+            so the time spent in each component can be recorded.
+        """
+        if not texts:
+            return []
+        with self.metrics.time('spacy.tokenizer'):
+            docs = [self.nlp.make_doc(text) for text in texts]
+        for name, component in self.nlp.pipeline:
+            with self.metrics.time(f'spacy.{name}'):
+                if hasattr(component, 'pipe'):
+                    docs = list(component.pipe(docs, batch_size=len(docs)))
+                else:
+                    docs = [component(doc) for doc in docs]
+        return docs
+
+    def token_features(self, doc, ne_data, page_number):
+        tokens = []
+        for token in doc:
+            # ne_data has one entry per token of the page, in order, so the token's
+            # named entity is found by position rather than by matching its text
+            ne_info = ne_data[token.i]
+            latitude, longitude = self.coordinates(token.text, ne_info[2] if ne_info and len(ne_info) > 2 else None)
+
+            token_data = {
+                'text': token.text,
+                'lemma': token.lemma_,
+                'POS': token.pos_,
+                'USAS_tags': token._.pymusas_tags,
+                'page_id': page_number,
+                'start_char': token.idx,  # Character start position
+                'end_char': token.idx + len(token),  # Character end position
+                'NE': ne_info,  # Add named entity information
+                'latitude': latitude,  # Add latitude
+                'longitude': longitude  # Add longitude
+            }
+            tokens.append(token_data)
+        return tokens
+
+    @staticmethod
+    def coordinates(text, geolocation):
+        """The latitude and longitude of a token's geolocation as floats, (None, None) if it has none."""
+        # Extract latitude and longitude if they exist
+        latitude = None
+        longitude = None
+        if isinstance(geolocation, dict):
+            latitude_str = geolocation.get('latitude')
+            longitude_str = geolocation.get('longitude')
+
+            if latitude_str is not None and longitude_str is not None:
+                try:
+                    latitude = float(latitude_str)
+                    longitude = float(longitude_str)
+                except ValueError:
+                    # Handle the case where latitude or longitude is not a valid number
+                    print(f"Invalid latitude or longitude value for {text}: latitude={latitude_str}, longitude={longitude_str}")
+        return latitude, longitude
+
     def save_processed_data(self, original_file_path, data):
         current_page_id = None
         page_data = []
@@ -118,26 +764,120 @@ class TextProcessor:
             self.write_to_file(original_file_path, page_data, current_page_id)
 
     def write_to_file(self, original_file_path, page_data, page_id):
-        output_file = self.output_path / f"{original_file_path.stem}_page_{page_id}.json"
-        with open(output_file, 'w') as file:
-            json.dump(page_data, file, indent=4)
-        print(f'Saved file {output_file}')
+        with JSONPageWriter(self.output_path, original_file_path) as writer:
+            writer.write_page(page_data, page_id)
 
 
 
 
+# Set in the parent before the worker pool is forked, so every worker inherits the loaded pipeline
+_worker_processor = None
+
+# Returns the job's result and Metrics, with the worker's pid, the CPU time the job took and the error the job
+# failed with (None when it didn't). An error stays with its job, so the rest of the run carries on
+def _process_job_in_worker(job):
+    started = time.process_time()
+    result, metrics, error = None, Metrics(), None
+    try:
+        if job.shard is None:
+            metrics = asyncio.run(_worker_processor.process_file(job.file_name))
+        else:
+            result, metrics = asyncio.run(_worker_processor.process_shard(job))
+    except Exception as e:
+        traceback.print_exc()
+        error = f'{type(e).__name__}: {e}'
+    return job, result, metrics, os.getpid(), time.process_time() - started, error
+
+
 # Use environment variables for input and output folder paths
 input_folder_path = os.getenv('INPUT_FOLDER_PATH', '[PATH TO FOLDER]/Textprocessing/0118')
 output_folder_path = os.getenv('OUTPUT_FOLDER_PATH', '[PATH TO FOLDER]/Textprocessing/output')
 
-# Get the filename from environment variable
+# Optional SQLite file for the geocode cache, so lookups are kept between runs and shared by the workers
+geocode_cache_path = os.getenv('GEOCODE_CACHE_PATH')
+
+# Where the precompiled entity ruler patterns are kept, mount it to keep them between container runs
+ruler_snapshot_dir = os.getenv('RULER_SNAPSHOT_DIR', 'resources/snapshots')
+
+# Number of pages run through the pipeline together
+page_batch_size = int(os.getenv('PAGE_BATCH_SIZE', 16))
+
+# Output format, see output_formats.py
+output_format = os.getenv('OUTPUT_FORMAT', 'json')
+
+# Geocoding service, its concurrency and its rate limit in requests per second
+geocoder_url = os.getenv('GEOCODER_URL', NOMINATIM_URL)
+geocoder_concurrency = int(os.getenv('GEOCODER_CONCURRENCY', 2))
+geocoder_rate_limit = float(os.getenv('GEOCODER_RATE_LIMIT', 1.0))
+
+# Optional gazetteer file (a GeoNames dump or name<TAB>latitude<TAB>longitude lines) to resolve place names from,
+# only the names it doesn't have go to GEOCODER_URL; set GEOCODER_URL to an empty string to never send a request,
+# e.g. on nodes without network access. See gazetteer_geocoder.py
+gazetteer_path = os.getenv('GAZETTEER_PATH')
+
+# Get the filename from environment variable, if it is not set the whole input folder is processed
 file_name = os.getenv('FILE_NAME')
 
+# Set INCREMENTAL=0 to process every file again, even those whose output is up to date
+incremental = os.getenv('INCREMENTAL', '1') == '1'
+
+# Optional file for the timings and counters of every file and of the whole run, in the Prometheus
+# text format if it ends in .prom and as JSON otherwise
+stats_path = os.getenv('STATS_PATH')
+
+# Optional folder to save a cProfile profile of every file in, look at them with e.g. python -m pstats
+profile_dir = os.getenv('PROFILE_DIR')
+
+# Size of the in-memory page cache in MB (0 turns the page cache off), and an optional SQLite file
+# that keeps processed pages between runs and shares them between the workers, see page_cache.py
+page_cache_size_mb = int(os.getenv('PAGE_CACHE_SIZE_MB', 64))
+page_cache_path = os.getenv('PAGE_CACHE_PATH')
+
+# Optional folder for the KWIC and collocation index, built from the output folder once the whole
+# input folder has been processed, see corpus_index.py
+index_folder_path = os.getenv('INDEX_FOLDER_PATH')
+
+# Set SAVE_DOCS=1 to also save the annotated spaCy Docs of every book as <book>.spacy in the output folder,
+# to visualize or export them later without parsing the text again, see doc_store.py
+save_docs = os.getenv('SAVE_DOCS', '0') == '1'
+
+# DEBUG shows every entity token's label as it is converted to IOB
+log_level = os.getenv('LOG_LEVEL', 'INFO')
+
+# Number of worker processes used when processing the whole input folder
+num_workers = int(os.getenv('NUM_WORKERS', os.cpu_count()))
+
+# Files with more work than a shard are split into shards of pages, the run's work being cut into about this
+# many shards per worker (0 never splits a file), see TextProcessor.plan_jobs
+shards_per_worker = int(os.getenv('SHARDS_PER_WORKER', SHARDS_PER_WORKER))
+
+
+def create_processor():
+    geocode_cache = SQLiteGeocodeCache(geocode_cache_path) if geocode_cache_path else None
+    if gazetteer_path:
+        # Loaded once here, the forked workers share the index
+        geocoder = GazetteerGeocoder(gazetteer_path, geocoder_url or None, geocoder_concurrency, geocoder_rate_limit,
+                                     geocode_cache)
+    else:
+        geocoder = NominatimGeocoder(geocoder_url, geocoder_concurrency, geocoder_rate_limit, geocode_cache)
+    page_cache = PageCache(page_cache_size_mb << 20, page_cache_path) if page_cache_size_mb else None
+    return TextProcessor(input_folder_path, NLP_MODEL, geocoder=geocoder, snapshot_dir=ruler_snapshot_dir,
+                         batch_size=page_batch_size, output_format=output_format, incremental=incremental,
+                         profile_dir=profile_dir, page_cache=page_cache, save_docs=save_docs)
 
 async def main():
-    processor = TextProcessor(input_folder_path, NLP_MODEL)
-    await processor.process_file(file_name)
+    processor = create_processor()
+    metrics = await processor.process_file(file_name)
+    if stats_path:
+        write_stats(stats_path, {file_name: metrics})
 
 # Run the async main function
-asyncio.run(main())
+if __name__ == "__main__":
+    logging.basicConfig(level=log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if file_name:
+        asyncio.run(main())
+    else:
+        create_processor().process_directory(num_workers, stats_path, shards_per_worker)
+        if index_folder_path:
+            build_index(output_folder_path, index_folder_path)
 
@@ -0,0 +1,76 @@
+'''Times the KWIC and collocation index against answering the same queries by re-reading the processed output.
+
+Builds the index for an output folder of TextProcessor (any output format), then runs a KWIC and a collocation
+query for each term both ways. The re-reading version loads every page file of the folder, as was the only way
+before, and must find the same matches and collocate counts as the index. Run from the Textprocessing folder,
+on the output of a run over 0118:
+
+    python benchmarks/corpus_index.py output --terms river garden the
+'''
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from collections import Counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from corpus_index import CorpusIndex, build_index, find_books, read_page_file
+from output_formats import ColumnarReader
+
+
+def read_books(output_path):
+    books = {}
+    for book, source in find_books(output_path).items():
+        if isinstance(source, Path):
+            with ColumnarReader(source) as reader:
+                books[book] = [token for page_id in reader.page_ids() for token in reader.page_tokens(page_id)]
+        else:
+            books[book] = [token for _, path in source for token in read_page_file(path)]
+    return books
+
+
+# The queries as they had to be answered before: over every token of every page file
+def scan_queries(output_path, term, window, skip_pos=('PUNCT', 'SPACE')):
+    matches, collocates = 0, Counter()
+    for tokens in read_books(output_path).values():
+        for i, token in enumerate(tokens):
+            if token['text'].lower() != term:
+                continue
+            matches += 1
+            for j in range(max(0, i - window), min(len(tokens), i + window + 1)):
+                if j != i and tokens[j]['POS'] not in skip_pos:
+                    collocates[tokens[j]['text'].lower()] += 1
+    return matches, collocates
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as index_path:
+        tokens, build_seconds = timed(build_index, args.output, index_path)
+        index, open_seconds = timed(CorpusIndex, index_path)
+        print(f'build {build_seconds:.2f}s for {tokens} tokens, open {open_seconds * 1000:.1f} ms')
+        print(f'{"term":<12}{"matches":>9}{"scan s":>9}{"kwic ms":>9}{"colloc ms":>11}{"speed-up":>10}')
+        for term in args.terms:
+            (matches, collocates), scan_seconds = timed(scan_queries, Path(args.output), term, args.window)
+            lines, kwic_seconds = timed(index.kwic, term, 'token', args.window, None)
+            counts, collocate_seconds = timed(index.collocates, term, 'token', None, args.window, None)
+            if len(lines) != matches or dict(counts) != dict(collocates):
+                print(f'FAIL: {term}: the index found other matches or collocates than the scan')
+                sys.exit(1)
+            print(f'{term:<12}{matches:>9}{scan_seconds:>9.2f}{kwic_seconds * 1000:>9.1f}{collocate_seconds * 1000:>11.1f}'
+                  f'{scan_seconds / (kwic_seconds + collocate_seconds):>9.0f}x')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', help="TextProcessor's output folder")
+    parser.add_argument('--terms', nargs='+', default=['river', 'garden', 'india', 'the'])
+    parser.add_argument('--window', type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,100 @@
+'''Times loading a book's saved Docs against parsing its pages again, and checks the saved Docs are the same.
+
+A copy of the book, with a blank page added at the end, is processed once with save_docs into a temporary output
+folder. Its pages are then parsed again with NLP_MODEL, and the saved Docs loaded with doc_store.load_docs: there
+must be one for every page, blank ones included, and the others must have the same tokens, lemmas, POS tags,
+pymusas_tags, entities and sentences, and visualize_entities must draw the same entities for them. Finally the
+book is exported from the saved Docs with export_saved_docs, which must go through the same pages and write the
+same output files as the run that parsed it. Geocoding is answered by the offline stub. Run from the
+Textprocessing folder:
+
+    python benchmarks/docbin.py 0118/011836203_01_text.json
+'''
+import sys
+import json
+import time
+import asyncio
+import filecmp
+import warnings
+import tempfile
+from pathlib import Path
+from spacy import displacy
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import TextProcessor as text_processor
+from TextProcessor import TextProcessor, NLP_MODEL
+from Named_entity_extractor import BG_COLOR
+from doc_store import DOCBIN_SUFFIX, load_docs
+from stub_nominatim import OfflineGeocoder
+
+
+def doc_annotations(doc):
+    return ([(token.text, token.lemma_, token.pos_, token._.pymusas_tags, token.is_sent_start) for token in doc],
+            [(ent.start, ent.end, ent.label_) for ent in doc.ents])
+
+
+def entity_html(doc):
+    warnings.filterwarnings('ignore', message=r'\[W006\]')  # Pages without entities
+    return displacy.render(doc, style='ent', options={'ents': list(BG_COLOR), 'colors': BG_COLOR}, jupyter=False)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+async def exported_pages(processor, docbin_path):
+    return [page_id async for page_id, _ in processor.process_saved_docs(docbin_path)]
+
+
+def main(book_path):
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as saved_dir, \
+            tempfile.TemporaryDirectory() as export_dir:
+        book = [list(page) for page in TextProcessor.iter_json_pages(book_path)]
+        book.append([max(page_id for page_id, _ in book) + 1, ' \n'])
+        file_path = Path(input_dir) / book_path.name
+        file_path.write_text(json.dumps(book))
+
+        text_processor.output_folder_path = saved_dir
+        processor = TextProcessor(file_path.parent, NLP_MODEL, geocoder=OfflineGeocoder(), incremental=False,
+                                  page_cache=None, save_docs=True)
+        asyncio.run(processor.process_file(file_path.name))
+        docbin_path = Path(saved_dir) / f'{file_path.stem}{DOCBIN_SUFFIX}'
+
+        pages = [(page_id, text) for page_id, text in book if text.strip()]
+        parsed, parse_seconds = timed(lambda: list(NLP_MODEL.pipe(text for _, text in pages)))
+        saved, load_seconds = timed(lambda: list(load_docs(docbin_path, NLP_MODEL.vocab)))
+        print(f'{len(book)} pages, {len(book) - len(pages)} of them blank, DocBin {docbin_path.stat().st_size / 1e6:.1f} MB')
+        print(f'{"parse again":<16}{parse_seconds:>8.2f}s')
+        print(f'{"load DocBin":<16}{load_seconds:>8.2f}s   {parse_seconds / load_seconds:.0f}x')
+
+        if [page_id for page_id, _ in saved] != [page_id for page_id, _ in book]:
+            print('FAIL: the saved Docs are not the pages of the book, in order')
+            sys.exit(1)
+        if any(len(doc) for (_, doc), (_, text) in zip(saved, book) if not text.strip()):
+            print('FAIL: a blank page has a saved Doc with tokens')
+            sys.exit(1)
+        saved = [(page_id, doc) for (page_id, doc), (_, text) in zip(saved, book) if text.strip()]
+        for (page_id, doc), parsed_doc in zip(saved, parsed):
+            if doc_annotations(doc) != doc_annotations(parsed_doc) or entity_html(doc) != entity_html(parsed_doc):
+                print(f'FAIL: page {page_id}: the saved Doc differs from the page parsed again')
+                sys.exit(1)
+        print('Saved Docs match the parsed pages')
+
+        if asyncio.run(exported_pages(processor, docbin_path)) != [page_id for page_id, _ in book]:
+            print('FAIL: the export doesn\'t go through the pages of the book, blank ones included')
+            sys.exit(1)
+
+        _, export_seconds = timed(asyncio.run, processor.export_saved_docs(file_path.name, Path(export_dir)))
+        files = sorted(path.name for path in Path(saved_dir).iterdir() if path.is_file() and path != docbin_path)
+        _, mismatch, errors = filecmp.cmpfiles(saved_dir, export_dir, files, shallow=False)
+        if mismatch or errors:
+            print(f'FAIL: {len(mismatch) + len(errors)} of {len(files)} output files differ when exported from the Docs')
+            sys.exit(1)
+        print(f'{"export":<16}{export_seconds:>8.2f}s   {len(files)} output files, identical to the parsed run')
+
+
+if __name__ == "__main__":
+    main(Path(sys.argv[1]))
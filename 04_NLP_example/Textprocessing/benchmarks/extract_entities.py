@@ -0,0 +1,64 @@
+'''Compares the trie-based extract_entities with the old one-regex-per-entry version, using the full place-name
+and plant lists. The old version is slow enough that only the few longest pages of the file are used by default.
+Run from the Textprocessing folder:
+
+    python benchmarks/extract_entities.py 0118/011836203_01_text.json --pages 5
+'''
+import re
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gazetteer_matcher import GazetteerMatcher
+
+
+# extract_entities as it was: one regex per entry. The entries are escaped here, some plant names
+# are not valid regexes and would otherwise stop the benchmark
+def regex_extract_entities(text, ent_list, tag='PLNAME'):
+    extracted_entities = {}
+    for ent in ent_list:
+        for match in re.finditer(f' {re.escape(ent)}[\\.,\\s\\n;:]', text):
+            extracted_entities[match.start()+1] = text[match.start()+1:match.end()-1], tag
+    return {i: extracted_entities[i] for i in sorted(extracted_entities.keys())}
+
+
+def gazetteer_lists():
+    place_names = [name.strip().title().replace("'S", "'s") for name in open('resources/LD_placenames.txt').readlines()]
+    place_names += [name.upper() for name in place_names]
+    plant_names = [l.strip() for l in open('resources/Plant_list.txt').readlines()]
+    return [name for name in set(place_names + plant_names) if name]
+
+
+def main(args):
+    entries = gazetteer_lists()
+    with open(args.file) as file:
+        texts = sorted((text for _, text in json.load(file)), key=len, reverse=True)[:args.pages]
+    characters = sum(len(text) for text in texts)
+
+    start = time.perf_counter()
+    matcher = GazetteerMatcher(entries)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    found = [matcher.find(text) for text in texts]
+    trie_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    regex_found = [regex_extract_entities(text, entries) for text in texts]
+    regex_time = time.perf_counter() - start
+
+    print(f'{len(entries)} entries, {len(texts)} pages, {characters} characters')
+    print(f'regex: {regex_time:.2f}s, {sum(map(len, regex_found))} matches')
+    print(f'trie:  {trie_time:.3f}s, {sum(map(len, found))} matches (plus {build_time:.2f}s to build, once) '
+          f'({regex_time / trie_time:.0f}x)')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('--pages', type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,113 @@
+'''Compares geocoding a book's place names from the local gazetteer with sending them all to the geocoding service.
+
+The pages are parsed up front and their place names collected per page, as convert_to_iob_format does; that
+time is not counted. Each page's names are then resolved in one geocode_many call, by:
+
+- http:                NominatimGeocoder against the local stub server, a request per name not yet cached
+- gazetteer + http:    GazetteerGeocoder, only the names the gazetteer doesn't have are sent to the stub server
+- gazetteer only:      GazetteerGeocoder without a service, as on an air-gapped node
+
+Unless --gazetteer is given, the gazetteer is made from resources/LD_placenames.txt with the stub's made-up
+locations, so every name found in it must have the location the stub server gives. Run from the
+Textprocessing folder:
+
+    python benchmarks/gazetteer.py 0118/000204469_01_text.json --latency 0.05 --concurrency 8
+'''
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from TextProcessor import TextProcessor, NLP_MODEL
+from geocoder import NominatimGeocoder
+from gazetteer_geocoder import Gazetteer, GazetteerGeocoder, normalize
+from stub_nominatim import OfflineGeocoder, fake_location, run_stub_server
+
+GEO_LABELS = ["PLNAME", "GEONOUN", "GPE"]
+
+
+def write_stub_gazetteer(path):
+    with open('resources/LD_placenames.txt', encoding='utf8') as names, open(path, 'w', encoding='utf8') as file:
+        for name in names:
+            location = fake_location(name.strip())
+            if location:
+                file.write(f"{name.strip()}\t{location['latitude']}\t{location['longitude']}\n")
+
+
+async def resolve(geocoder, pages):
+    start = time.perf_counter()
+    results = {}
+    for place_names in pages:
+        results.update(await geocoder.geocode_many(place_names))
+    await geocoder.close()
+    return results, time.perf_counter() - start
+
+
+async def main(args):
+    processor = TextProcessor('.', NLP_MODEL, geocoder=OfflineGeocoder())
+    nee = processor.nee
+    pages = []
+    for doc in NLP_MODEL.pipe(text for _, text in processor.load_json_data(args.file)):
+        pages.append({entity["text"] for entity in nee.index_entities(nee.merge_entities(doc), doc)
+                      if entity and entity["label"].split('-')[-1] in GEO_LABELS})
+    names = set().union(*pages)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        gazetteer_path = args.gazetteer or Path(temp_dir) / 'gazetteer.tsv'
+        if not args.gazetteer:
+            write_stub_gazetteer(gazetteer_path)
+        start = time.perf_counter()
+        gazetteer = Gazetteer(gazetteer_path)
+        load_seconds = time.perf_counter() - start
+
+    runner, base_url = await run_stub_server(args.port, args.latency)
+    try:
+        runs = [('http', NominatimGeocoder(base_url, args.concurrency, args.rate_limit)),
+                ('gazetteer + http', GazetteerGeocoder(gazetteer, base_url, args.concurrency, args.rate_limit)),
+                ('gazetteer only', GazetteerGeocoder(gazetteer, None))]
+        results = {}
+        print(f'{Path(args.file).name}: {len(pages)} pages, {len(names)} place names, stub latency '
+              f'{args.latency * 1000:.0f} ms; gazetteer of {len(gazetteer)} names loaded in {load_seconds:.2f}s')
+        for name, geocoder in runs:
+            results[name], seconds = await resolve(geocoder, pages)
+            print(f'{name:<20}{seconds:>8.3f}s  {len(names) / seconds:>10.0f} names/s  {geocoder.lookups:>5} requests, '
+                  f'{getattr(geocoder, "gazetteer_hits", 0)} from the gazetteer')
+    finally:
+        await runner.cleanup()
+
+    if not args.gazetteer:
+        # Names in the gazetteer as they are must have the stub's location, the rest must be the same as over http
+        exact = {name for name in names if gazetteer.find(normalize(name)) is not None}
+        for name in names:
+            expected = {key: float(value) if value else None for key, value in results['http'][name].items()}
+            got = {key: float(value) if value else None for key, value in results['gazetteer + http'][name].items()}
+            if (name in exact or gazetteer.lookup(name) is None) and got != expected:
+                print(f'FAIL: {name}: {got} from the gazetteer, {expected} from the stub server')
+                sys.exit(1)
+        print(f'{len(exact)} names found in the gazetteer as they are, '
+              f'{len(results["gazetteer + http"]) - len(exact) - sum(gazetteer.lookup(name) is None for name in names)} '
+              f'through a fallback, all other locations the same as over http')
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        gazetteer.fallbacks.clear()
+        for place_names in pages:
+            gazetteer.lookup_many(place_names)
+    seconds = time.perf_counter() - start
+    print(f'gazetteer lookups: {args.repeat * sum(map(len, pages)) / seconds:.0f} names/s')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('--gazetteer', help='a gazetteer file to use instead of the stub one')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stub server waits before answering')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate-limit', type=float, default=1000.0, help='requests per second')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--repeat', type=int, default=20, help='times the lookups are repeated for their throughput')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,87 @@
+'''Compares the old token-by-token geocoding with the concurrent, deduplicated geocoder against a local stub server.
+
+The old way awaited one request per token of every place entity, in sequence, with a new HTTP session each time
+(only successful lookups were cached). The pages are parsed up front and that time is not counted.
+Run from the Textprocessing folder:
+
+    python benchmarks/geocoding.py 0118/000204469_01_text.json --latency 0.05 --concurrency 8
+'''
+import sys
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+import aiohttp
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from TextProcessor import TextProcessor, NLP_MODEL
+from geocoder import NominatimGeocoder
+from stub_nominatim import run_stub_server
+
+GEO_LABELS = ["PLNAME", "GEONOUN", "GPE"]
+
+
+async def sequential_geocoding(base_url, nee, docs):
+    cache = {}
+
+    async def geocode(place_name):
+        if place_name in cache:
+            return cache[place_name]
+        async with aiohttp.ClientSession() as session:
+            async with session.get(base_url, params={'q': place_name, 'format': 'json'}) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    if data:
+                        cache[place_name] = {'latitude': data[0].get('lat'), 'longitude': data[0].get('lon')}
+                        return cache[place_name]
+        return {'latitude': None, 'longitude': None}
+
+    requests = 0
+    for doc in docs:
+        for entity in nee.index_entities(nee.merge_entities(doc), doc):
+            if entity and entity["label"].split('-')[-1] in GEO_LABELS:
+                requests += entity["text"] not in cache
+                await geocode(entity["text"])
+    return requests
+
+
+async def concurrent_geocoding(geocoder, nee, docs):
+    for doc in docs:
+        await nee.convert_to_iob_format(nee.merge_entities(doc), doc)
+    await geocoder.close()
+    return geocoder.cache.misses
+
+
+async def main(args):
+    runner, base_url = await run_stub_server(args.port, args.latency)
+    try:
+        geocoder = NominatimGeocoder(base_url, max_concurrency=args.concurrency, rate_limit=args.rate_limit)
+        processor = TextProcessor('.', NLP_MODEL, geocoder=geocoder)
+        data = processor.load_json_data(args.file)
+        docs = list(NLP_MODEL.pipe(text for _, text in data))
+
+        start = time.perf_counter()
+        old_requests = await sequential_geocoding(base_url, processor.nee, docs)
+        old_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        new_requests = await concurrent_geocoding(geocoder, processor.nee, docs)
+        new_time = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+
+    print(f'{Path(args.file).name}: {len(docs)} pages, stub latency {args.latency * 1000:.0f} ms')
+    print(f'sequential: {old_requests} requests in {old_time:.2f}s')
+    print(f'concurrent: {new_requests} requests in {new_time:.2f}s ({old_time / new_time:.1f}x)')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stub server waits before answering')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate-limit', type=float, default=1000.0, help='requests per second')
+    parser.add_argument('--port', type=int, default=8765)
+    asyncio.run(main(parser.parse_args()))
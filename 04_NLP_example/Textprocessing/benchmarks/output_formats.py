@@ -0,0 +1,79 @@
+'''Compares the output formats of output_formats.py: size on disk, time to write, and time to read everything back.
+For the columnar formats it also times a typical column scan (counting tokens per POS tag) on the memory map.
+Geocoding is answered offline. Run from the Textprocessing folder:
+
+    python benchmarks/output_formats.py 0118/011844530_01_text.json
+'''
+import io
+import sys
+import json
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+from collections import Counter
+from contextlib import redirect_stdout
+
+import numpy
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from TextProcessor import TextProcessor, NLP_MODEL
+from output_formats import WRITERS, ColumnarReader
+from stub_nominatim import OfflineGeocoder
+
+
+def read_back(output_format, output_path):
+    if output_format == 'json':
+        return sum(len(json.load(open(path))) for path in output_path.glob('*.json'))
+    if output_format == 'jsonl':
+        return sum(len([json.loads(line) for line in open(path)]) for path in output_path.glob('*.jsonl'))
+    with ColumnarReader(next(output_path.glob('*.tokcol'))) as reader:
+        return sum(len(reader.page_tokens(page_id)) for page_id in reader.page_ids())
+
+
+def count_pos(output_format, output_path):
+    if output_format.startswith('columnar'):
+        with ColumnarReader(next(output_path.glob('*.tokcol'))) as reader:
+            counts = numpy.bincount(reader.column('POS'))
+            return dict(zip(reader.dictionary('POS'), counts.tolist()))
+    counts = Counter()
+    for path in output_path.glob('*.json*'):
+        tokens = json.load(open(path)) if path.suffix == '.json' else [json.loads(line) for line in open(path)]
+        counts.update(token['POS'] for token in tokens)
+    return dict(counts)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+async def main(file_path):
+    file_path = Path(file_path)
+    processor = TextProcessor(file_path.parent, NLP_MODEL, geocoder=OfflineGeocoder())
+    pages = [page async for page in processor.process_pages(processor.iter_json_pages(file_path))]
+    pages = [(page_number, tokens) for page_number, tokens in pages if tokens]
+    print(f'{file_path.name}: {len(pages)} pages, {sum(len(tokens) for _, tokens in pages)} tokens')
+    print(f'{"format":<14}{"size":>12}{"write":>10}{"read":>10}{"POS count":>12}')
+
+    for output_format, writer_class in WRITERS.items():
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_path = Path(output_dir)
+
+            def write():
+                # The writers print every file they save, which is not what is being measured
+                with redirect_stdout(io.StringIO()), writer_class(output_path, file_path) as writer:
+                    for page_number, tokens in pages:
+                        writer.write_page(tokens, page_number)
+
+            _, write_time = timed(write)
+            size = sum(path.stat().st_size for path in output_path.iterdir())
+            _, read_time = timed(read_back, output_format, output_path)
+            _, count_time = timed(count_pos, output_format, output_path)
+        print(f'{output_format:<14}{size:>12,}{write_time:>9.2f}s{read_time:>9.2f}s{count_time:>11.3f}s')
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1]))
@@ -0,0 +1,59 @@
+'''Checks that pages answered by the page cache are identical to freshly processed ones, and times the runs.
+
+The books are processed four times with TextProcessor.process_data: without a page cache, with an empty cache
+that has a disk tier, again with the memory tier now filled, and with a new cache that only has the disk tier
+to go on, as the next run would. Every run must return the same tokens as the first. Geocoding is answered by
+the offline stub, so the runs only differ in the cache. Run from the Textprocessing folder:
+
+    python benchmarks/page_cache.py 0118/*.json
+'''
+import sys
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from TextProcessor import TextProcessor, NLP_MODEL
+from page_cache import PageCache
+from stub_nominatim import OfflineGeocoder
+
+
+def run(processor, file_paths):
+    start = time.perf_counter()
+    results = [asyncio.run(processor.process_data(processor.load_json_data(file_path))) for file_path in file_paths]
+    return results, time.perf_counter() - start
+
+
+def main(file_paths):
+    processor = TextProcessor('.', NLP_MODEL, geocoder=OfflineGeocoder())
+    pages = sum(len(processor.load_json_data(file_path)) for file_path in file_paths)
+    print(f'{len(file_paths)} files, {pages} pages')
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_path = Path(cache_dir) / 'pages.sqlite'
+        fresh, fresh_time = run(processor, file_paths)
+        empty = processor.metrics.counters['pages_skipped_empty']
+        print(f'{"no page cache":<24}{fresh_time:>8.2f}s   {empty} empty pages skipped')
+
+        runs = [('empty cache', PageCache(path=cache_path)), ('memory tier', None),
+                ('disk tier only', PageCache(path=cache_path))]
+        for name, page_cache in runs:
+            processor.page_cache = page_cache or processor.page_cache
+            before = processor.page_cache.stats()
+            results, seconds = run(processor, file_paths)
+            stats = processor.page_cache.stats()
+            hits = {tier: stats[tier] - before[tier] for tier in ['memory_hits', 'disk_hits', 'misses']}
+            if results != fresh:
+                print(f'FAIL: {name}: the output differs from the run without a page cache')
+                sys.exit(1)
+            lookups = sum(hits.values())
+            print(f'{name:<24}{seconds:>8.2f}s   {hits["memory_hits"]} memory hits, {hits["disk_hits"]} disk hits, '
+                  f'{hits["misses"]} misses ({(lookups - hits["misses"]) / lookups:.0%} hit rate), '
+                  f'{fresh_time / seconds:.1f}x, identical output')
+        print(f'Disk tier: {cache_path.stat().st_size / 1e6:.1f} MB')
+
+
+if __name__ == "__main__":
+    main([Path(path) for path in sys.argv[1:]])
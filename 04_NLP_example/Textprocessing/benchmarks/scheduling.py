@@ -0,0 +1,90 @@
+'''Compares the ways of handing the 0118 books to a pool of workers, by how long the run takes against the ideal
+of all the work divided over the cores.
+
+- find order:     whole files in directory order, as dispatch.sh's xargs -P used to
+- largest first:  whole files, the biggest first
+- shards:         TextProcessor.plan_jobs, the big files split into shards of pages, the largest jobs first
+
+The runs are simulated: every job goes to the first worker that is free, as from the pool's queue, and takes
+as long as its share of the work, estimated from the page lengths the way plan_jobs does. With --run, the
+directory is also processed for real with that many workers, with and without shards, and the outputs are
+compared, for each of the --formats (json and columnar-zlib by default). Run from the Textprocessing folder:
+
+    python benchmarks/scheduling.py 0118 --workers 2 4 8 16
+    python benchmarks/scheduling.py 0118 --run 2
+'''
+import os
+import sys
+import time
+import heapq
+import filecmp
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import TextProcessor as text_processor
+from TextProcessor import TextProcessor, NLP_MODEL, PAGE_WORK
+from stub_nominatim import OfflineGeocoder
+
+
+def makespan(works, num_workers):
+    '''How long the jobs take when each is given, in order, to the first worker that is free.'''
+    free_at = [0.0] * num_workers
+    for work in works:
+        heapq.heappush(free_at, heapq.heappop(free_at) + work)
+    return max(free_at)
+
+
+def file_work(processor, file_name):
+    return sum(len(text) + PAGE_WORK if text.strip() else 0
+               for _, text in processor.iter_json_pages(processor.input_path / file_name))
+
+
+def simulate(processor, num_workers_list):
+    file_names = os.listdir(processor.input_path)  # The order find lists them in
+    works = {file_name: file_work(processor, file_name) for file_name in file_names if file_name.endswith('.json')}
+    total = sum(works.values())
+    print(f'{len(works)} files, largest {max(works.values()) / total:.0%} of the work')
+    print(f'{"workers":<10}{"find order":>14}{"largest first":>16}{"shards":>14}   (utilization: ideal / makespan)')
+    for num_workers in num_workers_list:
+        jobs, sharded = processor.plan_jobs(sorted(works), num_workers)
+        ideal = total / num_workers
+        schedules = [list(works.values()), sorted(works.values(), reverse=True), [job.work for job in jobs]]
+        print(f'{num_workers:<10}' + ''.join(f'{ideal / makespan(schedule, num_workers):>{width}.0%}'
+                                             for schedule, width in zip(schedules, [14, 16, 14]))
+              + f'   {len(jobs)} jobs')
+
+
+def run(input_path, num_workers, output_formats):
+    for output_format in output_formats:
+        outputs = {}
+        for name, shards_per_worker in [('whole files', 0), ('shards', 4)]:
+            output_path = Path(tempfile.mkdtemp())
+            text_processor.output_folder_path = output_path
+            processor = TextProcessor(input_path, NLP_MODEL, geocoder=OfflineGeocoder(), incremental=False,
+                                      output_format=output_format)
+            start = time.perf_counter()
+            processor.process_directory(num_workers, shards_per_worker=shards_per_worker)
+            outputs[name] = output_path
+            print(f'RESULT {output_format}, {name}: {time.perf_counter() - start:.1f}s')
+            NLP_MODEL.remove_pipe('sentencizer')  # Added again by the next processor's NamedEntityExtractor
+            NLP_MODEL.remove_pipe('entity_ruler')
+
+        files = sorted(path.name for path in outputs['whole files'].iterdir() if path.is_file())
+        _, mismatch, errors = filecmp.cmpfiles(outputs['whole files'], outputs['shards'], files, shallow=False)
+        print(f'RESULT {output_format}: {len(files)} output files, {len(mismatch) + len(errors)} differ between the two runs')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='folder with the JSON books')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8, 16])
+    parser.add_argument('--run', type=int, metavar='WORKERS', help='also process the folder with this many workers')
+    parser.add_argument('--formats', nargs='+', default=['json', 'columnar-zlib'], help='output formats for --run')
+    args = parser.parse_args()
+    if args.run:
+        run(args.input, args.run, args.formats)
+    else:
+        simulate(TextProcessor(args.input, NLP_MODEL, geocoder=OfflineGeocoder(), incremental=False), args.workers)
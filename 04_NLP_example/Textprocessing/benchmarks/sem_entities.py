@@ -0,0 +1,86 @@
+'''Compares the single-pass extract_sem_entities with the version that walked the doc once per tag type and merged
+adjacent tokens with combine_multi_tokens, on the longest pages of the given books.
+
+The pages are parsed once up front and that time is not counted. Both versions are run with USAS tag families
+given as single letters and as (prefix, label) tuples, and must return the same OrderedDict for every page.
+Run from the Textprocessing folder:
+
+    python benchmarks/sem_entities.py 0118/011836203_01_text.json 0118/011834423_01_text.json --pages 20
+'''
+import sys
+import time
+import argparse
+from pathlib import Path
+from collections import OrderedDict
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from TextProcessor import TextProcessor, NLP_MODEL
+
+TAG_TYPES = {
+    'letters': list('ZMWLTNAE'),
+    'tuples': [('Z1', 'PERSON'), ('Z2', 'PLACE'), ('M7', 'AREA'), ('W3', 'GEOFEATURE'), ('L3', 'PLANT'),
+               ('T1', 'TIME'), ('N3', 'MEASURE')],
+}
+
+
+# extract_sem_entities as it was: one walk over the doc per tag type, then the matching tokens merged pairwise
+def combine(x, y):
+    return (x[0], x[1], x[2] + ' ' + y[2], x[3])
+
+
+def combine_multi_tokens(a_list):
+    new_list = [a_list.pop()]
+    while a_list:
+        last = a_list.pop()
+        if new_list[-1][0] - last[0] == 1:
+            new_list.append(combine(last, new_list.pop()))
+        else:
+            new_list.append(last)
+    return sorted(new_list)
+
+
+def old_extract_sem_entities(processed_text, tag_types):
+    entities = {}
+    for tag_type in tag_types:
+        tag_indices = [(i, token.idx, token.text, tag_type) for i, token in enumerate(processed_text)
+                       if token._.pymusas_tags[0].startswith(tag_type[0])]
+        if tag_indices:
+            for i, idx, token, tag in combine_multi_tokens(tag_indices):
+                entities[idx] = token, tag
+    return OrderedDict(sorted(entities.items()))
+
+
+def timed(function, docs, tag_types, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [function(doc, tag_types) for doc in docs]
+    return results, (time.perf_counter() - start) / repeat
+
+
+def main(args):
+    processor = TextProcessor('.', NLP_MODEL)
+    nee = processor.nee
+    texts = [text for file_path in args.files for _, text in TextProcessor.iter_json_pages(Path(file_path))]
+    texts = sorted(texts, key=len, reverse=True)[:args.pages]
+    docs = list(NLP_MODEL.pipe(texts))
+    tokens = sum(len(doc) for doc in docs)
+    print(f'{len(docs)} pages, {tokens} tokens ({tokens // len(docs)} per page)')
+
+    for name, tag_types in TAG_TYPES.items():
+        old, old_time = timed(old_extract_sem_entities, docs, tag_types, args.repeat)
+        new, new_time = timed(nee.extract_sem_entities, docs, tag_types, args.repeat)
+        if old != new:
+            print(f'FAIL: {name}: the single-pass entities differ from the old ones')
+            sys.exit(1)
+        entities = sum(len(result) for result in new)
+        print(f'  {name:<8} {len(tag_types)} tag types, {entities} entities: old {old_time:.3f}s, '
+              f'single pass {new_time:.3f}s ({old_time / new_time:.1f}x, {tokens / new_time:,.0f} tokens/sec)')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--pages', type=int, default=20, help='how many of the longest pages to use')
+    parser.add_argument('--repeat', type=int, default=5)
+    main(parser.parse_args())
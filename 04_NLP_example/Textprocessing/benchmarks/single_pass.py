@@ -0,0 +1,45 @@
+'''Checks that the single-pass TextProcessor gives the same output as the old two-pass one,
+and reports how long each takes.
+
+Run from the Textprocessing folder (the resource lists are opened with relative paths):
+
+    python benchmarks/single_pass.py 0118/000200036_01_text.json
+'''
+import sys
+import time
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from TextProcessor import TextProcessor, NLP_MODEL
+from stub_nominatim import OfflineGeocoder
+
+
+async def run(processor, data):
+    start = time.perf_counter()
+    result = await processor.process_data(data)
+    return result, time.perf_counter() - start
+
+
+async def main(file_path):
+    file_path = Path(file_path)
+    processor = TextProcessor(file_path.parent, NLP_MODEL, geocoder=OfflineGeocoder())
+    data = processor.load_json_data(file_path)
+
+    processor.single_pass = False
+    two_pass, two_pass_time = await run(processor, data)
+    processor.single_pass = True
+    one_pass, one_pass_time = await run(processor, data)
+
+    if one_pass != two_pass:
+        print('FAIL: single-pass output differs from two-pass output')
+        sys.exit(1)
+
+    print(f'{file_path.name}: {len(one_pass)} tokens, output identical')
+    print(f'two-pass:    {two_pass_time:.2f}s')
+    print(f'single-pass: {one_pass_time:.2f}s ({two_pass_time / one_pass_time:.2f}x)')
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1]))
@@ -0,0 +1,68 @@
+'''Compares the offset-indexed token/entity joins with the old scanning versions on whole books.
+
+Both joins are timed on their own; the pages are parsed once up front and that time is not counted.
+Run from the Textprocessing folder:
+
+    python benchmarks/span_index.py 0118/011836203_01_text.json 0118/011834423_01_text.json
+'''
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from TextProcessor import TextProcessor, NLP_MODEL
+
+
+# The entity lookup convert_to_iob_format used to do: rescan the entities for every sentence and token
+def scan_entities(merged_entities, doc):
+    token_entities = []
+    for sent in doc.sents:
+        sent_entities = [e for e in merged_entities if e["start"] >= sent.start_char and e["end"] <= sent.end_char]
+        for token in sent:
+            token_entities.append(next((e for e in sent_entities if e["start"] <= token.idx < e["end"]), None))
+    return token_entities
+
+
+# The join process_data used to do: find each token's entity by its surface text
+def scan_ne_data(ne_data, doc):
+    return [next((ne for ne in ne_data if ne[0] == token.text), None) for token in doc]
+
+
+def iob_without_geocoding(token_entities, doc):
+    return [(token.text, ('B-' if token.idx == e["start"] else 'I-') + e["label"], None) if e else (token.text, 'O', None)
+            for token, e in zip(doc, token_entities)]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(file_paths):
+    processor = TextProcessor('.', NLP_MODEL)
+    nee = processor.nee
+    for file_path in map(Path, file_paths):
+        data = processor.load_json_data(file_path)
+        docs = list(NLP_MODEL.pipe(text for _, text in data))
+        merged = [nee.merge_entities(doc) for doc in docs]
+        tokens = sum(len(doc) for doc in docs)
+
+        scanned, scan_time = timed(lambda: [scan_entities(m, d) for m, d in zip(merged, docs)])
+        indexed, index_time = timed(lambda: [nee.index_entities(m, d) for m, d in zip(merged, docs)])
+        if scanned != indexed:
+            print(f'FAIL: {file_path.name}: indexed entities differ from the scanned ones')
+            sys.exit(1)
+
+        ne_data = [iob_without_geocoding(t, d) for t, d in zip(indexed, docs)]
+        _, text_join_time = timed(lambda: [scan_ne_data(n, d) for n, d in zip(ne_data, docs)])
+        by_offset, offset_join_time = timed(lambda: [[n[token.i] for token in d] for n, d in zip(ne_data, docs)])
+
+        print(f'{file_path.name}: {len(data)} pages, {tokens} tokens')
+        print(f'  convert_to_iob_format lookup: scan {scan_time:.3f}s, index {index_time:.3f}s ({scan_time / index_time:.1f}x)')
+        print(f'  process_data join:            text {text_join_time:.3f}s, offset {offset_join_time:.3f}s ({text_join_time / offset_join_time:.1f}x)')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,39 @@
+'''Stand-ins for the Nominatim service, so the benchmarks run offline.
+
+OfflineGeocoder answers without any network traffic. run_stub_server starts a local HTTP server that answers
+/search requests like Nominatim, after an artificial delay, for benchmarks that should include the HTTP side.
+Both give a made-up location derived from the name; names starting with a lower-case letter are not found.'''
+import sys
+import asyncio
+from pathlib import Path
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from geocoder import NominatimGeocoder, NOT_FOUND
+
+
+def fake_location(place_name):
+    if not place_name[:1].isupper():
+        return None
+    return {'latitude': str(len(place_name)), 'longitude': str(-len(place_name))}
+
+
+class OfflineGeocoder(NominatimGeocoder):
+    async def lookup(self, place_name, semaphore):
+        return fake_location(place_name) or dict(NOT_FOUND)
+
+
+async def run_stub_server(port=8765, latency=0.05):
+    '''Starts the stub server on localhost and returns its runner (call runner.cleanup() to stop it) and URL.'''
+    async def search(request):
+        await asyncio.sleep(latency)
+        location = fake_location(request.query.get('q', ''))
+        return web.json_response([{'lat': location['latitude'], 'lon': location['longitude']}] if location else [])
+
+    app = web.Application()
+    app.router.add_get('/search', search)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner, f'http://127.0.0.1:{port}/search'
@@ -0,0 +1,321 @@
+'''Inverted index over TextProcessor's output, for KWIC concordances and collocations without re-reading the pages.
+
+build_index reads the processed output of a folder - the .json or .jsonl page files, or the .tokcol file of
+each book - once and writes the index into another folder. CorpusIndex memory-maps it, so opening an index and
+running a query only touches the parts of the arrays the query needs.
+
+Every token of the corpus gets a position: the books one after the other, their pages in page order. The index
+holds a numpy array per token attribute, indexed by position (page id, start_char, and ids for the text, lemma,
+primary USAS tag and POS), and the offsets of every book's first position. Queries can be made on three fields:
+
+- token: the token text, lower-cased
+- lemma: the lemma, lower-cased
+- usas:  the primary USAS tag, the first of USAS_tags
+
+Each field has a sorted vocabulary and postings: the positions of every term, grouped by term in vocabulary
+order, with the offsets where each term's positions start. Because the vocabulary is sorted, the terms starting
+with a prefix (a query ending in '*', like 'Z2*' or 'garden*') are a single run of the postings. A position leads
+to the (book, page, start_char) of the token. KWIC lines and collocation windows stay within the token's book.
+
+    python corpus_index.py build output index
+    python corpus_index.py kwic index river --width 8
+    python corpus_index.py collocates index Z2 --field usas --by lemma --window 4
+'''
+import re
+import json
+import argparse
+from bisect import bisect_left
+from pathlib import Path
+import numpy
+from output_formats import ColumnarReader, atomic_open
+
+INDEX_VERSION = 1
+FIELDS = ['token', 'lemma', 'usas']
+PAGE_FILE = re.compile(r'(.+)_page_(\d+)\.(json|jsonl)')
+
+
+def find_books(output_path):
+    '''Returns {book: .tokcol file, or the [(page_id, page file)] of its pages in page order} for an output folder.'''
+    books = {path.stem: path for path in output_path.glob('*.tokcol')}
+    pages = {}
+    for path in output_path.iterdir():
+        match = PAGE_FILE.fullmatch(path.name)
+        if match and match[1] not in books:
+            pages.setdefault(match[1], []).append((int(match[2]), path))
+    books.update((book, sorted(book_pages)) for book, book_pages in pages.items())
+    return dict(sorted(books.items()))
+
+
+def read_page_file(path):
+    with open(path) as file:
+        if path.suffix == '.jsonl':
+            return [json.loads(line) for line in file]
+        return json.load(file)
+
+
+class IndexBuilder:
+    '''Collects the tokens of the corpus as id arrays, with a vocabulary per attribute in the order seen.'''
+    def __init__(self):
+        self.vocab = {name: {} for name in ['text', 'lemma', 'usas', 'pos']}
+        self.columns = {name: [] for name in ['page', 'start', 'text', 'lemma', 'usas', 'pos']}
+        self.books = []
+        self.book_offsets = [0]
+
+    def encode(self, name, values):
+        ids = self.vocab[name]
+        return numpy.array([ids.setdefault(value, len(ids)) for value in values], dtype=numpy.int32)
+
+    def add_column(self, name, values):
+        self.columns[name].append(values)
+
+    def add_tokens(self, tokens):
+        self.add_column('page', numpy.array([token['page_id'] for token in tokens], dtype=numpy.int32))
+        self.add_column('start', numpy.array([token['start_char'] for token in tokens], dtype=numpy.int32))
+        self.add_column('text', self.encode('text', [token['text'] for token in tokens]))
+        self.add_column('lemma', self.encode('lemma', [token['lemma'] for token in tokens]))
+        self.add_column('usas', self.encode('usas', [token['USAS_tags'][0] if token['USAS_tags'] else ''
+                                                     for token in tokens]))
+        self.add_column('pos', self.encode('pos', [token['POS'] for token in tokens]))
+        return len(tokens)
+
+    def add_columnar(self, path):
+        # The columns are mapped onto the builder's ids through the book's own dictionaries
+        with ColumnarReader(path) as reader:
+            self.add_column('page', numpy.array(reader.column('page_id'), dtype=numpy.int32))
+            self.add_column('start', numpy.array(reader.column('start_char'), dtype=numpy.int32))
+            for name, column, decode in [('text', 'text', str), ('lemma', 'lemma', str), ('pos', 'POS', str),
+                                         ('usas', 'USAS_tags', lambda tags: (json.loads(tags) or [''])[0])]:
+                mapping = self.encode(name, [decode(value) for value in reader.dictionary(column)])
+                self.add_column(name, mapping[reader.column(column)])
+            return len(reader)
+
+    def add_book(self, book, source):
+        tokens = self.add_columnar(source) if isinstance(source, Path) else \
+            sum(self.add_tokens(read_page_file(path)) for _, path in source)
+        self.books.append(book)
+        self.book_offsets.append(self.book_offsets[-1] + tokens)
+
+    def save(self, index_path):
+        index_path.mkdir(parents=True, exist_ok=True)
+        columns = {name: numpy.concatenate(chunks) if chunks else numpy.zeros(0, dtype=numpy.int32)
+                   for name, chunks in self.columns.items()}
+
+        def sorted_vocab(name, normalize):
+            # The field's sorted vocabulary and an array mapping the ids seen to it
+            raw = list(self.vocab[name])
+            terms = sorted({normalize(value) for value in raw})
+            term_ids = {term: i for i, term in enumerate(terms)}
+            return terms, numpy.array([term_ids[normalize(value)] for value in raw], dtype=numpy.int32)
+
+        vocab = {'text': list(self.vocab['text']), 'pos': list(self.vocab['pos'])}
+        vocab['token'], text_to_token = sorted_vocab('text', str.lower)
+        vocab['lemma'], lemma_ids = sorted_vocab('lemma', str.lower)
+        vocab['usas'], usas_ids = sorted_vocab('usas', str)
+        arrays = {
+            'page': columns['page'], 'start': columns['start'], 'text': columns['text'], 'pos': columns['pos'],
+            'lemma': lemma_ids[columns['lemma']], 'usas': usas_ids[columns['usas']],
+            'text_to_token': text_to_token, 'book_offsets': numpy.array(self.book_offsets, dtype=numpy.int64),
+        }
+        field_ids = {'token': text_to_token[columns['text']], 'lemma': arrays['lemma'], 'usas': arrays['usas']}
+        for field, ids in field_ids.items():
+            arrays[f'{field}.postings'] = numpy.argsort(ids, kind='stable').astype(numpy.int32)
+            arrays[f'{field}.offsets'] = numpy.concatenate(
+                [[0], numpy.cumsum(numpy.bincount(ids, minlength=len(vocab[field])))]).astype(numpy.int64)
+
+        # The header goes first and is written last, so an index with a header is complete
+        (index_path / 'index.json').unlink(missing_ok=True)
+        for name, values in arrays.items():
+            with atomic_open(index_path / f'{name}.npy', 'wb') as file:
+                numpy.save(file, values)
+        with atomic_open(index_path / 'index.json') as file:
+            json.dump({'version': INDEX_VERSION, 'tokens': len(columns['page']), 'books': self.books,
+                       'vocab': vocab}, file)
+
+
+def build_index(output_path, index_path):
+    '''
+        Indexes the processed output in output_path and saves the index in index_path.
+
+        Parameters:
+        - output_path (str): Folder with TextProcessor's output, in any of its output formats.
+        - index_path (str): Folder to save the index in, an index already there is replaced.
+
+        Returns:
+        - int: The number of tokens indexed.
+    '''
+    builder = IndexBuilder()
+    books = find_books(Path(output_path))
+    for book, source in books.items():
+        builder.add_book(book, source)
+    builder.save(Path(index_path))
+    print(f'Indexed {builder.book_offsets[-1]} tokens of {len(books)} books in {index_path}')
+    return builder.book_offsets[-1]
+
+
+class CorpusIndex:
+    '''
+        Queries an index saved by build_index. Terms are looked up in a field ('token', 'lemma' or 'usas');
+        token and lemma queries are not case-sensitive, and a term ending in '*' matches every term starting
+        with the rest of it.
+    '''
+    def __init__(self, index_path):
+        self.index_path = Path(index_path)
+        with open(self.index_path / 'index.json') as file:
+            header = json.load(file)
+        if header['version'] != INDEX_VERSION:
+            raise ValueError(f'{index_path} holds a version {header["version"]} index, rebuild it with build_index')
+        self.books = header['books']
+        self.vocab = header['vocab']
+        self.arrays = {}
+
+    def __len__(self):
+        return self.array('page').shape[0]
+
+    def array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = numpy.load(self.index_path / f'{name}.npy', mmap_mode='r')
+        return self.arrays[name]
+
+    def term_range(self, term, field):
+        '''The range of vocabulary ids the term matches in the field.'''
+        vocab = self.vocab[field]
+        term = term if field == 'usas' else term.lower()
+        if term.endswith('*'):
+            prefix = term[:-1]
+            return bisect_left(vocab, prefix), bisect_left(vocab, prefix + '\U0010ffff')
+        first = bisect_left(vocab, term)
+        return first, first + 1 if first < len(vocab) and vocab[first] == term else first
+
+    def positions(self, term, field='token'):
+        '''Returns the positions of the term in the corpus, in corpus order.'''
+        first, last = self.term_range(term, field)
+        offsets = self.array(f'{field}.offsets')
+        positions = self.array(f'{field}.postings')[offsets[first]:offsets[last]]
+        return numpy.sort(positions) if last - first > 1 else numpy.asarray(positions)
+
+    def frequency(self, term, field='token'):
+        first, last = self.term_range(term, field)
+        offsets = self.array(f'{field}.offsets')
+        return int(offsets[last] - offsets[first])
+
+    def book_bounds(self, positions):
+        '''The first and the after-last position of the book of every position.'''
+        book_offsets = self.array('book_offsets')
+        books = numpy.searchsorted(book_offsets, positions, side='right') - 1
+        return books, book_offsets[books], book_offsets[books + 1]
+
+    def locate(self, position):
+        '''Returns the (book, page_id, start_char) of the token at a position.'''
+        books, _, _ = self.book_bounds(numpy.array([position]))
+        return self.books[books[0]], int(self.array('page')[position]), int(self.array('start')[position])
+
+    def join_tokens(self, text_ids, starts):
+        '''The text of a run of tokens, with a single space wherever the original had whitespace.'''
+        texts, pieces, end = self.vocab['text'], [], None
+        for text_id, start in zip(text_ids, starts):
+            text = texts[text_id]
+            if pieces and start != end:
+                pieces.append(' ')
+            pieces.append(' ' if text.isspace() else text)
+            end = start + len(text)
+        return ' '.join(''.join(pieces).split())
+
+    def text(self, first, last):
+        '''The text of the tokens from position first up to last.'''
+        return self.join_tokens(self.array('text')[first:last].tolist(), self.array('start')[first:last].tolist())
+
+    def kwic(self, term, field='token', width=5, limit=100):
+        '''
+            Concordance lines for the term: for each match (the first `limit`, None for all), a dict with its
+            book, page_id and start_char, and the `width` tokens left and right of it, within its book.
+        '''
+        positions = self.positions(term, field)[:limit]
+        books, book_starts, book_ends = self.book_bounds(positions)
+        # The windows of all the matches are read in one go, the positions outside the book are dropped per line
+        windows = positions[:, None].astype(numpy.int64) + numpy.arange(-width, width + 1)
+        inside = ((windows >= book_starts[:, None]) & (windows < book_ends[:, None])).tolist()
+        windows = numpy.clip(windows, 0, max(len(self) - 1, 0))
+        text_ids, starts = self.array('text')[windows].tolist(), self.array('start')[windows].tolist()
+        pages = self.array('page')[positions].tolist()
+
+        lines = []
+        for i, book in enumerate(books.tolist()):
+            def join(first, last):
+                kept = [j for j in range(first, last) if inside[i][j]]
+                return self.join_tokens([text_ids[i][j] for j in kept], [starts[i][j] for j in kept])
+
+            lines.append({'book': self.books[book], 'page_id': pages[i], 'start_char': starts[i][width],
+                          'left': join(0, width), 'node': join(width, width + 1),
+                          'right': join(width + 1, 2 * width + 1)})
+        return lines
+
+    def field_ids(self, field, positions):
+        if field == 'token':
+            return self.array('text_to_token')[self.array('text')[positions]]
+        return self.array(field)[positions]
+
+    def collocates(self, term, field='token', by=None, window=5, top=20, skip_pos=('PUNCT', 'SPACE')):
+        '''
+            Counts the terms within `window` tokens either side of every match of the term, within its book.
+
+            Parameters:
+            - term (str), field (str): What to look for, as in positions().
+            - by (str): The field the collocates are counted by, the query's field by default.
+            - window (int): Tokens looked at on each side of a match.
+            - top (int): How many collocates to return, None for all.
+            - skip_pos (tuple): POS tags of tokens that are neither counted nor looked at, punctuation and
+              whitespace by default.
+
+            Returns:
+            - list of (term, count): The most frequent collocates, most frequent first.
+        '''
+        by = by or field
+        positions = self.positions(term, field)
+        _, book_starts, book_ends = self.book_bounds(positions)
+        around = numpy.concatenate([numpy.arange(-window, 0), numpy.arange(1, window + 1)])
+        candidates = positions[:, None].astype(numpy.int64) + around
+        inside = (candidates >= book_starts[:, None]) & (candidates < book_ends[:, None])
+        candidates = candidates[inside]
+        skip_ids = [i for i, pos in enumerate(self.vocab['pos']) if pos in skip_pos]
+        if skip_ids:
+            candidates = candidates[~numpy.isin(self.array('pos')[candidates], skip_ids)]
+
+        counts = numpy.bincount(self.field_ids(by, candidates), minlength=len(self.vocab[by]))
+        found = numpy.flatnonzero(counts)
+        order = sorted(found.tolist(), key=lambda i: (-counts[i], self.vocab[by][i]))
+        return [(self.vocab[by][i], int(counts[i])) for i in order[:top]]
+
+
+def main(args):
+    if args.command == 'build':
+        build_index(args.output, args.index)
+        return
+
+    index = CorpusIndex(args.index)
+    if args.command == 'kwic':
+        for line in index.kwic(args.term, args.field, args.width, args.limit):
+            print(f"{line['book']}:{line['page_id']}:{line['start_char']:<8}{line['left'][-60:]:>60} "
+                  f"[{line['node']}] {line['right'][:60]}")
+        print(f'{index.frequency(args.term, args.field)} matches')
+    else:
+        for collocate, count in index.collocates(args.term, args.field, args.by, args.window, args.top):
+            print(f'{count:>8}  {collocate}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Builds and queries the KWIC and collocation index.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='index the processed output of a folder')
+    build.add_argument('output', help="TextProcessor's output folder")
+    build.add_argument('index', help='folder to save the index in')
+    for name in ['kwic', 'collocates']:
+        command = commands.add_parser(name)
+        command.add_argument('index')
+        command.add_argument('term', help="a token, lemma or USAS tag, ending in '*' to match a prefix")
+        command.add_argument('--field', choices=FIELDS, default='token')
+    commands.choices['kwic'].add_argument('--width', type=int, default=6)
+    commands.choices['kwic'].add_argument('--limit', type=int, default=50)
+    commands.choices['collocates'].add_argument('--by', choices=FIELDS)
+    commands.choices['collocates'].add_argument('--window', type=int, default=5)
+    commands.choices['collocates'].add_argument('--top', type=int, default=20)
+    main(parser.parse_args())
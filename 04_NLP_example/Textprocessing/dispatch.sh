@@ -1,6 +1,6 @@
-
 #!/bin/bash
-input_directory="[PATH TO FOLDER]/0118"
+input_directory="[PATH TO FOLDER]/Textprocessing/0118"
+output_directory="[PATH TO FOLDER]/Textprocessing/output"
 
 # Get the number of CPU cores on Mac
 ##CORES=$(sysctl -n hw.ncpu)
@@ -12,5 +12,13 @@ echo "Number of CPU cores: $CORES"
 
 
 
-# Use xargs to run the process in parallel and print filename
-find "$input_directory" -name '*.json' | xargs -P "$CORES" -I {} bash -c './jobfile.sh "$1"' _ {}
+# Run a single container over the whole directory. FILE_NAME is left unset, so TextProcessor
+# loads the models once and shares them with one worker process per core.
+# (jobfile.sh still runs a container for a single file.)
+docker run \
+    -v "${input_directory}:${input_directory}" \
+    -v "${output_directory}:${output_directory}" \
+    -e INPUT_FOLDER_PATH="${input_directory}" \
+    -e OUTPUT_FOLDER_PATH="${output_directory}" \
+    -e NUM_WORKERS="$CORES" \
+    textprocessor
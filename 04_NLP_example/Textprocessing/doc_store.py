@@ -0,0 +1,63 @@
+'''Saves the annotated spaCy Docs of a book as a DocBin, so they can be visualized or analysed again without
+running the pipeline over the text a second time.
+
+With TextProcessor's save_docs, every page that goes through the pipeline is added to its book's DocBin, which is
+written next to the output as <book>.spacy. A Doc keeps its tokens, lemmas, POS tags, entities and sentence
+boundaries, and through the DocBin's user data the pymusas_tags of every token and the page id the Doc came from
+(doc.user_data['page_id']). Empty pages don't go through the pipeline; they are added as empty Docs with their
+page id, so a book's pages are all there, in order.
+
+load_docs gives the Docs back, with the vocab of a loaded pipeline. They can be passed to
+NamedEntityExtractor.visualize_entities, extract_sem_entities, merge_entities and process_doc, or be turned into
+TextProcessor output again with TextProcessor.export_saved_docs.'''
+from spacy.tokens import DocBin, Token
+from output_formats import atomic_open
+
+DOCBIN_SUFFIX = '.spacy'
+# Bump this when what goes into a book's DocBin changes, so books whose Docs are saved are processed again
+DOCBIN_VERSION = 2
+
+
+def new_docbin():
+    return DocBin(store_user_data=True)
+
+
+def add_doc(docbin, doc, page_id):
+    doc.user_data['page_id'] = page_id
+    docbin.add(doc)
+
+
+def save_docbin(docbin, path):
+    with atomic_open(path, 'wb') as file:
+        file.write(docbin.to_bytes())
+    print(f'Saved file {path}')
+
+
+def merge_docbins(paths, path):
+    '''Writes the Docs of the DocBins in paths, in that order, to a single DocBin at path.'''
+    docbin = new_docbin()
+    for part in paths:
+        with open(part, 'rb') as file:
+            docbin.merge(DocBin(store_user_data=True).from_bytes(file.read()))
+    save_docbin(docbin, path)
+
+
+def load_docs(path, vocab):
+    '''
+        Yields the (page_id, Doc) pairs of a saved DocBin, in the order the pages were processed.
+
+        Parameters:
+        - path (Path): The .spacy file.
+        - vocab (Vocab): The vocab of the pipeline the Docs are used with, e.g. TextProcessor's NLP_MODEL.vocab.
+    '''
+    # The extension is normally registered by the pymusas tagger, Docs can also be loaded without it
+    if not Token.has_extension('pymusas_tags'):
+        Token.set_extension('pymusas_tags', default=None)
+    with open(path, 'rb') as file:
+        docbin = DocBin(store_user_data=True).from_bytes(file.read())
+    for doc in docbin.get_docs(vocab):
+        # The user data comes back through msgpack, which turns the lists of tags into tuples
+        for key, value in doc.user_data.items():
+            if isinstance(key, tuple) and key[0] == '._.' and isinstance(value, tuple):
+                doc.user_data[key] = list(value)
+        yield doc.user_data.get('page_id'), doc
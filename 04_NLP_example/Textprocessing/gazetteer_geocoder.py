@@ -0,0 +1,219 @@
+'''Geocoding from a local gazetteer, so place names are resolved without a request to Nominatim where possible.
+
+The gazetteer is a tab-separated file: either a GeoNames dump (allCountries.txt, cities500.txt, GB.txt, ...),
+where the name, ASCII name and alternate names of every entry are indexed, or plain `name<TAB>latitude<TAB>
+longitude` lines, such as the ones `python gazetteer_geocoder.py build` writes for the names of
+resources/LD_placenames.txt. Lines starting with # are skipped.
+
+Names are normalized (accents, case, punctuation and a leading "the" taken off) and kept in one sorted list, with
+the coordinates in numpy arrays next to it, so a lookup is a bisect and the index stays small enough to be
+shared by the forked workers. A name listed more than once keeps the GeoNames entry with the largest
+population, or else the first one in the file.
+
+A capitalized name that is not in the gazetteer as it is, is tried again:
+- without a leading direction: "Northeastern Africa" as "Africa"
+- as the first words of a name that goes on with geo feature nouns only (resources/geo_feature_nouns.txt):
+  "Derwent" finds "Derwent Water" but "Saint" doesn't find "Saint Herbert's Isle" (the most populous, else the
+  shortest, when there are several)
+- as a misspelling of a name with the same first two letters, through difflib: "Crosthwaitc" finds "Crosthwaite"
+Lower-case names, like the geo nouns "river" or "fell", are only looked up as they are. What is still not
+found goes to the Nominatim service, unless there is none, as on air-gapped nodes.'''
+import re
+import asyncio
+import difflib
+import argparse
+import unicodedata
+from bisect import bisect_left
+import numpy
+from geocoder import NominatimGeocoder, NOMINATIM_URL, NOT_FOUND
+from manifest import hash_file
+
+NON_WORD = re.compile(r'[\W_]+')
+DIRECTIONS = {'north', 'south', 'east', 'west', 'northern', 'southern', 'eastern', 'western', 'northeast',
+              'northwest', 'southeast', 'southwest', 'northeastern', 'northwestern', 'southeastern',
+              'southwestern', 'central', 'upper', 'lower'}
+GEO_NOUNS_PATH = 'resources/geo_feature_nouns.txt'
+FUZZY_CUTOFF = 0.88  # difflib ratio a misspelt name needs to be taken for a gazetteer name
+GEONAMES_COLUMNS = 19
+
+
+def normalize(place_name):
+    if not place_name.isascii():
+        decomposed = unicodedata.normalize('NFKD', place_name)
+        place_name = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    words = NON_WORD.sub(' ', place_name.casefold()).split()
+    if len(words) > 1 and words[0] == 'the':
+        words = words[1:]
+    return ' '.join(words)
+
+
+class Gazetteer:
+    """
+        In-memory index of a gazetteer file, see the module docstring for the formats.
+
+        Parameters:
+        - path (str or Path): The gazetteer file.
+        - geo_nouns_path (str or Path): The feature nouns a name found from its first words may go on with.
+    """
+    def __init__(self, path, geo_nouns_path=GEO_NOUNS_PATH):
+        with open(geo_nouns_path, encoding='utf8') as file:
+            nouns = {normalize(line) for line in file} - {''}
+        self.geo_nouns = nouns | {noun + 's' for noun in nouns}
+        self.digest = hash_file(path)  # Part of the pipeline version, through GazetteerGeocoder.version
+        entries = {}  # normalized name -> (population, latitude, longitude), the first or most populous entry
+        with open(path, encoding='utf8') as file:
+            for line in file:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    if len(fields) >= GEONAMES_COLUMNS:
+                        names = {fields[1], fields[2], *fields[3].split(',')} - {''}
+                        entry = (int(fields[14] or 0), float(fields[4]), float(fields[5]))
+                    else:
+                        names = [fields[0]]
+                        entry = (0, float(fields[1]), float(fields[2]))
+                except (IndexError, ValueError):
+                    continue  # Not an entry
+                for name in map(normalize, names):
+                    if name and (name not in entries or entry[0] > entries[name][0]):
+                        entries[name] = entry
+
+        self.names = sorted(entries)
+        populations, latitudes, longitudes = zip(*(entries[name] for name in self.names)) if entries else ((), (), ())
+        self.populations = numpy.array(populations, dtype=numpy.int64)
+        self.latitudes = numpy.array(latitudes, dtype=numpy.float64)
+        self.longitudes = numpy.array(longitudes, dtype=numpy.float64)
+        self.fallbacks = {}  # Rows found for names that weren't in the gazetteer as they are, None for misses
+
+    def __len__(self):
+        return len(self.names)
+
+    def find(self, name):
+        i = bisect_left(self.names, name)
+        return i if i < len(self.names) and self.names[i] == name else None
+
+    def find_prefix(self, name):
+        # Normalized names are words joined by single spaces, so the names that start with the words of
+        # `name` sort between `name + ' '` and `name + '!'`
+        rows = [row for row in range(bisect_left(self.names, name + ' '), bisect_left(self.names, name + '!'))
+                if self.geo_nouns.issuperset(self.names[row][len(name) + 1:].split())]
+        return min(rows, key=lambda row: (-self.populations[row], len(self.names[row])), default=None)
+
+    def find_similar(self, name):
+        start, end = bisect_left(self.names, name[:2]), bisect_left(self.names, name[:2] + '\uffff')
+        candidates = [candidate for candidate in self.names[start:end] if abs(len(candidate) - len(name)) <= 2]
+        matches = difflib.get_close_matches(name, candidates, n=1, cutoff=FUZZY_CUTOFF)
+        return self.find(matches[0]) if matches else None
+
+    def find_fallback(self, name):
+        words = name.split()
+        while len(words) > 1 and words[0] in DIRECTIONS:
+            words = words[1:]
+            row = self.find(' '.join(words))
+            if row is not None:
+                return row
+        if len(name) < 4:
+            return None
+        row = self.find_prefix(name)
+        return row if row is not None else self.find_similar(name)
+
+    def row(self, place_name):
+        name = normalize(place_name)
+        if not name:
+            return None
+        row = self.find(name)
+        if row is None and place_name[:1].isupper():
+            if name not in self.fallbacks:
+                self.fallbacks[name] = self.find_fallback(name)
+            row = self.fallbacks[name]
+        return row
+
+    def location(self, row):
+        # As strings, like the locations Nominatim returns
+        return {'latitude': repr(self.latitudes[row].item()), 'longitude': repr(self.longitudes[row].item())}
+
+    def lookup(self, place_name):
+        row = self.row(place_name)
+        return None if row is None else self.location(row)
+
+    # Returns a dict with the locations of the place names that were found, the others are left out
+    def lookup_many(self, place_names):
+        rows = {place_name: self.row(place_name) for place_name in set(place_names)}
+        return {place_name: self.location(row) for place_name, row in rows.items() if row is not None}
+
+
+class GazetteerGeocoder(NominatimGeocoder):
+    """
+        Resolves place names from a local Gazetteer, and sends only the names it doesn't have to the Nominatim
+        service (through the cache, as NominatimGeocoder does).
+
+        Parameters:
+        - gazetteer (Gazetteer, str or Path): The index, or the gazetteer file to load it from.
+        - base_url (str): Search endpoint for the names that aren't in the gazetteer, None to never send a
+          request and leave them not found.
+        - max_concurrency, rate_limit, cache, timeout: As for NominatimGeocoder, for those requests.
+    """
+    def __init__(self, gazetteer, base_url=NOMINATIM_URL, max_concurrency=2, rate_limit=1.0, cache=None, timeout=30):
+        super().__init__(base_url, max_concurrency, rate_limit, cache, timeout)
+        self.gazetteer = gazetteer if isinstance(gazetteer, Gazetteer) else Gazetteer(gazetteer)
+        self.gazetteer_hits = 0  # Names answered from the gazetteer, without a request
+
+    # A different gazetteer file gives other locations, so books are geocoded again when it changes
+    def version(self):
+        return super().version() + [self.gazetteer.digest]
+
+    # A document's place names are looked up in the gazetteer in one go, the misses are then resolved together
+    async def geocode_many(self, place_names):
+        results = self.gazetteer.lookup_many(place_names)
+        self.gazetteer_hits += len(results)
+        missing = set(place_names).difference(results)
+        if missing and self.base_url:
+            results.update(await super().geocode_many(missing))
+        else:
+            results.update((place_name, dict(NOT_FOUND)) for place_name in missing)
+        return results
+
+
+async def build(names_path, output_path, base_url, rate_limit):
+    '''Geocodes every name of a list, such as resources/LD_placenames.txt, once and writes the gazetteer file.'''
+    with open(names_path, encoding='utf8') as file:
+        names = {}
+        for line in file:
+            names.setdefault(normalize(line), line.strip())  # One request per normalized name
+    names.pop('', None)
+    print(f'Geocoding {len(names)} names at {rate_limit} requests per second')
+    geocoder = NominatimGeocoder(base_url, rate_limit=rate_limit)
+    try:
+        results = await geocoder.geocode_many(list(names.values()))
+    finally:
+        await geocoder.close()
+    found = 0
+    with open(output_path, 'w', encoding='utf8') as file:
+        file.write(f'# Geocoded from {names_path} with {base_url}\n')
+        for name in sorted(names.values()):
+            location = results[name]
+            if location['latitude'] is not None:
+                file.write(f"{name}\t{location['latitude']}\t{location['longitude']}\n")
+                found += 1
+    print(f'Saved file {output_path}, {found} of {len(names)} names found')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Builds a gazetteer file from a list of place names, or looks up names in one.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('names', help='file with one place name per line, e.g. resources/LD_placenames.txt')
+    build_parser.add_argument('output')
+    build_parser.add_argument('--url', default=NOMINATIM_URL)
+    build_parser.add_argument('--rate-limit', type=float, default=1.0)
+    lookup_parser = subparsers.add_parser('lookup')
+    lookup_parser.add_argument('gazetteer')
+    lookup_parser.add_argument('place_names', nargs='+')
+    args = parser.parse_args()
+    if args.command == 'build':
+        asyncio.run(build(args.names, args.output, args.url, args.rate_limit))
+    else:
+        gazetteer = Gazetteer(args.gazetteer)
+        for place_name in args.place_names:
+            print(f'{place_name}\t{gazetteer.lookup(place_name)}')
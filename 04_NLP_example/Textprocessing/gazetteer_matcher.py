@@ -0,0 +1,44 @@
+'''Finds gazetteer entries (place names, plant names, ...) in raw text in a single pass.
+
+The entries are stored in a trie keyed by word, so a text is scanned once, word by word, instead of once per entry.
+Text and entries are split the same way, into runs of word characters and single punctuation marks, so matches
+always start and end on word boundaries. Entries are plain strings, nothing in them is treated as a regex.'''
+import re
+
+WORD = re.compile(r"\w+|[^\w\s]")
+END = ''  # Key for the entry that ends at a trie node, a word is never empty
+
+
+class GazetteerMatcher:
+    def __init__(self, entries):
+        self.root = {}
+        for entry in entries:
+            entry = entry.strip()
+            words = WORD.findall(entry)
+            if not words:
+                continue
+            node = self.root
+            for word in words:
+                node = node.setdefault(word, {})
+            node[END] = entry
+
+    # Returns (start, end) character offsets of the matches, leftmost-longest and not overlapping.
+    # An entry matches only if the text between its words is the same as in the entry.
+    def find(self, text):
+        words = [(match.start(), match.end(), match.group()) for match in WORD.finditer(text)]
+        matches, i = [], 0
+        while i < len(words):
+            node, longest = self.root, None
+            for j in range(i, len(words)):
+                node = node.get(words[j][2])
+                if node is None:
+                    break
+                entry = node.get(END)
+                if entry is not None and text[words[i][0]:words[j][1]] == entry:
+                    longest = j
+            if longest is None:
+                i += 1
+            else:
+                matches.append((words[i][0], words[longest][1]))
+                i = longest + 1
+        return matches
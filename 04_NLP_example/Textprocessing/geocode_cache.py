@@ -0,0 +1,152 @@
+'''Caches for NamedEntityExtractor.geocode results.
+
+A cached result is the dict geocode returns, {'latitude': ..., 'longitude': ...}. Lookups that found
+nothing (latitude None) are cached too, but for a shorter time, so they are not retried on every mention
+and still get another chance later on.'''
+import os
+import json
+import time
+import sqlite3
+from collections import OrderedDict
+
+DAY = 24 * 60 * 60
+
+
+class GeocodeCache:
+    """
+        Base class for the geocode cache backends. Backends implement _get_many and _put_many,
+        this class takes care of expiry times and the hit/miss counters.
+
+        Parameters:
+        - ttl (float): Seconds a found location is kept.
+        - negative_ttl (float): Seconds a lookup that found nothing is kept.
+        - max_entries (int): Size bound, the least recently used entries are evicted past it.
+    """
+    def __init__(self, ttl=30 * DAY, negative_ttl=DAY, max_entries=100000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_negative(result):
+        return result.get('latitude') is None or result.get('longitude') is None
+
+    def expires(self, result, now):
+        return now + (self.negative_ttl if self.is_negative(result) else self.ttl)
+
+    def get(self, place_name):
+        return self.get_many([place_name]).get(place_name)
+
+    def put(self, place_name, result):
+        self.put_many({place_name: result})
+
+    # Returns a dict with the cached results of the place names that were found,
+    # names that are missing or expired are left out
+    def get_many(self, place_names):
+        place_names = set(place_names)
+        found = self._get_many(place_names) if place_names else {}
+        self.hits += len(found)
+        self.misses += len(place_names) - len(found)
+        return found
+
+    def put_many(self, results):
+        if results:
+            self._put_many(results)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def _get_many(self, place_names):
+        raise NotImplementedError
+
+    def _put_many(self, results):
+        raise NotImplementedError
+
+
+class MemoryGeocodeCache(GeocodeCache):
+    '''Cache that lives as long as the process, the default backend.'''
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.entries = OrderedDict()  # place name -> (expires, result), least recently used first
+
+    def _get_many(self, place_names):
+        now, found = time.time(), {}
+        for place_name in place_names:
+            entry = self.entries.get(place_name)
+            if entry is None:
+                continue
+            if entry[0] <= now:
+                del self.entries[place_name]
+                continue
+            self.entries.move_to_end(place_name)
+            found[place_name] = entry[1]
+        return found
+
+    def _put_many(self, results):
+        now = time.time()
+        for place_name, result in results.items():
+            self.entries[place_name] = (self.expires(result, now), result)
+            self.entries.move_to_end(place_name)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class SQLiteGeocodeCache(GeocodeCache):
+    '''
+        On-disk cache that outlives the process and can be shared by parallel workers and containers
+        that mount the same file. The database runs in WAL mode so readers don't block the writer.
+        Each process opens its own connection on first use, so the cache can be created before forking.
+    '''
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = str(path)
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                                   'place_name TEXT PRIMARY KEY, result TEXT, expires REAL, last_used REAL)')
+                connection.execute('CREATE INDEX IF NOT EXISTS geocode_last_used ON geocode (last_used)')
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def _get_many(self, place_names):
+        now, found = time.time(), {}
+        place_names = list(place_names)
+        # Stay well below SQLite's limit on the number of query parameters
+        for i in range(0, len(place_names), 500):
+            chunk = place_names[i:i + 500]
+            rows = self.connection.execute(
+                f'SELECT place_name, result FROM geocode WHERE expires > ? AND place_name IN ({",".join("?" * len(chunk))})',
+                [now, *chunk])
+            found.update((place_name, json.loads(result)) for place_name, result in rows)
+        if found:
+            with self.connection:
+                self.connection.executemany('UPDATE geocode SET last_used = ? WHERE place_name = ?',
+                                            [(now, place_name) for place_name in found])
+        return found
+
+    def _put_many(self, results):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)',
+                                        [(place_name, json.dumps(result), self.expires(result, now), now)
+                                         for place_name, result in results.items()])
+            self.evict(now)
+
+    def evict(self, now):
+        self.connection.execute('DELETE FROM geocode WHERE expires <= ?', (now,))
+        excess = self.connection.execute('SELECT COUNT(*) FROM geocode').fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute('DELETE FROM geocode WHERE place_name IN '
+                                    '(SELECT place_name FROM geocode ORDER BY last_used LIMIT ?)', (excess,))
@@ -0,0 +1,165 @@
+'''Geocoding of place names against a Nominatim search service.
+
+A document's place names are resolved together: the unique names are looked up in the cache first, and the rest
+are requested concurrently over one pooled HTTP session. A semaphore bounds the number of requests in flight and
+a token bucket limits the request rate, to stay within the usage policy of the public Nominatim server
+(https://operations.osmfoundation.org/policies/nominatim/, at most one request per second). The bucket is kept
+in shared memory, so the worker processes forked from the one that made the geocoder share the one limit.
+
+Only answers from the service are cached, a name that was not found included. A request that failed (an
+error status, a timeout, no connection) is not: the name is reported as not found for now and asked for again
+the next time it comes up. A 429 answer pauses the rate limiter for the Retry-After the server gives, and the
+request is sent again after it.'''
+import time
+import asyncio
+import multiprocessing
+import aiohttp
+from geocode_cache import MemoryGeocodeCache
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+NOT_FOUND = {'latitude': None, 'longitude': None}
+MAX_RETRIES = 3  # Times a request answered with 429 Too Many Requests is sent again
+DEFAULT_RETRY_AFTER = 60.0  # Seconds to wait after a 429 without a usable Retry-After header
+
+
+class TokenBucket:
+    '''
+        Allows `rate` acquisitions per second on average, with bursts of up to `capacity`, in this process and
+        all the processes forked from it together.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        # [tokens, time of the last update], shared with forked processes; time.monotonic is the same clock in all
+        self.state = multiprocessing.RawArray('d', [capacity, time.monotonic()])
+        self.lock = multiprocessing.Lock()
+
+    def take(self):
+        '''Takes a token if there is one and returns 0, or else the seconds until there will be one.'''
+        with self.lock:
+            tokens, updated = self.state
+            now = time.monotonic()
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self.state[0], self.state[1] = tokens, now
+            return wait
+
+    def pause(self, seconds):
+        '''Hands out no tokens for the next `seconds`, to all the processes sharing the bucket.'''
+        with self.lock:
+            now = time.monotonic()
+            # take() waits (1 - tokens) / rate for the next token
+            self.state[0] = min(self.state[0] + (now - self.state[1]) * self.rate, 1 - seconds * self.rate)
+            self.state[1] = now
+
+    async def acquire(self):
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class NominatimGeocoder:
+    """
+        Resolves place names to {'latitude': ..., 'longitude': ...} dicts, {'latitude': None, 'longitude': None}
+        when nothing is found.
+
+        Parameters:
+        - base_url (str): Search endpoint, point it at a local stub server for tests and benchmarks.
+        - max_concurrency (int): Maximum number of requests in flight.
+        - rate_limit (float): Maximum number of requests per second.
+        - cache (GeocodeCache): Where results are kept, an in-memory cache by default.
+        - timeout (float): Seconds before a request is given up on.
+    """
+    def __init__(self, base_url=NOMINATIM_URL, max_concurrency=2, rate_limit=1.0, cache=None, timeout=30):
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = TokenBucket(rate_limit)
+        self.cache = cache if cache is not None else MemoryGeocodeCache()
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.headers = {'User-Agent': 'IAA-Oracle-ULTEC text processor'}
+        self._session = None
+        self._session_loop = None
+        # Requests sent to the service, how many of them failed and the seconds they took altogether
+        self.lookups = 0
+        self.failures = 0
+        self.lookup_seconds = 0.0
+
+    # One keep-alive session is shared by all lookups; a session belongs to an event loop,
+    # so a new one is opened when the geocoder is used from a different loop
+    def session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, headers=self.headers)
+            self._session_loop = loop
+        return self._session
+
+    # Which service the locations come from, part of TextProcessor's pipeline version
+    def version(self):
+        return [type(self).__name__, self.base_url]
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def geocode(self, place_name):
+        return (await self.geocode_many([place_name]))[place_name]
+
+    # Returns a dict with a result for every place name given
+    async def geocode_many(self, place_names):
+        results = self.cache.get_many(place_names)
+        missing = [place_name for place_name in set(place_names) if place_name not in results]
+        if missing:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            resolved = dict(zip(missing, await asyncio.gather(*(self.lookup(place_name, semaphore)
+                                                                  for place_name in missing))))
+            # Empty answers are cached as well (for a shorter time), so they are not retried on every mention;
+            # failed requests (None) are not, they are not found for now only
+            self.cache.put_many({place_name: result for place_name, result in resolved.items() if result is not None})
+            results.update((place_name, dict(NOT_FOUND) if result is None else result)
+                           for place_name, result in resolved.items())
+        return results
+
+    @staticmethod
+    def retry_after(response):
+        # Retry-After may also be an HTTP date, which Nominatim doesn't send; the default is used for it
+        try:
+            return max(float(response.headers.get('Retry-After', '')), 0.0)
+        except ValueError:
+            return DEFAULT_RETRY_AFTER
+
+    # Returns the location, NOT_FOUND when the service found nothing, or None when the request failed
+    async def lookup(self, place_name, semaphore):
+        params = {'q': place_name, 'format': 'json'}
+        async with semaphore:
+            for _ in range(MAX_RETRIES + 1):
+                await self.rate_limiter.acquire()
+                start = time.perf_counter()
+                try:
+                    async with self.session().get(self.base_url, params=params) as response:
+                        if response.status == 200:
+                            data = await response.json()
+                            if data:
+                                return {'latitude': data[0].get('lat'), 'longitude': data[0].get('lon')}
+                            return dict(NOT_FOUND)
+                        self.failures += 1
+                        if response.status != 429:
+                            print(f"Geocoding failed for {place_name}: HTTP {response.status}")
+                            return None
+                        self.rate_limiter.pause(self.retry_after(response))
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    self.failures += 1
+                    print(f"Geocoding failed for {place_name}: {e}")
+                    return None
+                finally:
+                    self.lookups += 1
+                    self.lookup_seconds += time.perf_counter() - start
+        print(f"Geocoding failed for {place_name}: still rate limited after {MAX_RETRIES} retries")
+        return None
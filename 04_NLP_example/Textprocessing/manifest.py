@@ -0,0 +1,133 @@
+'''Keeps track of what TextProcessor has already done, so re-runs skip the input files that have not changed
+and an interrupted run carries on from the last page it wrote.
+
+Every input file gets a small JSON manifest in the .manifest folder of the output directory:
+
+    {"input_hash": ..., "pipeline_version": ..., "complete": true,
+     "pages": [[1, ["book_page_1.json"]], ...], "output_files": ["book_page_1.json", ...]}
+
+A file is up to date when the sha256 of its contents and the pipeline version match the manifest, the manifest
+is complete and every output file it lists is still there. When only the hash and version match, the pages the
+manifest lists are kept and the others are processed. Anything else starts the file from scratch, removing the
+outputs of the previous version first. Manifests are written with atomic_open, like the output files.
+
+While a file is processed, the pages written since the manifest was last saved are appended to a journal next
+to it (book.journal, one [page_id, output files] line per page) instead of saving the whole manifest again after
+every page, which would take time quadratic in the number of pages. Loading a manifest reads its journal too,
+leaving out a last line that was cut off; saving the manifest folds the journal in and removes it. The shards
+of a book keep journals of the same kind in their folders (see TextProcessor.stream_shard).'''
+import json
+import hashlib
+from pathlib import Path
+from output_formats import atomic_open
+
+MANIFEST_DIR = '.manifest'
+
+
+def append_journal(path, pages):
+    '''Appends [page_id, output files] lines to a journal.'''
+    with open(path, 'a') as file:
+        file.writelines(json.dumps([page_id, names]) + '\n' for page_id, names in pages)
+
+
+def read_journal(path):
+    '''Yields the [page_id, output files] lines of a journal, up to a last line that was cut off.'''
+    try:
+        with open(path) as file:
+            for line in file:
+                yield json.loads(line)
+    except IOError:
+        pass
+    except ValueError:
+        pass  # The line being written when the run was stopped, the page is done again
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileManifest:
+    """
+        The manifest of one input file.
+
+        Parameters:
+        - output_path (Path): The output directory, the manifest is kept in its .manifest folder.
+        - file_path (Path): The input file.
+        - pipeline_version (str): Changes whenever the same input would give different output.
+    """
+    def __init__(self, output_path, file_path, pipeline_version):
+        self.output_path = Path(output_path)
+        self.path = self.output_path / MANIFEST_DIR / f'{Path(file_path).stem}.json'
+        self.journal_path = self.path.with_suffix('.journal')
+        self.input_hash = hash_file(file_path)
+        self.pipeline_version = pipeline_version
+        self.previous = self.load()
+        self.pages = {}
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                manifest = json.load(file)
+        except (IOError, ValueError):
+            return None
+        for page in read_journal(self.journal_path):
+            manifest['pages'].append(page)
+            manifest['output_files'].extend(page[1])
+        return manifest
+
+    def save(self, complete=False):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # The journal goes first: should the run stop in between, its pages are done again, while the journal
+        # of an older manifest must never be read with the new one
+        self.journal_path.unlink(missing_ok=True)
+        files = sorted({name for names in self.pages.values() for name in names})
+        with atomic_open(self.path) as file:
+            json.dump({
+                'input_hash': self.input_hash,
+                'pipeline_version': self.pipeline_version,
+                'complete': complete,
+                'pages': [[page_id, names] for page_id, names in self.pages.items()],
+                'output_files': files,
+            }, file)
+
+    def matches_previous(self):
+        return (self.previous is not None
+                and self.previous['input_hash'] == self.input_hash
+                and self.previous['pipeline_version'] == self.pipeline_version)
+
+    def up_to_date(self):
+        return (self.matches_previous() and self.previous['complete']
+                and all((self.output_path / name).exists() for name in self.previous['output_files']))
+
+    def start(self, resumable=True):
+        """
+            Starts (or resumes) processing the file and returns the ids of the pages that are already done.
+            Pages are only resumed for writers that write each page as soon as they get it.
+        """
+        if resumable and self.matches_previous():
+            self.pages = {page_id: names for page_id, names in self.previous['pages']
+                          if all((self.output_path / name).exists() for name in names)}
+        elif self.previous is not None:
+            # The input or the pipeline changed, so the old outputs are removed rather than left to mix with the new
+            for name in self.previous['output_files']:
+                (self.output_path / name).unlink(missing_ok=True)
+        self.save()
+        return set(self.pages)
+
+    def page_written(self, page_id, output_files):
+        self.pages_written([(page_id, output_files)])
+
+    def pages_written(self, pages):
+        for page_id, output_files in pages:
+            self.pages[page_id] = [str(Path(path).relative_to(self.output_path)) for path in output_files]
+        append_journal(self.journal_path, [(page_id, self.pages[page_id]) for page_id, _ in pages])
+
+    def finish(self, output_files=()):
+        # Files that are not tied to a page, like the columnar writer's single file, are listed under page None
+        if output_files:
+            self.page_written(None, output_files)
+        self.save(complete=True)
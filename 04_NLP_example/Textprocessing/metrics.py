@@ -0,0 +1,116 @@
+'''Timings and counters for TextProcessor, so a slow book can be traced to the stage it spends its time in.
+
+Stages are timed with `with metrics.time('stage'):` and accumulate seconds and calls; counters are plain
+numbers. TextProcessor keeps one Metrics per file and adds them up for the run:
+
+- spacy.<component>:   each component of the spaCy pipeline, including the tokenizer, entity_ruler and
+                       pymusas_rule_based_tagger
+- ner.*:               merging the entities, mapping them onto the tokens, geocoding and building the IOB tuples
+- token_features:      building the token dicts
+- write:               the output writer, with the bytes_written and files_written counters
+- load_docs:           reading the Docs saved with save_docs back, when exporting from them
+- assemble:            putting the output of a file's shards together, for the files split over several workers
+- geocode_* counters:  lookups sent to the geocoding service, their failures and total latency, the hits
+                       and misses of the geocode cache and the names answered from a local gazetteer
+- page_cache_*:        pages answered by the page cache's memory and disk tiers and the pages it missed, next
+                       to pages_skipped_empty, the empty pages that never went through the pipeline
+- jobs_failed:         jobs of the directory run (whole files or shards) that raised an error in their worker
+
+write_stats saves the metrics of every file and of the whole run, as JSON, or in the Prometheus text format
+when the file name ends in .prom.'''
+import json
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+class Metrics:
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+            self.calls[stage] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def add(self, other):
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] += seconds
+        self.calls.update(other.calls)
+        self.counters.update(other.counters)
+
+    def to_dict(self):
+        counters = dict(self.counters)
+        lookups = counters.get('geocode_cache_hits', 0) + counters.get('geocode_cache_misses', 0)
+        if lookups:
+            counters['geocode_cache_hit_rate'] = counters.get('geocode_cache_hits', 0) / lookups
+        if counters.get('geocode_lookups'):
+            counters['geocode_mean_latency_ms'] = counters['geocode_lookup_seconds'] / counters['geocode_lookups'] * 1000
+        page_hits = counters.get('page_cache_memory_hits', 0) + counters.get('page_cache_disk_hits', 0)
+        if page_hits + counters.get('page_cache_misses', 0):
+            counters['page_cache_hit_rate'] = page_hits / (page_hits + counters.get('page_cache_misses', 0))
+        return {
+            'stages': {stage: {'seconds': self.seconds[stage], 'calls': self.calls[stage]}
+                       for stage in sorted(self.seconds, key=self.seconds.get, reverse=True)},
+            'counters': counters,
+        }
+
+    def summary(self, top=5):
+        return ', '.join(f'{stage} {seconds:.2f}s'
+                         for stage, seconds in sorted(self.seconds.items(), key=lambda item: -item[1])[:top])
+
+
+def prometheus_lines(metrics, labels=()):
+    def series(name, extra=()):
+        label_text = ','.join(f'{key}="{value}"' for key, value in list(labels) + list(extra))
+        return f'textprocessor_{name}{{{label_text}}}' if label_text else f'textprocessor_{name}'
+
+    data = metrics.to_dict()
+    for stage, values in data['stages'].items():
+        yield f'{series("stage_seconds_total", [("stage", stage)])} {values["seconds"]}'
+        yield f'{series("stage_calls_total", [("stage", stage)])} {values["calls"]}'
+    for name, value in data['counters'].items():
+        yield f'{series(name)} {value}'
+
+
+def worker_utilization(busy, num_workers, wall_seconds):
+    '''How busy the workers of a run were: busy is {worker: CPU seconds spent on jobs}, workers that never got a job count as idle.'''
+    seconds = sorted(busy.values(), reverse=True) + [0.0] * (num_workers - len(busy))
+    return {'wall_seconds': wall_seconds, 'busy_seconds': sum(seconds),
+            'utilization': sum(seconds) / (num_workers * wall_seconds) if wall_seconds else 0.0,
+            'workers': [{'busy_seconds': busy_seconds, 'utilization': busy_seconds / wall_seconds if wall_seconds else 0.0}
+                        for busy_seconds in seconds]}
+
+
+def write_stats(path, file_metrics, workers=None):
+    '''Saves the metrics of each file ({file name: Metrics}) and their total for the run, with the worker_utilization
+    of the run if given.'''
+    run = Metrics()
+    for metrics in file_metrics.values():
+        run.add(metrics)
+
+    with open(path, 'w') as file:
+        if str(path).endswith('.prom'):
+            file.write('\n'.join(prometheus_lines(run)) + '\n')
+            for file_name, metrics in sorted(file_metrics.items()):
+                file.write('\n'.join(prometheus_lines(metrics, [('file', file_name)])) + '\n')
+            if workers:
+                file.write(f'textprocessor_run_seconds {workers["wall_seconds"]}\n')
+                file.write(f'textprocessor_worker_utilization {workers["utilization"]}\n')
+                for i, worker in enumerate(workers['workers']):
+                    file.write(f'textprocessor_worker_busy_seconds{{worker="{i}"}} {worker["busy_seconds"]}\n')
+        else:
+            json.dump({'run': run.to_dict(), 'workers': workers,
+                       'files': {file_name: metrics.to_dict() for file_name, metrics in sorted(file_metrics.items())}},
+                      file, indent=4)
+    print(f'Saved stats to {path}')
+    return run
@@ -0,0 +1,274 @@
+'''Writers for TextProcessor's token output, and a reader for the columnar format.
+
+- json:     one pretty-printed JSON list of token dicts per page, <book>_page_<n>.json (the original format)
+- jsonl:    one compact JSON object per token and line, per page, <book>_page_<n>.jsonl
+- columnar: one binary file per book, <book>.tokcol, with a typed array per column. Offsets and page ids are
+            stored as int32 arrays, latitude and longitude as float64 arrays (NaN for None), and the string
+            columns (text, lemma, POS, USAS tags, NE tag and NE geolocation) as int32 ids into a per-book
+            dictionary (-1 for None). 'columnar-zlib' compresses each column with zlib.
+
+Layout of a .tokcol file: the magic bytes, the length of the JSON header as a little-endian uint64, the header
+(row count, page row ranges, dictionaries and the dtype, offset and length of each column), padding to a multiple
+of 8 bytes, then the columns. Uncompressed columns are read straight from a memory map, without copying.
+
+Every file is written under a temporary name and renamed into place once complete, so a worker that is killed
+part way never leaves a half-written output file behind.'''
+import os
+import json
+import mmap
+import zlib
+import struct
+from pathlib import Path
+from array import array
+from contextlib import contextmanager
+import numpy
+
+MAGIC = b'TOKCOL1\n'
+INT_COLUMNS = ['page_id', 'start_char', 'end_char']
+STRING_COLUMNS = ['text', 'lemma', 'POS', 'USAS_tags', 'NE_tag', 'NE_geolocation']
+FLOAT_COLUMNS = ['latitude', 'longitude']
+
+
+def align(offset):
+    return (offset + 7) // 8 * 8
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    '''Opens a temporary file next to path that replaces path once it has been written and closed.
+    If writing fails, the temporary file is removed and whatever was at path is left as it was.'''
+    temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(temp_path, mode) as file:
+            yield file
+        os.replace(temp_path, path)
+    except BaseException:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise
+
+
+class PageWriter:
+    '''
+        Writes the processed pages of one input file. Used as a context manager, pages are passed to write_page.
+        output_files lists the files written so far. A resumable writer writes every page to its own files as
+        soon as it gets it, so an interrupted file can be finished later by writing only the missing pages.
+    '''
+    resumable = True
+
+    def __init__(self, output_path, original_file_path):
+        self.output_path = output_path
+        self.stem = original_file_path.stem
+        self.output_files = []
+        self.finished = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.finish()
+
+    def finish(self):
+        '''Closes the writer, once - leaving the with block closes it unless finish was called already.'''
+        if not self.finished:
+            self.finished = True
+            self.close()
+
+    def write_page(self, page_data, page_id):
+        raise NotImplementedError
+
+    def adopt(self, shard_files):
+        '''Takes over output files that a writer of the same kind wrote for part of the book, in page order.
+        Page files are moved into the output directory as they are.'''
+        for path in shard_files:
+            output_file = self.output_path / Path(path).name
+            os.replace(path, output_file)
+            self.output_files.append(output_file)
+
+    def close(self):
+        pass
+
+
+class JSONPageWriter(PageWriter):
+    def write_page(self, page_data, page_id):
+        output_file = self.output_path / f"{self.stem}_page_{page_id}.json"
+        with atomic_open(output_file) as file:
+            json.dump(page_data, file, indent=4)
+        self.output_files.append(output_file)
+        print(f'Saved file {output_file}')
+
+
+class JSONLinesPageWriter(PageWriter):
+    def write_page(self, page_data, page_id):
+        output_file = self.output_path / f"{self.stem}_page_{page_id}.jsonl"
+        with atomic_open(output_file) as file:
+            file.writelines(json.dumps(token, separators=(',', ':')) + '\n' for token in page_data)
+        self.output_files.append(output_file)
+        print(f'Saved file {output_file}')
+
+
+class ColumnarWriter(PageWriter):
+    '''Collects the columns of the whole book as compact arrays and writes the .tokcol file on close.'''
+    resumable = False
+
+    def __init__(self, output_path, original_file_path, compression=None):
+        super().__init__(output_path, original_file_path)
+        self.compression = compression
+        self.columns = {name: array('i') for name in INT_COLUMNS + STRING_COLUMNS}
+        self.columns.update({name: array('d') for name in FLOAT_COLUMNS})
+        self.dictionaries = {name: {} for name in STRING_COLUMNS}
+        self.pages = []  # [page_id, first row, row after the last]
+
+    def encode(self, column, value):
+        if value is None:
+            return -1
+        ids = self.dictionaries[column]
+        return ids.setdefault(value, len(ids))
+
+    def write_page(self, page_data, page_id):
+        first_row = len(self.columns['page_id'])
+        columns = self.columns
+        for token in page_data:
+            _, ne_tag, geolocation = token['NE']
+            columns['page_id'].append(token['page_id'])
+            columns['start_char'].append(token['start_char'])
+            columns['end_char'].append(token['end_char'])
+            columns['text'].append(self.encode('text', token['text']))
+            columns['lemma'].append(self.encode('lemma', token['lemma']))
+            columns['POS'].append(self.encode('POS', token['POS']))
+            columns['USAS_tags'].append(self.encode('USAS_tags', json.dumps(token['USAS_tags'])))
+            columns['NE_tag'].append(self.encode('NE_tag', ne_tag))
+            columns['NE_geolocation'].append(self.encode('NE_geolocation', None if geolocation is None else json.dumps(geolocation)))
+            columns['latitude'].append(numpy.nan if token['latitude'] is None else token['latitude'])
+            columns['longitude'].append(numpy.nan if token['longitude'] is None else token['longitude'])
+        self.pages.append([page_id, first_row, len(self.columns['page_id'])])
+
+    def adopt(self, shard_files):
+        # The pages of the part files are added to this book's columns, re-encoded against its dictionaries
+        for path in shard_files:
+            with ColumnarReader(path) as reader:
+                for page_id in reader.page_ids():
+                    self.write_page(reader.page_tokens(page_id), page_id)
+            os.remove(path)
+
+    def close(self):
+        blobs, column_info, offset = [], {}, 0
+        for name, values in self.columns.items():
+            blob = numpy.asarray(values, dtype='<i4' if values.typecode == 'i' else '<f8').tobytes()
+            if self.compression == 'zlib':
+                blob = zlib.compress(blob)
+            column_info[name] = {'dtype': '<i4' if values.typecode == 'i' else '<f8', 'offset': offset, 'length': len(blob)}
+            blobs.append(blob + b'\0' * (align(len(blob)) - len(blob)))
+            offset += align(len(blob))
+
+        header = json.dumps({
+            'rows': len(self.columns['page_id']),
+            'compression': self.compression,
+            'pages': self.pages,
+            'columns': column_info,
+            'dictionaries': {name: list(ids) for name, ids in self.dictionaries.items()},
+        }).encode('utf8')
+        preamble = MAGIC + struct.pack('<Q', len(header)) + header
+        output_file = self.output_path / f"{self.stem}.tokcol"
+        with atomic_open(output_file, 'wb') as file:
+            file.write(preamble + b'\0' * (align(len(preamble)) - len(preamble)))
+            file.writelines(blobs)
+        self.output_files.append(output_file)
+        print(f'Saved file {output_file}')
+
+
+class ZlibColumnarWriter(ColumnarWriter):
+    '''ColumnarWriter with every column compressed with zlib.'''
+    def __init__(self, output_path, original_file_path):
+        super().__init__(output_path, original_file_path, 'zlib')
+
+
+class ColumnarReader:
+    '''
+        Reads a .tokcol file through a memory map. column() gives a numpy array over the file, dictionary()
+        the strings a string column's ids refer to, and page_tokens() a page as the same list of token dicts
+        the JSON format holds.
+    '''
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a columnar token file')
+        header_length, = struct.unpack('<Q', self.buffer[len(MAGIC):len(MAGIC) + 8])
+        header_start = len(MAGIC) + 8
+        self.header = json.loads(self.buffer[header_start:header_start + header_length])
+        self.data_start = align(header_start + header_length)
+        self.pages = {page_id: (first_row, end_row) for page_id, first_row, end_row in self.header['pages']}
+        self._columns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.header['rows']
+
+    def close(self):
+        self._columns = {}
+        try:
+            self.buffer.close()
+        except BufferError:
+            pass  # Arrays handed out by column() still point into the map, it is closed once they are gone
+        self.file.close()
+
+    def column(self, name):
+        if name not in self._columns:
+            info = self.header['columns'][name]
+            start = self.data_start + info['offset']
+            if self.header['compression'] == 'zlib':
+                values = numpy.frombuffer(zlib.decompress(self.buffer[start:start + info['length']]), dtype=info['dtype'])
+            else:
+                values = numpy.frombuffer(self.buffer, dtype=info['dtype'],
+                                          count=info['length'] // numpy.dtype(info['dtype']).itemsize, offset=start)
+            self._columns[name] = values
+        return self._columns[name]
+
+    def dictionary(self, name):
+        return self.header['dictionaries'][name]
+
+    def page_ids(self):
+        return list(self.pages)
+
+    def page_tokens(self, page_id):
+        first_row, end_row = self.pages[page_id]
+        rows = {name: self.column(name)[first_row:end_row].tolist()
+                for name in INT_COLUMNS + STRING_COLUMNS + FLOAT_COLUMNS}
+        strings = {name: self.dictionary(name) for name in STRING_COLUMNS}
+
+        def decode(name, i):
+            value_id = rows[name][i]
+            return None if value_id < 0 else strings[name][value_id]
+
+        tokens = []
+        for i in range(end_row - first_row):
+            geolocation = decode('NE_geolocation', i)
+            latitude, longitude = rows['latitude'][i], rows['longitude'][i]
+            tokens.append({
+                'text': decode('text', i),
+                'lemma': decode('lemma', i),
+                'POS': decode('POS', i),
+                'USAS_tags': json.loads(decode('USAS_tags', i)),
+                'page_id': rows['page_id'][i],
+                'start_char': rows['start_char'][i],
+                'end_char': rows['end_char'][i],
+                'NE': [decode('text', i), decode('NE_tag', i), None if geolocation is None else json.loads(geolocation)],
+                'latitude': None if latitude != latitude else latitude,  # NaN stands for None
+                'longitude': None if longitude != longitude else longitude,
+            })
+        return tokens
+
+
+WRITERS = {
+    'json': JSONPageWriter,
+    'jsonl': JSONLinesPageWriter,
+    'columnar': ColumnarWriter,
+    'columnar-zlib': ZlibColumnarWriter,
+}
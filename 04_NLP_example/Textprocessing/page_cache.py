@@ -0,0 +1,106 @@
+'''Cache of processed pages for TextProcessor, so a page whose text has been seen before is not run through the
+pipeline and the named entity extractor again.
+
+Pages are keyed by TextProcessor.page_key, a hash of the page text and the annotation versions, so a new model
+or pattern list never gets an old result. The text is hashed exactly as it is: the token offsets are part of the
+output, so two pages that only differ in their whitespace don't share a result. The cached value is the page's
+list of token dicts without their locations, and the (token index, place name) of the tokens to geocode,
+pickled. The page_id is filled in again on every hit, and TextProcessor geocodes the place names again, so the
+locations always come from the current geocoder and its cache, with its expiry of failed lookups.
+
+There are two tiers. The memory tier keeps the most recently used pages up to a size in bytes and belongs to
+one process. The disk tier is an optional SQLite file that outlives the run and can be shared by the workers and
+by containers that mount it, like SQLiteGeocodeCache. Its entries are pickles, so only point it at a file you
+trust.'''
+import os
+import time
+import zlib
+import pickle
+import sqlite3
+from collections import OrderedDict
+
+
+class PageCache:
+    """
+        Parameters:
+        - max_bytes (int): Size bound of the memory tier, the least recently used pages are evicted past it.
+        - path (str): SQLite file for the disk tier, None keeps the cache in memory only.
+        - max_disk_entries (int): Size bound of the disk tier, in pages.
+    """
+    def __init__(self, max_bytes=64 << 20, path=None, max_disk_entries=200000):
+        self.max_bytes = max_bytes
+        self.path = str(path) if path else None
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()  # key -> pickled (tokens, places), least recently used first
+        self.size = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # Each process opens its own connection on first use, so the cache can be created before forking
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, tokens BLOB, last_used REAL)')
+                connection.execute('CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)')
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def get(self, key, page_id):
+        """Returns the cached (tokens, places) of the page with this key, with the tokens' page_id set, or None."""
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+            self.memory_hits += 1
+        elif self.path:
+            row = self.connection.execute('SELECT tokens FROM pages WHERE key = ?', (key,)).fetchone()
+            if row:
+                data = zlib.decompress(row[0])
+                with self.connection:
+                    self.connection.execute('UPDATE pages SET last_used = ? WHERE key = ?', (time.time(), key))
+                self.remember(key, data)
+                self.disk_hits += 1
+        if data is None:
+            self.misses += 1
+            return None
+        tokens, places = pickle.loads(data)
+        for token in tokens:
+            token['page_id'] = page_id
+        return tokens, places
+
+    def put(self, key, tokens, places=()):
+        data = pickle.dumps((tokens, list(places)), protocol=pickle.HIGHEST_PROTOCOL)
+        self.remember(key, data)
+        if self.path:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+                                        (key, zlib.compress(data, 1), time.time()))
+                self.evict()
+
+    def remember(self, key, data):
+        if key in self.entries:
+            self.size -= len(self.entries[key])
+        self.entries[key] = data
+        self.entries.move_to_end(key)
+        self.size += len(data)
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def evict(self):
+        excess = self.connection.execute('SELECT COUNT(*) FROM pages').fetchone()[0] - self.max_disk_entries
+        if excess > 0:
+            self.connection.execute('DELETE FROM pages WHERE key IN '
+                                    '(SELECT key FROM pages ORDER BY last_used LIMIT ?)', (excess,))
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0}
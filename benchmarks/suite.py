@@ -0,0 +1,272 @@
+'''Benchmark suite for the hot paths of the examples, so changes can be checked for speed-ups and regressions.
+
+Cases:
+- process_data:           TextProcessor.process_data over the 0118 JSON files (pages/sec, tokens/sec, peak RSS)
+- setup_entity_patterns:  NamedEntityExtractor start-up, building the entity patterns and loading their snapshot
+- ner:                    extract_entities and convert_to_iob_format on the largest 0118 pages
+- pymusas_example:        01_application_dockerfile_example's tagging loop on the two Sherlock Holmes texts
+- dispatch:               the compose server's Dispatcher against 5 local stub workers
+
+Each case runs in its own Python process, so the peak RSS is that of the case alone and one case can't warm up
+another. Geocoding is answered by the offline stub in 04_NLP_example/Textprocessing/benchmarks/stub_nominatim.py,
+and the stub workers are the ones from 03_complex_compose_example/benchmarks/dispatch.py, so the suite needs no
+network. The results are written as JSON together with the versions and machine they were measured on. Given
+the results of an earlier run with --baseline, metrics that got worse by more than --threshold are listed and
+the suite exits with status 1. Metrics ending in _per_sec are better when higher, those ending in _seconds, _ms
+or _mb when lower; the other values, like page and token counts, are recorded but not compared.
+
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --baseline results.json --threshold 0.15 --repeat 3
+    python benchmarks/suite.py --cases ner dispatch --quick
+'''
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import importlib.util
+import multiprocessing
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TEXTPROCESSING = ROOT / '04_NLP_example' / 'Textprocessing'
+PYMUSAS_EXAMPLE = ROOT / '01_application_dockerfile_example'
+COMPOSE_EXAMPLE = ROOT / '03_complex_compose_example'
+
+HIGHER_IS_BETTER = ('_per_sec',)
+LOWER_IS_BETTER = ('_seconds', '_ms', '_mb')
+
+SHERLOCK_TEXTS = ['The Adventures of Sherlock Holmes.txt', 'The Return of Sherlock Holmes.txt']
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in KiB on Linux
+
+
+def use_textprocessing():
+    # The resource lists are opened with relative paths. The Textprocessing benchmarks folder goes last, as it
+    # holds scripts named like the modules they benchmark
+    os.chdir(TEXTPROCESSING)
+    sys.path.insert(0, str(TEXTPROCESSING))
+    sys.path.append(str(TEXTPROCESSING / 'benchmarks'))
+
+
+def input_files(quick):
+    files = sorted((TEXTPROCESSING / '0118').glob('*.json'))
+    return files[:3] if quick else files
+
+
+def case_process_data(quick):
+    use_textprocessing()
+    from TextProcessor import TextProcessor, NLP_MODEL
+    from stub_nominatim import OfflineGeocoder
+
+    processor = TextProcessor(TEXTPROCESSING / '0118', NLP_MODEL, geocoder=OfflineGeocoder())
+    pages = tokens = tagging_seconds = 0
+    for file_path in input_files(quick):
+        data = processor.load_json_data(file_path)
+        start = time.perf_counter()
+        result = asyncio.run(processor.process_data(data))
+        tagging_seconds += time.perf_counter() - start
+        pages += len(data)
+        tokens += len(result)
+    return {'pages': pages, 'tokens': tokens, 'tagging_seconds': tagging_seconds,
+            'pages_per_sec': pages / tagging_seconds, 'tokens_per_sec': tokens / tagging_seconds,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def load_pipeline():
+    import spacy
+    nlp = spacy.load('en_core_web_sm', exclude=['parser'])
+    nlp.add_pipe('pymusas_rule_based_tagger', source=spacy.load('en_dual_none_contextual'))
+    return nlp
+
+
+def case_setup_entity_patterns(quick):
+    use_textprocessing()
+    from Named_entity_extractor import NamedEntityExtractor
+    from stub_nominatim import OfflineGeocoder
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        timings = {}
+        # The first extractor builds the patterns and saves the snapshot, the second loads it
+        for name in ['build_seconds', 'snapshot_load_seconds']:
+            nlp = load_pipeline()
+            start = time.perf_counter()
+            NamedEntityExtractor(nlp, geocoder=OfflineGeocoder(), snapshot_dir=snapshot_dir)
+            timings[name] = time.perf_counter() - start
+    return timings
+
+
+def case_ner(quick):
+    use_textprocessing()
+    from TextProcessor import TextProcessor, NLP_MODEL
+    from Named_entity_extractor import NamedEntityExtractor
+    from stub_nominatim import OfflineGeocoder
+    from extract_entities import gazetteer_lists
+
+    texts = [text for file_path in input_files(quick) for _, text in TextProcessor.iter_json_pages(file_path)]
+    texts = sorted(texts, key=len, reverse=True)[:5 if quick else 20]
+    characters = sum(len(text) for text in texts)
+    nee = NamedEntityExtractor(NLP_MODEL, geocoder=OfflineGeocoder())
+
+    entries = gazetteer_lists()
+    start = time.perf_counter()
+    nee.extract_entities('', entries)  # Builds the matcher for the list
+    matcher_build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for text in texts:
+        nee.extract_entities(text, entries)
+    extract_seconds = time.perf_counter() - start
+
+    docs = list(NLP_MODEL.pipe(texts))
+    merged = [nee.merge_entities(doc) for doc in docs]
+    tokens = sum(len(doc) for doc in docs)
+
+    async def convert():
+        for entities, doc in zip(merged, docs):
+            await nee.convert_to_iob_format(entities, doc)
+
+    start = time.perf_counter()
+    asyncio.run(convert())
+    convert_seconds = time.perf_counter() - start
+    return {'pages': len(texts), 'characters': characters, 'tokens': tokens,
+            'matcher_build_seconds': matcher_build_seconds,
+            'extract_entities_chars_per_sec': characters / extract_seconds,
+            'convert_to_iob_tokens_per_sec': tokens / convert_seconds}
+
+
+def case_pymusas_example(quick):
+    spec = importlib.util.spec_from_file_location('pymusas_example', PYMUSAS_EXAMPLE / 'src' / 'pymusas-example.py')
+    example = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(example)
+    nlp = example.load_pipeline()
+
+    metrics = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for name in SHERLOCK_TEXTS[:1] if quick else SHERLOCK_TEXTS:
+            book = name.split()[1].lower()  # 'adventures' or 'return'
+            start = time.perf_counter()
+            tokens = example.tag_lines_pipe(nlp, PYMUSAS_EXAMPLE / 'input' / name, Path(output_dir) / 'output.txt')
+            metrics[f'{book}_tokens_per_sec'] = tokens / (time.perf_counter() - start)
+    metrics['peak_rss_mb'] = peak_rss_mb()
+    return metrics
+
+
+def case_dispatch(quick):
+    sys.path.insert(0, str(COMPOSE_EXAMPLE / 'benchmarks'))
+    from dispatch import stub_addresses, run_stub_workers, run_dispatcher
+
+    random.seed(0)
+    addresses, port = stub_addresses(5), 18070
+    stubs = multiprocessing.Process(target=run_stub_workers, args=(addresses, port, [0.02] * 4 + [0.1], 8), daemon=True)
+    stubs.start()
+    time.sleep(1)
+    try:
+        report = run_dispatcher(addresses, port, 500 if quick else 2000, 8, 128)
+    finally:
+        stubs.terminate()
+    return {'jobs_per_sec': report['jobs_per_second'], 'latency_p50_ms': report['latency_ms']['p50'],
+            'latency_p99_ms': report['latency_ms']['p99'], 'failed_jobs': report['failed']}
+
+
+CASES = {
+    'process_data': case_process_data,
+    'setup_entity_patterns': case_setup_entity_patterns,
+    'ner': case_ner,
+    'pymusas_example': case_pymusas_example,
+    'dispatch': case_dispatch,
+}
+
+
+def run_case(name, quick, verbose):
+    '''Runs one case in a fresh interpreter and returns its metrics.'''
+    with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+        command = [sys.executable, str(Path(__file__).resolve()), '--run-case', name, '--result-file', result_file.name]
+        if quick:
+            command.append('--quick')
+        output = None if verbose else subprocess.DEVNULL  # The pipeline prints every saved file and entity label
+        subprocess.run(command, check=True, stdout=output)
+        return json.load(open(result_file.name))
+
+
+def environment():
+    import spacy
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'spacy': spacy.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, threshold):
+    '''Prints how every metric moved since the baseline and returns the ones that got worse by more than threshold.'''
+    regressions = []
+    for case, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(case, {}).get(metric)
+            if not old or not metric.endswith(HIGHER_IS_BETTER + LOWER_IS_BETTER):
+                continue
+            change = (value - old) / old
+            worse = -change if metric.endswith(HIGHER_IS_BETTER) else change
+            flag = 'REGRESSION' if worse > threshold else ''
+            print(f'{case + "." + metric:<52}{old:>14.3f}{value:>14.3f}{change:>+9.1%}  {flag}')
+            if flag:
+                regressions.append(f'{case}.{metric}')
+    return regressions
+
+
+def main(args):
+    if args.run_case:
+        metrics = CASES[args.run_case](args.quick)
+        with open(args.result_file, 'w') as file:
+            json.dump(metrics, file)
+        return
+
+    results = {}
+    for name in args.cases:
+        print(f'Running {name}...', flush=True)
+        runs = [run_case(name, args.quick, args.verbose) for _ in range(args.repeat)]
+        # The median of the repeats, per metric
+        results[name] = {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+        for metric, value in results[name].items():
+            print(f'  {metric:<40}{value:>14.3f}')
+
+    with open(args.output, 'w') as file:
+        json.dump({'environment': environment(), 'quick': args.quick, 'repeat': args.repeat, 'results': results},
+                  file, indent=4)
+    print(f'Saved results to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('quick') != args.quick:
+            print('Warning: the baseline was measured with a different --quick setting')
+        print(f'\n{"metric":<52}{"baseline":>14}{"now":>14}{"change":>9}')
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} metrics regressed by more than {args.threshold:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+        print(f'\nNo metric regressed by more than {args.threshold:.0%}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the hot paths of the examples.')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='relative change counted as a regression')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case, the median is kept')
+    parser.add_argument('--quick', action='store_true', help='smaller inputs, for a fast check')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the cases')
+    parser.add_argument('--run-case', choices=list(CASES), help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    main(parser.parse_args())